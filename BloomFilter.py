@@ -0,0 +1,35 @@
+import hashlib
+import math
+import struct
+
+import numpy as np
+
+
+class BloomFilter:
+    """
+        Set membership test without false negatives, used to skip database lookups for keys that certainly do not exist.
+        Every key sets numHashes bits of a bit array, positions in the form of (h1 + i * h2) mod numBits with h1, h2 taken
+        from the md5 of the key. The rate of false positives stays below falsePositiveRate as long as at most capacity
+        keys are added.
+    """
+
+    def __init__(self, capacity, falsePositiveRate):
+        self.capacity = max(1, capacity)
+        self.numBits = max(8, int(math.ceil(-self.capacity * math.log(falsePositiveRate) / math.log(2) ** 2)))
+        self.numHashes = max(1, int(round(float(self.numBits) / self.capacity * math.log(2))))
+        self.bits = np.zeros(self.numBits, dtype=np.bool_)
+        self.numKeys = 0
+
+    def getPositions(self, key):
+        (h1, h2) = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.numBits for i in xrange(self.numHashes)]
+
+    def add(self, key):
+        self.bits[self.getPositions(key)] = True
+        self.numKeys = self.numKeys + 1
+
+    def isFull(self):
+        return self.numKeys > self.capacity
+
+    def __contains__(self, key):
+        return bool(self.bits[self.getPositions(key)].all())
@@ -36,6 +36,7 @@ class bcolors:
 class MainInterpreter(cmd.Cmd):
     prompt = bcolors.OKBLUE + "(Expelliarmus) " + bcolors.ENDC
     _availableArgsList = ("vmis", "packages", "baseimages")
+    _availableArgsNearest = ["masters", "baseimages", "vmis"]
     _availableArgsReassembly = []
     _availableArgsEvaluateFunctions = ["decomposition1", "decomposition2", "reassembly", "similarity"]
     _availableArgsEvaluateOptions = ["--repetitions=", "--path="]
@@ -53,6 +54,7 @@ class MainInterpreter(cmd.Cmd):
             numVMIs = repo.getNumberOfVMIs()
             numBases = repo.getNumberOfBaseImages()
             numPkgs = repo.getNumberOfPackages()
+            (pkgFilesSize, pkgBlobsSize) = repo.getPackageStoreSize()
             self._availableArgsReassembly = repo.getAllVmiNames()
             self._availableArgsReassembly.append("all")
 
@@ -61,6 +63,8 @@ class MainInterpreter(cmd.Cmd):
         print "\tVMIs:        {0:>{width}s}".format(numVMIs, width=digits)
         print "\tBase Images: {0:>{width}s}".format(numBases, width=digits)
         print "\tPackages:    {0:>{width}s}".format(numPkgs, width=digits)
+        print "\tPackage files: %.1f MB, %.1f MB stored without duplicates" \
+              % (pkgFilesSize / 1024.0 / 1024.0, pkgBlobsSize / 1024.0 / 1024.0)
         print "\nSupported VMI formats: " + ",".join(StaticInfo.validVMIFormats) + "\n\n\n\n"
 
 
@@ -77,6 +81,8 @@ class MainInterpreter(cmd.Cmd):
             print "Any path given by the user to specify files or folders has to be relative to the working directory of this program."
             print ""
             print "\tlist       - show information about VMI components currently stored"
+            print "\tsearch     - find VMIs containing a package"
+            print "\tnearest    - find stored VMIs or base images most similar to a VMI"
             print "\tinspect    - inspect VMIs and define main services"
             print "\tdecompose  - decompose VMIs"
             print "\treassemble - reassemble VMIs"
@@ -103,6 +109,46 @@ class MainInterpreter(cmd.Cmd):
         print ""
         print "\tShows a complete list of VMIs/Packages/Base images that are currently stored in the repository.\n"
 
+    def do_search(self, line):
+        if len(line.strip()) == 0:
+            print "Error: no package name given. Type \"help search\" for usage."
+        else:
+            self.exp.printVMIsWithPackage(line.strip())
+
+    def help_search(self):
+        print "\nUsage: search name"
+        print ""
+        print "\tLists packages in the repository with names containing or similar to \"name\", closest first,"
+        print "\ttogether with the VMIs that contain them.\n"
+
+    def do_nearest(self, line):
+        args = line.split()
+        k = 5
+        if len(args) > 0 and args[0].startswith("--k="):
+            k = self.parsePositiveInteger(args.pop(0))
+            if k is None:
+                return
+        if len(args) != 2 or args[0] not in self._availableArgsNearest:
+            print "Error: invalid arguments. Please consult \"help nearest\"."
+        elif args[1].startswith("/"):
+            print "Error: \"%s\" is not a valid path. Please try again with a path relative to the directory of this program." % args[1]
+        elif not os.path.isfile(args[1]):
+            print "Error: \"%s\" is not a valid path." % args[1]
+        else:
+            self.exp.printNearest(args[1], k, args[0])
+
+    def complete_nearest(self, text, line, begidx, endidx):
+        if len(line[:begidx].split()) < 2:
+            return _complete_arg_list(text, self._availableArgsNearest + ["--k="])
+        return _complete_rel_path(text)
+
+    def help_nearest(self):
+        print "\nUsage: nearest [--k=number] { masters | baseimages | vmis } path"
+        print ""
+        print "\tLists the k (default 5) stored masters, base images or VMIs most similar to the VMI specified by \"path\"."
+        print "\tSimilarities are estimated from package signatures stored in the repository."
+        print "\tMasters are compared on main services, which are read from the VMI's .meta file (see \"inspect\").\n"
+
     def do_inspect(self, line):
         if line.startswith("/"):
             print "Error: \"%s\" is not a valid path. Please try again with a path relative to the directory of this program." % line
@@ -125,7 +171,15 @@ class MainInterpreter(cmd.Cmd):
               "\t" + StaticInfo.cliHintPath + "\n"
 
     def do_decompose(self, line):
-        if line.startswith("/"):
+        if line.startswith("--plan"):
+            line = line[6:].strip()
+            if line.startswith("/"):
+                print "Error: \"%s\" is not a valid path. Please try again with a path relative to the directory of this program." % line
+            elif os.path.isfile(line) or os.path.isdir(line):
+                self.exp.planDecomposition(line)
+            else:
+                print "Error: \"%s\" is not a valid path." % line
+        elif line.startswith("/"):
             print "Error: \"%s\" is not a valid path. Please try again with a path relative to the directory of this program." % line
         elif os.path.isfile(line):
             self.exp.decomposeVMI(line)
@@ -141,11 +195,15 @@ class MainInterpreter(cmd.Cmd):
             print "Error: \"%s\" is not a valid path." % line
 
     def help_decompose(self):
-        print "\nUsage: decompose path"
+        print "\nUsage: decompose [--plan] path"
         print "\n\tDecompose the VMI specified by \"path\" or all VMIs in folder specified by \"path\"."
-        print "\tRequires a .meta file for each VMI to be decomposed. This file can be created with command \"inspect\".\n"
+        print "\tRequires a .meta file for each VMI to be decomposed. This file can be created with command \"inspect\"."
+        print "\tWith --plan, VMIs are only opened read-only and the outcome of the decomposition is reported"
+        print "\t(packages to export and remove, base image selection, projected storage savings).\n"
 
     def complete_decompose(self, text, line, begidx, endidx):
+        if len(line[:begidx].split()) < 2 and text.startswith("-"):
+            return _complete_arg_list(text, ["--plan"])
         return _complete_rel_path(text)
 
     def do_reassemble(self, line):
@@ -164,6 +222,13 @@ class MainInterpreter(cmd.Cmd):
     def complete_reassemble(self, text, line, begidx, endidx):
         return [i for i in self._availableArgsReassembly if i.startswith(text)]
 
+    def parsePositiveInteger(self, text):
+        value = text.rsplit("=", 1)[1]
+        if not value.isdigit() or int(value) == 0:
+            print "Error: %s is not a positive integer" % value
+            return None
+        return int(value)
+
     def parseRepetitions(self, text):
         try:
             return int(text.rsplit("=", 1)[1])
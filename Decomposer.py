@@ -2,14 +2,143 @@ import sys
 import time
 import shutil
 import os
-from collections import defaultdict
+import multiprocessing
 
+from Evaluation import DecompositionEvaluation
 from GuestFSHelper import GuestFSHelper
+from PackageGraph import PackageGraph
 from RepositoryDatabase import RepositoryDatabase
 from StaticInfo import StaticInfo
 from VMIDescription import BaseImageDescriptor, VMIDescriptor
 from VMIManipulation import VMIManipulator
-from VMISimilarity import SimilarityCalculator
+from SimilarityMatrix import SimilarityMatrix
+
+
+def decomposeGuestInWorker(vmiData):
+    """
+        Runs in worker processes of Decomposer.decomposeMany
+    :param vmiData: in the form of (pathToVMI, vmiName, [MS1,MS2], evaluate)
+    :rtype: GuestPhaseResult
+    """
+    (pathToVMI, vmiName, mainServices, evaluate) = vmiData
+    evalDecomp = None
+    if evaluate:
+        evalDecomp = DecompositionEvaluation(None)
+    result = Decomposer.tryDecomposeGuest(pathToVMI, vmiName, mainServices, evalDecomp=evalDecomp)
+    result.evalDecomp = evalDecomp
+    # appliances kept warm by the handle pool would outlive the worker process
+    GuestFSHelper.closeAllHandles()
+    return result
+
+
+def planDecompositionInWorker(vmiData):
+    """
+        Runs in worker processes of Decomposer.planMany
+    :param vmiData: in the form of (pathToVMI, vmiName, [MS1,MS2])
+    :rtype: DecompositionPlan
+    """
+    (pathToVMI, vmiName, mainServices) = vmiData
+    plan = Decomposer.tryPlan(pathToVMI, vmiName, mainServices)
+    # appliances kept warm by the handle pool would outlive the worker process
+    GuestFSHelper.closeAllHandles()
+    return plan
+
+
+class GuestPhaseResult:
+    """
+        Everything the commit phase of a decomposition needs from its guest phase (see Decomposer.decomposeMany).
+        Sent back from worker processes, graphs are encoded as PackageGraphFile instead of pickled descriptors.
+    """
+    def __init__(self, pathToVMI, vmiName, mainServices):
+        self.pathToVMI = pathToVMI
+        self.vmiName = vmiName
+        self.mainServices = mainServices
+        self.error = None               # message if the VMI could not be decomposed
+        self.vmiModified = False        # True if the error happened after the package export had started
+        self.vmiData = None             # VMI before the removal, in the form of (inspectionData, encoded PackageGraph)
+        self.baseImageData = None       # VMI after the removal (new base image), same form
+        self.localPathToUserDir = None
+        self.exportedPackages = dict()  # in the form of {pkg,{name:"pkg", version:"1.1", ..., path:"localRepo/pkg.deb"}}
+        self.evalDecomp = None          # guest phase evaluation of a worker process
+        self.guestPhaseTime = 0.0
+
+    @staticmethod
+    def encodeDescriptor(descriptor):
+        inspectionData = {
+            "distribution":         descriptor.distribution,
+            "distributionVersion":  descriptor.distributionVersion,
+            "architecture":         descriptor.architecture,
+            "pkgManager":           descriptor.pkgManager
+        }
+        return (inspectionData, descriptor.graph.encode())
+
+    def getVMIDescriptor(self):
+        vmi = VMIDescriptor(self.pathToVMI, self.vmiName, self.mainServices, None, None)
+        vmi.initializeFromInspectionData(self.vmiData[0], PackageGraph.decode(self.vmiData[1]))
+        return vmi
+
+    def getBaseImageDescriptor(self):
+        baseImage = BaseImageDescriptor(self.pathToVMI)
+        baseImage.initializeFromInspectionData(self.baseImageData[0], PackageGraph.decode(self.baseImageData[1]))
+        return baseImage
+
+
+class DecompositionPlan:
+    """
+        Projected outcome of a decomposition (see Decomposer.plan), computed without changing the VMI or the repository.
+        Sizes are in bytes. Package files are estimated by the install sizes of the packages (upper bound),
+        base images keep the file size of the VMI (removed packages do not shrink the image file).
+    """
+    def __init__(self, pathToVMI, vmiName, mainServices):
+        self.pathToVMI = pathToVMI
+        self.vmiName = vmiName
+        self.mainServices = mainServices
+        self.error = None               # message if the VMI could not be decomposed
+        self.numRequiredPackages = 0    # main services and their dependencies
+        self.exportedPackages = []      # required packages not in the repository yet
+        self.removedPackages = []       # packages removed from the VMI
+        self.chosenBaseImage = None     # path of the existing base image used instead of the VMI's, None if it remains
+        self.replacedBaseImages = []    # paths of base images replaced by the chosen one
+        self.vmiSize = 0
+        self.exportedPackagesSize = 0
+        self.userFolderSize = 0
+        self.replacedBaseImagesSize = 0
+
+    def getStoredSize(self):
+        storedSize = self.exportedPackagesSize + self.userFolderSize
+        if self.chosenBaseImage is None:
+            storedSize = storedSize + self.vmiSize
+        return storedSize
+
+    def getSavedSize(self):
+        return self.vmiSize + self.replacedBaseImagesSize - self.getStoredSize()
+
+    def printPlan(self):
+        print "Decomposition Plan for \"%s\":" % self.vmiName
+        if self.error is not None:
+            print "\t" + self.error
+            return
+        print "\tMain Services:\t\t\t\t%s\n" \
+              "\tPackage(s) required:\t\t%i\n" \
+              "\tAlready existing locally:\t%i\n" \
+              "\tPackages to be exported:\t%i\n" \
+              "\tPackages to be removed:\t\t%i" \
+              % (",".join(self.mainServices), self.numRequiredPackages,
+                 self.numRequiredPackages - len(self.exportedPackages), len(self.exportedPackages),
+                 len(self.removedPackages))
+        if self.chosenBaseImage is None:
+            print "\tThe base image of the new VMI would remain."
+        else:
+            print "\tThe existing base image \"%s\" would be used instead of the original." % self.chosenBaseImage
+        for pathToBaseImage in self.replacedBaseImages:
+            print "\tThe base image \"%s\" would be replaced." % pathToBaseImage
+        print "\tVMI size:\t\t\t\t\t%i bytes\n" \
+              "\tProjected storage:\t\t\t%i bytes (packages %i, user folder %i, base image %i)\n" \
+              "\tReplaced base images:\t\t%i bytes\n" \
+              "\tProjected savings:\t\t\t%i bytes" \
+              % (self.vmiSize, self.getStoredSize(), self.exportedPackagesSize, self.userFolderSize,
+                 self.vmiSize if self.chosenBaseImage is None else 0, self.replacedBaseImagesSize,
+                 self.getSavedSize())
 
 
 class Decomposer:
@@ -18,7 +147,7 @@ class Decomposer:
     def checkMainServicesExistence(vmi):
         for pkgName in vmi.mainServices:
             if not vmi.checkIfNodeExists(pkgName):
-                similar = vmi.getListOfNodesContaining(pkgName)
+                similar = vmi.getSimilarNodes(pkgName)
                 if len(similar)>0:
                     sys.exit("Error: Main Service \"" + pkgName + "\" does not exist in " + vmi.vmiName + "\n"
                               "Did you mean one of the following?\n" + ",".join(similar))
@@ -26,9 +155,7 @@ class Decomposer:
                     sys.exit("Error: Main Service \"" + pkgName + "\" does not exist in " + vmi.vmiName)
 
     @staticmethod
-    def decompose(pathToVMI, vmiName, mainServices, evalDecomp=None):
-        print "\n=== Decompose VMI \"%s\"\nPath: \"%s\"" % (vmiName, pathToVMI)
-
+    def checkDecomposable(pathToVMI, vmiName):
         if not os.path.isfile(pathToVMI):
             sys.exit("ERROR: Cannot decompose VMI \"%s\". File \"%s\" does not exist!" % (vmiName, pathToVMI))
 
@@ -36,10 +163,103 @@ class Decomposer:
             if repoManager.vmiExists(vmiName):
                 sys.exit("Error: Cannot decompose VMI \"%s\". A VMI with that name already exists in the database!" % vmiName)
 
+    @staticmethod
+    def decompose(pathToVMI, vmiName, mainServices, evalDecomp=None):
+        result = Decomposer.decomposeGuest(pathToVMI, vmiName, mainServices, evalDecomp=evalDecomp)
+        if result.error is not None:
+            Decomposer.handleFailedGuestPhase(result)
+            sys.exit("ERROR: Cannot decompose VMI \"%s\"." % vmiName)
+        Decomposer.commitToRepository(result, evalDecomp=evalDecomp)
+
+    @staticmethod
+    def decomposeMany(vmiData, evalDecomp=None):
+        """
+            The guest phases (graph creation, package export and removal, user folder export) of up to
+            StaticInfo.decompositionMaxConcurrentVMIs VMIs run concurrently in worker processes. The commit phases
+            (base image selection, repository and master graph updates) run one after another in this process
+            in the order of vmiData, the repository ends up the same as after decomposing the VMIs one by one.
+            VMIs that cannot be decomposed (see decomposeGuest) are skipped.
+            With evalDecomp, packages exported by concurrent guest phases before the first of them is committed are
+            counted for each of these VMIs, sizes and package counts are only comparable with sequential runs
+            for one worker (see Expelliarmus.evaluateDecompositionOnce).
+        :param vmiData: in the form of [(pathToVMI, vmiName, [MS1,MS2])]
+        :return: generator in the form of (pathToVMI, vmiName, mainServices, decompTime), after each commit phase
+        """
+        numProcesses = max(1, min(StaticInfo.decompositionMaxConcurrentVMIs, len(vmiData)))
+        if numProcesses == 1:
+            results = Decomposer.decomposeGuestsInProcess(vmiData, evalDecomp=evalDecomp)
+        else:
+            # creates the repository database before the worker processes read it (see checkDecomposable)
+            with RepositoryDatabase():
+                pass
+            pool = multiprocessing.Pool(processes=numProcesses, initializer=GuestFSHelper.initializeWorkerProcess)
+            results = pool.imap(decomposeGuestInWorker, [(pathToVMI, vmiName, mainServices, evalDecomp is not None)
+                                                         for (pathToVMI, vmiName, mainServices) in vmiData])
+        try:
+            for result in results:
+                if result.error is not None:
+                    Decomposer.handleFailedGuestPhase(result)
+                    print "VMI \"%s\" is skipped." % result.vmiName
+                    continue
+                startTime = time.time()
+                Decomposer.commitToRepository(result, evalDecomp=evalDecomp)
+                yield (result.pathToVMI, result.vmiName, result.mainServices,
+                       result.guestPhaseTime + time.time() - startTime)
+        finally:
+            if numProcesses > 1:
+                pool.close()
+                pool.join()
+
+    @staticmethod
+    def decomposeGuestsInProcess(vmiData, evalDecomp=None):
+        for (i, (pathToVMI, vmiName, mainServices)) in enumerate(vmiData):
+            # boot appliance for next VMI while this one is decomposed
+            if i + 1 < len(vmiData):
+                GuestFSHelper.prelaunchHandle(vmiData[i + 1][0])
+            yield Decomposer.tryDecomposeGuest(pathToVMI, vmiName, mainServices, evalDecomp=evalDecomp)
+
+    @staticmethod
+    def tryDecomposeGuest(pathToVMI, vmiName, mainServices, evalDecomp=None):
+        """
+        :rtype: GuestPhaseResult
+        """
+        startTime = time.time()
+        try:
+            result = Decomposer.decomposeGuest(pathToVMI, vmiName, mainServices, evalDecomp=evalDecomp)
+        except SystemExit as e:
+            # VMI left unchanged, errors from the package export on are returned by decomposeGuest
+            result = GuestPhaseResult(pathToVMI, vmiName, mainServices)
+            result.error = str(e)
+        result.guestPhaseTime = time.time() - startTime
+        return result
+
+    @staticmethod
+    def decomposeGuest(pathToVMI, vmiName, mainServices, evalDecomp=None):
+        """
+            Everything that requires the appliance, the repository database is only read.
+            Errors before the package export end the decomposition (SystemExit), the VMI is left unchanged.
+            Errors from then on are returned in result.error with result.vmiModified set,
+            together with the packages exported so far.
+        :rtype: GuestPhaseResult
+        """
+        print "\n=== Decompose VMI \"%s\"\nPath: \"%s\"" % (vmiName, pathToVMI)
+        Decomposer.checkDecomposable(pathToVMI, vmiName)
+
         print ('Creating GuestFS Handler...')
         startTime = time.time()
         (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True)
-        handlerCreationTime = time.time() - startTime
+        if evalDecomp is not None:
+            evalDecomp.timeHandlerCreation = time.time() - startTime
+        try:
+            return Decomposer.decomposeWithHandle(pathToVMI, vmiName, mainServices, guest, root, evalDecomp=evalDecomp)
+        finally:
+            GuestFSHelper.shutdownHandle(guest)
+
+    @staticmethod
+    def decomposeWithHandle(pathToVMI, vmiName, mainServices, guest, root, evalDecomp=None):
+        """
+        :rtype: GuestPhaseResult
+        """
         print ('Creating VMI Graph...')
         vmi = VMIDescriptor(pathToVMI, vmiName, mainServices, guest, root, verbose=True)
 
@@ -52,6 +272,84 @@ class Decomposer:
 
         Decomposer.checkMainServicesExistence(vmi)
 
+        result = GuestPhaseResult(pathToVMI, vmiName, mainServices)
+        result.vmiData = GuestPhaseResult.encodeDescriptor(vmi)
+
+        # Export and remove Packages from VMI and its graph
+        # after this, vmiDescriptor "vmi" becomes invalid!
+        # summed sizes of required and exported packages are saved for evaluation
+        manipulator = VMIManipulator.getVMIManipulator(vmi.pathToVMI, vmi.vmiName, guest, root)
+        try:
+            result.vmiModified = True
+            result.exportedPackages = Decomposer.exportPackages(vmi, manipulator, evalDecomp=evalDecomp)
+            newBaseImage = Decomposer.removePackages(vmi, manipulator, guest, root)
+            result.baseImageData = GuestPhaseResult.encodeDescriptor(newBaseImage)
+
+            # Export and remove User Directory
+            print "User Folder Export:"
+            localPathToUserDir = manipulator.exportHomeDir()
+            print "\tUserfolder exported to %s" % localPathToUserDir
+            print "User Folder Removal:"
+            manipulator.removeHomeDir()
+            print "\tUserfolder removed."
+            result.localPathToUserDir = localPathToUserDir
+        except SystemExit as e:
+            # e.g. package manager failed to remove the main services, after the export and possibly a partial removal
+            result.error = str(e)
+            return result
+        result.vmiModified = False
+        return result
+
+    @staticmethod
+    def handleFailedGuestPhase(result):
+        """
+            Prints the error of a guest phase. Packages exported before a later error are added to the repository
+            (their files are already in the local repository), the VMI itself is not added.
+        :param GuestPhaseResult result:
+        """
+        print result.error
+        if result.vmiModified:
+            print "VMI \"%s\" may have been modified before the error occurred (packages exported or removed), " \
+                  "restore it from a copy before decomposing it again." % result.vmiName
+            if len(result.exportedPackages) > 0:
+                with RepositoryDatabase() as repoManager:
+                    Decomposer.addExportedPackages(repoManager, result, result.getVMIDescriptor().distribution)
+                print "%i packages exported from this VMI were added to the repository." % len(result.exportedPackages)
+
+    @staticmethod
+    def addExportedPackages(repoManager, result, distribution):
+        """
+            Packages exported by VMIs decomposed at the same time are only added once
+        :param RepositoryDatabase repoManager:
+        :param GuestPhaseResult result:
+        """
+        existingPackages = repoManager.resolvePackages(
+            [(pkg, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture])
+             for pkg, pkgInfo in result.exportedPackages.iteritems()],
+            distribution
+        )
+        repoManager.addPackageDict(
+            dict((pkg, pkgInfo) for pkg, pkgInfo in result.exportedPackages.iteritems()
+                 if (pkg, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture])
+                 not in existingPackages),
+            distribution
+        )
+        # files of packages added in the meantime were replaced by the download, they are linked to the store again
+        repoManager.storePackageFiles(pkgInfo[StaticInfo.dictKeyFilePath]
+                                      for pkgInfo in result.exportedPackages.itervalues())
+
+    @staticmethod
+    def commitToRepository(result, evalDecomp=None):
+        """
+            Everything that changes the repository, runs for one VMI at a time
+        :param GuestPhaseResult result:
+        """
+        vmi = result.getVMIDescriptor()
+        newBaseImage = result.getBaseImageDescriptor()
+        localPathToUserDir = result.localPathToUserDir
+        if evalDecomp is not None and result.evalDecomp is not None:
+            evalDecomp.copyGuestPhaseAttributes(result.evalDecomp)
+
         # Check Similarity with all mastergraphs in repository (only for evaluation)
         Decomposer.compareWithMasterGraphs(vmi, evalDecomp=evalDecomp)
 
@@ -68,34 +366,22 @@ class Decomposer:
 
         newMainServices = vmi.mainServices
 
-
-        # Export and remove Packages from VMI and its graph
-        # after this, vmiDescriptor "vmi" becomes invalid!
-        # summed sizes of required and exported packages are saved for evaluation
-        manipulator = VMIManipulator.getVMIManipulator(vmi.pathToVMI, vmi.vmiName, guest, root)
-        Decomposer.exportPackages(vmi, manipulator, evalDecomp=evalDecomp)
-        newBaseImage = Decomposer.removePackages(vmi, manipulator, guest, root)
-
-        # Export and remove User Directory
-        print "User Folder Export:"
-        localPathToUserDir = manipulator.exportHomeDir()
-        print "\tUserfolder exported to %s" % localPathToUserDir
-        print "User Folder Removal:"
-        manipulator.removeHomeDir()
-        print "\tUserfolder removed."
-
-        GuestFSHelper.shutdownHandle(guest)
-
         with RepositoryDatabase() as repoManager:
+            # Update Repository Database
+            Decomposer.addExportedPackages(repoManager, result, vmi.distribution)
+
             # Decide which baseImage to keep
             print "Base Image Storage:"
-            numPackagesInNew = len(newBaseImage.graph.nodes())
-            existingBaseImagesWithCompatiblePackages = repoManager.getBaseImagesWithCompatiblePackages(newBaseImage.distribution,
-                                                                                                       newBaseImage.distributionVersion,
-                                                                                                       newBaseImage.architecture,
-                                                                                                       newBaseImage.pkgManager)
-            (chosenBaseImage,replacingList) = Decomposer.chooseBaseImage(newBaseImage,MSPkgDict,
-                                                                         existingBaseImagesWithCompatiblePackages)
+            (compatibilities, installSizes) = repoManager.getBaseImageCompatibilities(newBaseImage, MSPkgDict)
+            (chosenBaseID, replacingIDs) = Decomposer.chooseBaseImage(RepositoryDatabase.newBaseImageKey,
+                                                                      compatibilities, installSizes)
+            # only the chosen and the replaced base images are loaded
+            baseImages = dict((baseID, repoManager.getBaseImageFromID(baseID))
+                              for baseID in [chosenBaseID] + replacingIDs
+                              if baseID != RepositoryDatabase.newBaseImageKey)
+            baseImages[RepositoryDatabase.newBaseImageKey] = newBaseImage
+            chosenBaseImage = baseImages[chosenBaseID]
+            replacingList = [baseImages[baseID] for baseID in replacingIDs]
 
             chosenBaseImageOrigFileName = chosenBaseImage.pathToVMI.split("/")[-1]
 
@@ -151,6 +437,7 @@ class Decomposer:
                     masterDescriptor.addSubGraph(repoManager.getMainServicesForBaseImage(oldBaseImageID),
                                                  repoManager.getVMIMasterDescriptorFromBaseID(oldBaseImageID).getSubGraphForMainServices())
             masterDescriptor.saveGraph()
+            repoManager.setMasterSignature(chosenBaseImageID, masterDescriptor.getMainServicesSignature())
 
             # Replace base images in database (also removes old images and graphs from filesystem)
             repoManager.replaceAndRemoveBaseImages(chosenBaseImage, replacingList)
@@ -168,38 +455,104 @@ class Decomposer:
                 else:
                     baseImageTreatmentString = "New base image added as \"%s\"" % chosenBaseImage.pathToVMI.split("/")[-1]
                 evalDecomp.baseImageInfo = baseImageTreatmentString
-                evalDecomp.timeHandlerCreation = handlerCreationTime
 
-    #TODO: rename (only export main services + deps)
     @staticmethod
-    def exportPackages(vmi, manipulator, evalDecomp=None):
+    def planMany(vmiData):
+        """
+            Plans of up to StaticInfo.decompositionMaxConcurrentVMIs VMIs are created concurrently in worker processes.
+            Every VMI is planned against the current repository, VMIs decomposed earlier in the same batch are not
+            taken into account. The plans only read the repository database, packages of base images stored before
+            BaseImagePackages existed are added once beforehand.
+        :param vmiData: in the form of [(pathToVMI, vmiName, [MS1,MS2])]
+        :return: generator of DecompositionPlans in the order of vmiData
         """
+        with RepositoryDatabase() as repoManager:
+            repoManager.updateAllMissingBaseImagePackages()
+        numProcesses = max(1, min(StaticInfo.decompositionMaxConcurrentVMIs, len(vmiData)))
+        if numProcesses == 1:
+            for (pathToVMI, vmiName, mainServices) in vmiData:
+                yield Decomposer.tryPlan(pathToVMI, vmiName, mainServices)
+            return
+        pool = multiprocessing.Pool(processes=numProcesses, initializer=GuestFSHelper.initializeWorkerProcess)
+        try:
+            for plan in pool.imap(planDecompositionInWorker, vmiData):
+                yield plan
+        finally:
+            pool.close()
+            pool.join()
 
-        :return: returns BaseImage instance
+    @staticmethod
+    def tryPlan(pathToVMI, vmiName, mainServices):
         """
-        # Collect packages that should be exported (main services and their dependencies)
-        # in the form of {pkg,{name:"pkg", version:"1.1", architecture:"amd64", essential:False}}
-        #packageDict = self.graph.getNodeDataFromSubTrees(self.mainServices)
-        packageDict = vmi.getNodeDataFromSubTrees(vmi.mainServices)
-        numAllPackages = len(packageDict)
+        :rtype: DecompositionPlan
+        """
+        try:
+            return Decomposer.plan(pathToVMI, vmiName, mainServices)
+        except SystemExit as e:
+            plan = DecompositionPlan(pathToVMI, vmiName, mainServices)
+            plan.error = str(e)
+            return plan
 
-        # Save install sizes of required/exported Packages
-        sumSizesReqPkgs = 0
-        sumSizesExpPkgs = 0
+    @staticmethod
+    def plan(pathToVMI, vmiName, mainServices):
+        """
+            Dry run of decompose: the VMI is attached read-only (writes go to a temporary overlay), the removal is only
+            simulated by the package manager and the base image is chosen as in commitToRepository,
+            neither the VMI nor the repository are changed (see planMany for base images without BaseImagePackages)
+        :rtype: DecompositionPlan
+        """
+        print "\n=== Plan Decomposition of VMI \"%s\"\nPath: \"%s\"" % (vmiName, pathToVMI)
+        Decomposer.checkDecomposable(pathToVMI, vmiName)
+
+        (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True, readonly=True)
+        try:
+            vmi = VMIDescriptor(pathToVMI, vmiName, mainServices, guest, root)
+            Decomposer.checkMainServicesExistence(vmi)
+            inspectionData = GuestFSHelper.getInspectionData(guest, root)
+            manipulator = VMIManipulator.getVMIManipulator(vmi.pathToVMI, vmi.vmiName, guest, root)
+            removedPackages = manipulator.simulateRemovePackages(vmi.mainServices)
+            userFolderSize = 0
+            if guest.is_dir(manipulator.vmi_UserFolder):
+                # in kbytes
+                userFolderSize = guest.du(manipulator.vmi_UserFolder) * 1024
+        finally:
+            GuestFSHelper.shutdownHandle(guest)
+
+        plan = DecompositionPlan(pathToVMI, vmiName, mainServices)
+        plan.vmiSize = os.path.getsize(pathToVMI)
+        plan.userFolderSize = userFolderSize
+        (packageDict, plan.numRequiredPackages, _, plan.exportedPackagesSize) = Decomposer.getPackagesToExport(vmi)
+        plan.exportedPackages = sorted(packageDict.keys())
+        plan.removedPackages = sorted(pkg for pkg in removedPackages if pkg in vmi.graph)
+
+        # new base image is the VMI without the removed packages
+        newBaseImage = BaseImageDescriptor(pathToVMI)
+        newBaseImage.initializeFromInspectionData(inspectionData, vmi.graph.subgraph(
+            [pkg for pkg in vmi.graph if pkg not in removedPackages]))
 
-        # Remove packages that already exist in host repository
-        tmp = dict(packageDict)
         with RepositoryDatabase() as repoManager:
-            for pkg, pkgInfo in tmp.iteritems():
-                if repoManager.packageExists(pkg,
-                                             pkgInfo[StaticInfo.dictKeyVersion],
-                                             pkgInfo[StaticInfo.dictKeyArchitecture],
-                                             vmi.distribution):
-                    del packageDict[pkg]
-                    sumSizesReqPkgs = sumSizesReqPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
-                else:
-                    sumSizesReqPkgs = sumSizesReqPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
-                    sumSizesExpPkgs = sumSizesExpPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
+            (compatibilities, installSizes) = repoManager.getBaseImageCompatibilities(
+                newBaseImage, vmi.getNodeDataFromMainServicesSubtrees(), updateMissing=False)
+            (chosenBaseID, replacingIDs) = Decomposer.chooseBaseImage(RepositoryDatabase.newBaseImageKey,
+                                                                      compatibilities, installSizes)
+            if chosenBaseID != RepositoryDatabase.newBaseImageKey:
+                plan.chosenBaseImage = repoManager.getBaseImageFromID(chosenBaseID).pathToVMI
+            for baseID in replacingIDs:
+                if baseID != RepositoryDatabase.newBaseImageKey:
+                    pathToBaseImage = repoManager.getBaseImageFromID(baseID).pathToVMI
+                    plan.replacedBaseImages.append(pathToBaseImage)
+                    if os.path.isfile(pathToBaseImage):
+                        plan.replacedBaseImagesSize = plan.replacedBaseImagesSize + os.path.getsize(pathToBaseImage)
+        return plan
+
+    #TODO: rename (only export main services + deps)
+    @staticmethod
+    def exportPackages(vmi, manipulator, evalDecomp=None):
+        """
+            Packages are added to the repository database in the commit phase (see commitToRepository)
+        :return: exported packages in the form of {pkg,{name:"pkg", version:"1.1", ..., path:"localRepo/pkg.deb"}}
+        """
+        (packageDict, numAllPackages, sumSizesReqPkgs, sumSizesExpPkgs) = Decomposer.getPackagesToExport(vmi)
 
         numReqPackages = len(packageDict)
 
@@ -212,20 +565,52 @@ class Decomposer:
               % (",".join(vmi.mainServices),numAllPackages, numAllPackages - numReqPackages, numReqPackages)
 
         exportTime = 0.0
+        packageInfoDict = dict()
         if numReqPackages > 0:
             startTime = time.time()
             packageInfoDict = manipulator.exportPackages(packageDict)
             exportTime = time.time() - startTime
-
-            # Update Repository Database
-            with RepositoryDatabase() as repoManager:
-                repoManager.addPackageDict(packageInfoDict, vmi.distribution)
         if evalDecomp is not None:
             evalDecomp.reqPkgsNum = numAllPackages
             evalDecomp.expPkgsNum = numReqPackages
             evalDecomp.reqPkgsSize = sumSizesReqPkgs
             evalDecomp.expPkgsSize = sumSizesExpPkgs
             evalDecomp.timeExport = exportTime
+        return packageInfoDict
+
+    @staticmethod
+    def getPackagesToExport(vmi):
+        """
+            Main services and their dependencies that do not exist in the repository yet
+        :return: tuple in the form of (packageDict, number of required packages,
+                                       install size of required packages, install size of packages to export)
+        """
+        # Collect packages that should be exported (main services and their dependencies)
+        # in the form of {pkg,{name:"pkg", version:"1.1", architecture:"amd64", essential:False}}
+        #packageDict = self.graph.getNodeDataFromSubTrees(self.mainServices)
+        packageDict = vmi.getNodeDataFromSubTrees(vmi.mainServices)
+        numAllPackages = len(packageDict)
+
+        # Save install sizes of required/exported Packages
+        sumSizesReqPkgs = 0
+        sumSizesExpPkgs = 0
+
+        # Remove packages that already exist in host repository
+        tmp = dict(packageDict)
+        with RepositoryDatabase() as repoManager:
+            existingPackages = repoManager.resolvePackages(
+                [(pkg, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture])
+                 for pkg, pkgInfo in tmp.iteritems()],
+                vmi.distribution
+            )
+            for pkg, pkgInfo in tmp.iteritems():
+                if (pkg, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture]) in existingPackages:
+                    del packageDict[pkg]
+                    sumSizesReqPkgs = sumSizesReqPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
+                else:
+                    sumSizesReqPkgs = sumSizesReqPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
+                    sumSizesExpPkgs = sumSizesExpPkgs + int(pkgInfo[StaticInfo.dictKeyInstallSize])
+        return (packageDict, numAllPackages, sumSizesReqPkgs, sumSizesExpPkgs)
 
     @staticmethod
     def removePackages(vmi, manipulator, guest, root):
@@ -266,109 +651,77 @@ class Decomposer:
 
 
     @staticmethod
-    def chooseBaseImage(newBaseImage, newMSPackages, existingBaseImagesAndMSPackages):
+    def chooseBaseImage(newBaseImage, compatibilities, installSizes):
         """
-        :param BaseImageDescriptor  newBaseImage:
-
-        :param dict()               newMSPackages:
-                                    in the form:    dict(MS1:MS1Info,dep1:dep1Info...)
-                                    xInfo:          dict(name:"curl",version:"1.1",...)
-
-        :param dict(dict(dict()))   existingBaseImagesAndMSPackages:
-                                    in the form:    dict(base1: MSPackages, base2:...)
-                                    MSPackages:     dict(MS1:MS1Info,dep1:dep1Info...)
-                                    xInfo:          dict(name:"curl",version:"1.1",...)
+        :param newBaseImage:        key of the new base image
+        :param dict compatibilities:
+                                    in the form:    dict(B1: set(B2,B3...))
+                                    B1 can replace B2,B3,... (main services of B2,B3,... are compatible in B1),
+                                    every base image is compatible with itself
+        :param dict installSizes:
+                                    in the form:    dict(B1: sum of install sizes of all packages in B1)
         :return:
                 in the form: (B1, list(B2,B3...))
-                             B1 is the chosen BaseImage compatible to newMSPackages
+                             B1 is the chosen BaseImage compatible to the main services of the new one
                              B2,B3,... is list of BaseImages that B1 replaces
+                (see RepositoryDatabase.getBaseImageCompatibilities)
         """
-        if existingBaseImagesAndMSPackages == None or len(existingBaseImagesAndMSPackages) == 0:
+        if len(compatibilities) <= 1:
             return (newBaseImage,list())
 
-        compatibilities = defaultdict(dict)
-        # in form       B1      B2      B3      count   new
-        #           B1  True    False   False   1       1
-        #           B2  False   True    True    2       0
-        #           B3  True    False   True    2       0
-        #
-        #           compatibilities[B3][B1] = True  -> means main services of B1 are compatible in B3
-        #                                           -> B3 can replace B1
-        allBaseImagesAndMSPkgs = dict(existingBaseImagesAndMSPackages)
-        allBaseImagesAndMSPkgs[newBaseImage] = newMSPackages
-        # by row
-        for b1 in allBaseImagesAndMSPkgs.keys():
-            if b1 == newBaseImage:
-                compatibilities[b1]["new"] = 1
-            else:
-                compatibilities[b1]["new"] = 0
-
-            compatibilities[b1]["count"] = 0
-            rowString = ""
-            # by column
-            for b2 in allBaseImagesAndMSPkgs.keys():
-                # if same or compatible
-                if b1 == b2 or b1.checkCompatibilityForPackages(allBaseImagesAndMSPkgs[b2]):
-                    compatibilities[b1][b2] = True
-                    compatibilities[b1]["count"] = compatibilities[b1]["count"] + 1
-                else:
-                    compatibilities[b1][b2] = False
-                rowString = rowString + b2.pathToVMI + ":" + str(compatibilities[b1][b2]) + ", "
-            rowString = rowString + "\t" + b1.pathToVMI
-            #print rowString
-
-        # sort base images by count (number of base images it is compatible for)
+        # sort base images by count (number of base images it is compatible for), install size,
+        # existing before new
         sortedBaseImages = sorted(compatibilities.keys(),
                                   key=lambda baseImage: (
-                                      -compatibilities[baseImage]["count"],
-                                      int(baseImage.getPkgsInstallSize()),
-                                      compatibilities[baseImage]["new"]
+                                      -len(compatibilities[baseImage]),
+                                      installSizes[baseImage],
+                                      int(baseImage == newBaseImage),
+                                      baseImage
                                   ))
-        #print "Sorted base images by 1. incr. comp count, 2. decr. #(pkgs)"
-        #for baseImage in sortedBaseImages:
-        #    print baseImage.pathToVMI + "\t" + str(baseImage.getNumberOfPackages())
 
-        while len(sortedBaseImages) != 0:
-            candidateBaseImage = sortedBaseImages.pop(0)
+        for candidateBaseImage in sortedBaseImages:
             # chosen base image is the new one or the chosen one is compatible with the MSpackages from the new one
-            if candidateBaseImage == newBaseImage or compatibilities[candidateBaseImage][newBaseImage] == True:
-                replacingList = list()
-                for baseImageToReplace in allBaseImagesAndMSPkgs.keys():
-                    if candidateBaseImage != baseImageToReplace and compatibilities[candidateBaseImage][baseImageToReplace] == True:
-                        replacingList.append(baseImageToReplace)
+            if candidateBaseImage == newBaseImage or newBaseImage in compatibilities[candidateBaseImage]:
+                replacingList = sorted(compatibilities[candidateBaseImage] - set([candidateBaseImage]))
                 return (candidateBaseImage,replacingList)
 
-        # Worst case, no replacing possible, should be handled in while above
+        # Worst case, no replacing possible, should be handled in loop above
         return (newBaseImage,list())
 
+    @staticmethod
+    def getSimilaritiesToMasterGraphs(vmi):
+        """
+            Only the StaticInfo.masterSimilarityCandidates masters most similar by MinHash are compared exactly
+        :return: list in the form of [(similarity, master)]
+        """
+        with RepositoryDatabase() as repoManager:
+            candidates = repoManager.getMasterCandidates(vmi.getMainServicesSignature(),
+                                                         StaticInfo.masterSimilarityCandidates)
+            masterDescriptors = [repoManager.getVMIMasterDescriptorFromBaseID(baseID) for baseID in candidates]
+        if len(masterDescriptors) == 0:
+            return list()
+        # weighted similarity on main services, computed for all masters at once
+        similarities = SimilarityMatrix([vmi] + masterDescriptors, onlyOnMainServices=True)\
+            .getSimilarities(0, range(1, len(masterDescriptors) + 1))
+        return [(float(similarity), master) for (similarity, master) in zip(similarities, masterDescriptors)]
+
     @staticmethod
     def compareWithMasterGraphs(vmi, evalDecomp=None):
         print "Comparison to mastergraphs:"
         if evalDecomp is not None:
             startTime = time.time()
-            simAndMasterList = list()
-            with RepositoryDatabase() as repoManager:
-                masterDescriptors = repoManager.getVMIMasterDescriptors()
-                for master in masterDescriptors:
-                    similarity = SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors(vmi, master,
-                                                                                                     onlyOnMainServices=True,
-                                                                                                     verbose=False)
-                    print "\tMastergraph:\t" + master.graphFileName
-                    print "\tSimilarity:\t\t%0.2f\n" % similarity
-                    simAndMasterList.append((similarity,master))
+            simAndMasterList = Decomposer.getSimilaritiesToMasterGraphs(vmi)
+            for (similarity, master) in simAndMasterList:
+                print "\tMastergraph:\t" + master.graphFileName
+                print "\tSimilarity:\t\t%0.2f\n" % similarity
             timeToCalc = time.time() - startTime
             evalDecomp.timeSimToMasterCalc = timeToCalc
             evalDecomp.setSimilarity(simAndMasterList)
 
         else:
-            with RepositoryDatabase() as repoManager:
-                masterDescriptors = repoManager.getVMIMasterDescriptors()
-                for master in masterDescriptors:
-                    similarity = SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors(vmi, master,
-                                                                                                     onlyOnMainServices=True,
-                                                                                                     verbose=False)
-                    print "\tMastergraph:\t" + master.graphFileName
-                    print "\tSimilarity:\t\t%0.2f\n" % similarity
+            for (similarity, master) in Decomposer.getSimilaritiesToMasterGraphs(vmi):
+                print "\tMastergraph:\t" + master.graphFileName
+                print "\tSimilarity:\t\t%0.2f\n" % similarity
 
     # deprecated, right now not required
     @staticmethod
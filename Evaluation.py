@@ -87,6 +87,18 @@ class DecompositionEvaluation(Evaluation):
         self.masterNumPkgs = None
         self.timeSimToMasterCalc = None
 
+    def copyGuestPhaseAttributes(self, other):
+        """
+            Takes over what the guest phase of a decomposition in a worker process recorded (see Decomposer.decomposeMany)
+        :param DecompositionEvaluation other:
+        """
+        self.timeHandlerCreation = other.timeHandlerCreation
+        self.timeExport = other.timeExport
+        self.reqPkgsNum = other.reqPkgsNum
+        self.expPkgsNum = other.expPkgsNum
+        self.reqPkgsSize = other.reqPkgsSize
+        self.expPkgsSize = other.expPkgsSize
+
     def addVmiOrigSize(self, vmiOrigSize):
         self.sumOrigStorageSize = self.sumOrigStorageSize + vmiOrigSize
 
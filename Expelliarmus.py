@@ -6,7 +6,7 @@ import shutil
 from threading import Thread
 
 from Decomposer import Decomposer
-from GuestFSHelper import GuestFSHelper
+from GuestFSHelper import GuestFSHelper, GuestFSBatchSession
 from VMISimilarity import SimilarityCalculator
 from Reassembler import Reassembler
 from RepositoryDatabase import RepositoryDatabase
@@ -85,6 +85,51 @@ class Expelliarmus:
             print "---------------------------------------------"
             print "Overall base images in repository: " + str(len(baseDataList)) + "\n"
 
+    def printVMIsWithPackage(self, pkgName):
+        with RepositoryDatabase() as repoManager:
+            result = repoManager.getVmisWithPackagesLike(pkgName)
+        if len(result) == 0:
+            print "\nNo packages similar to \"%s\" found in repository.\n" % pkgName
+            return
+        print "\nPackages similar to \"%s\":\n" % pkgName
+        print "{:30s} {:s}".format("Name", "VMIs")
+        print "---------------------------------------------------------------------------"
+        for (similarName, vmiNames) in result:
+            name = (similarName[:27] + '..') if len(similarName) > 29 else similarName
+            print "{:30s} {:s}".format(name, ", ".join(vmiNames))
+        print "---------------------------------------------------------------------------\n"
+
+    def printNearest(self, pathToVMI, k, scope):
+        mainServices = []
+        pathToMeta = pathToVMI.rsplit(".", 1)[0] + ".meta"
+        if os.path.isfile(pathToMeta):
+            mainServices = open(pathToMeta).read().split("\n")[0].split(";")[2].split(",")
+        elif scope == "masters":
+            print "Error: masters are compared on main services, meta file \"%s\" does not exist." % pathToMeta
+            return
+
+        print "\tCreating Handler for \"%s\"" % pathToVMI
+        (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True, readonly=True)
+        vmi = VMIDescriptor(pathToVMI, pathToVMI.split("/")[-1], mainServices, guest, root)
+        GuestFSHelper.shutdownHandle(guest)
+        for pkgName in mainServices:
+            if not vmi.checkIfNodeExists(pkgName):
+                print "Error: Main Service \"%s\" does not exist in %s" % (pkgName, pathToVMI)
+                return
+
+        nearest = SimilarityCalculator.nearest(vmi, k, scope)
+        if len(nearest) < k:
+            print "\nOnly %i %s stored, most similar first (estimated similarity):\n" % (len(nearest), scope)
+        else:
+            print "\n%i most similar %s (estimated similarity):\n" % (len(nearest), scope)
+        print "{:50s} {:s}".format("Name", "Similarity")
+        print "---------------------------------------------------------------"
+        for (name, similarity) in nearest:
+            name = name.split("/")[-1]
+            name = (name[:47] + '..') if len(name) > 49 else name
+            print "{:50s} {:0.2f}".format(name, similarity)
+        print "---------------------------------------------------------------\n"
+
     def inspectVMIsInFolder(self, pathToDir):
         if not os.path.isdir(pathToDir):
             print "Error while inspecting VMIs. \"%s\" is not a directory." % pathToDir
@@ -122,14 +167,17 @@ class Expelliarmus:
 
         if len(vmiPathsToInspect) > 0:
             count = 1
-            for pathToVMI in vmiPathsToInspect:
-                print "VMI %i/%i" % (count,len(vmiPathsToInspect))
-                self.inspectVMI(pathToVMI,replaceMetaFiles=replaceMetaFiles)
-                count = count +1
+            # groups of VMIs share one appliance
+            for vmiPathsChunk in GuestFSBatchSession.chunks(vmiPathsToInspect):
+                with GuestFSBatchSession(vmiPathsChunk) as session:
+                    for pathToVMI in vmiPathsChunk:
+                        print "VMI %i/%i" % (count,len(vmiPathsToInspect))
+                        self.inspectVMI(pathToVMI,replaceMetaFiles=replaceMetaFiles, session=session)
+                        count = count +1
         else:
             print "No VMIs to inspect."
 
-    def inspectVMI(self, pathToVMI, replaceMetaFiles=None):
+    def inspectVMI(self, pathToVMI, replaceMetaFiles=None, session=None):
         extension = pathToVMI.split(".")[-1]
         pathToMeta = pathToVMI.rsplit(".", 1)[0] + ".meta"
 
@@ -153,21 +201,30 @@ class Expelliarmus:
                     print "\tInput not recognized, Meta file will not be replaced."
                 else:
                     print "\tExisting meta file will be replaced"
-                    self.createMetaFileForVMI(pathToVMI, pathToMeta)
+                    self.createMetaFileForVMI(pathToVMI, pathToMeta, session=session)
             elif replaceMetaFiles == True:
                 print "\tExisting meta file will be replaced"
-                self.createMetaFileForVMI(pathToVMI, pathToMeta)
+                self.createMetaFileForVMI(pathToVMI, pathToMeta, session=session)
             else:
                 print "\tMeta file already exists for VMI."
         else:
-            self.createMetaFileForVMI(pathToVMI,pathToMeta)
+            self.createMetaFileForVMI(pathToVMI,pathToMeta, session=session)
 
-    def createMetaFileForVMI(self, pathToVMI, pathToMetafile):
-        print "\tCreating Handler for \"%s\"" % pathToVMI
-        guest, root = GuestFSHelper.getHandle(pathToVMI, rootRequired=True)
-        print "\tCreating VMIDescriptor"
-        vmi = VMIDescriptor(pathToVMI, "test", [], guest, root)
-        GuestFSHelper.shutdownHandle(guest)
+    def createMetaFileForVMI(self, pathToVMI, pathToMetafile, session=None):
+        """
+        :param GuestFSBatchSession session: shared appliance the VMI is attached to, if any
+        """
+        if session is not None and session.contains(pathToVMI):
+            guest, root = session.openVMI(pathToVMI)
+            print "\tCreating VMIDescriptor"
+            vmi = VMIDescriptor(pathToVMI, "test", [], guest, root)
+            session.closeVMI()
+        else:
+            print "\tCreating Handler for \"%s\"" % pathToVMI
+            guest, root = GuestFSHelper.getHandle(pathToVMI, rootRequired=True, readonly=True)
+            print "\tCreating VMIDescriptor"
+            vmi = VMIDescriptor(pathToVMI, "test", [], guest, root)
+            GuestFSHelper.shutdownHandle(guest)
         correctMS = False
         while not correctMS:
             userInputMS = raw_input("\tEnter Main Services in format \"MS1,MS2,...\"\n\t")
@@ -180,7 +237,7 @@ class Expelliarmus:
                 if not vmi.checkIfNodeExists(pkgName):
                     error = True
                     print "\t\tMain Service \"" + pkgName + "\" does not exist"
-                    similar = vmi.getListOfNodesContaining(pkgName)
+                    similar = vmi.getSimilarNodes(pkgName)
                     if len(similar) > 0:
                         print "\t\tDid you mean one of the following?\n\t\t" + ",".join(similar)
                     else:
@@ -234,40 +291,96 @@ class Expelliarmus:
         else:
             vmiPathsToDecompose = vmiPaths
 
-        if len(vmiPathsToDecompose) > 0:
+        vmiData = []
+        for pathToVMI in vmiPathsToDecompose:
+            decompositionData = self.getDecompositionData(pathToVMI)
+            if decompositionData is not None:
+                vmiData.append(decompositionData)
+        if len(vmiData) > 0:
+            # guest phases of several VMIs run concurrently, repository is updated in the order of vmiData
             count = 1
-            for pathToVMI in vmiPathsToDecompose:
-                print "VMI %i/%i" % (count,len(vmiPathsToDecompose))
-                self.decomposeVMI(pathToVMI)
-                count = count +1
+            for (pathToVMI, vmiFileName, mainServices, _) in Decomposer.decomposeMany(vmiData):
+                print "VMI %i/%i decomposed: %s" % (count, len(vmiData), vmiFileName)
+                os.remove(pathToVMI.rsplit(".", 1)[0] + ".meta")
+                count = count + 1
         else:
             pass
 
     def decomposeVMI(self, pathToVMI):
+        decompositionData = self.getDecompositionData(pathToVMI)
+        if decompositionData is None:
+            return
+        (pathToVMI, vmiFileName, mainServices) = decompositionData
+        pathToMeta = pathToVMI.rsplit(".", 1)[0] + ".meta"
+
+        # decompose and clean up
+        Decomposer.decompose(pathToVMI, vmiFileName, mainServices)
+        os.remove(pathToMeta)
+
+    def planDecomposition(self, path):
+        """
+            Reports the outcome of decomposing the VMI at path or all VMIs in the folder at path (see Decomposer.plan)
+            without changing VMIs or the repository. VMIs without .meta files are skipped.
+        """
+        if os.path.isdir(path):
+            vmiPaths = [pathToVMI for pathToVMI in self.getVmiPaths(path)
+                        if os.path.isfile(pathToVMI.rsplit(".", 1)[0] + ".meta")]
+            print "Planning decomposition of VMIs in folder %s" % path
+            print "\tVMIs with meta files: %i" % len(vmiPaths)
+        else:
+            vmiPaths = [path]
+        vmiData = []
+        for pathToVMI in vmiPaths:
+            decompositionData = self.getDecompositionData(pathToVMI)
+            if decompositionData is not None:
+                vmiData.append(decompositionData)
+        if len(vmiData) == 0:
+            return
+
+        plans = []
+        for plan in Decomposer.planMany(vmiData):
+            plan.printPlan()
+            plans.append(plan)
+
+        if len(plans) > 1:
+            print "\nSummary (every VMI planned against the current repository):"
+            print "\t{:30s} {:>8s} {:>8s} {:>16s}  {:s}".format("VMI", "export", "remove", "saved (bytes)", "base image")
+            for plan in sorted(plans, key=lambda plan: plan.getSavedSize() if plan.error is None else None,
+                               reverse=True):
+                if plan.error is not None:
+                    print "\t{:30s} {:s}".format(plan.vmiName, "cannot be decomposed")
+                    continue
+                print "\t{:30s} {:8d} {:8d} {:16d}  {:s}".format(
+                    plan.vmiName, len(plan.exportedPackages), len(plan.removedPackages), plan.getSavedSize(),
+                    "new" if plan.chosenBaseImage is None else plan.chosenBaseImage.split("/")[-1])
+            print "\tProjected savings in total: %i bytes" % sum(plan.getSavedSize() for plan in plans
+                                                                  if plan.error is None)
+
+    def getDecompositionData(self, pathToVMI):
+        """
+        :return: (pathToVMI, vmiFileName, mainServices), None if the VMI cannot be decomposed
+        """
         vmiFileName = pathToVMI.split("/")[-1]
         extension = pathToVMI.split(".")[-1]
         pathToMeta = pathToVMI.rsplit(".", 1)[0] + ".meta"
         # check if VMI exists
         if not os.path.isfile(pathToVMI):
             print "\tError while decomposing VMI. File \"%s\" does not exist." % pathToVMI
-            return
+            return None
         # check if valid format
         if not extension in StaticInfo.validVMIFormats:
             print "\tError while decomposing VMI. File extension \"%s\" is not supported." % extension
             print "\tSupported extensions: " + ",".join(StaticInfo.validVMIFormats)
-            return
+            return None
         # check if meta file exists
         if not os.path.isfile(pathToMeta):
             print "\tError while decomposing VMI. Meta File \"%s\" does not exist." % pathToMeta
-            return
+            return None
 
         # obtain main services from meta data file
         vmiMetaData = open(pathToMeta).read().split("\n")[0].split(";")
         mainServices = vmiMetaData[2].split(",")
-
-        # decompose and clean up
-        Decomposer.decompose(pathToVMI, vmiFileName, mainServices)
-        os.remove(pathToMeta)
+        return (pathToVMI, vmiFileName, mainServices)
 
     def reassembleAllVMIs(self):
         vmisInFolder = self.getVmiPaths(StaticInfo.relPathLocalVMIFolder)
@@ -370,6 +483,10 @@ class Expelliarmus:
             evalDecomp.vmiMainServices = mainServices
             evalDecomp.addVmiOrigSize(os.path.getsize(pathToVMI))
 
+            # boot appliance for next VMI while this one is decomposed
+            if i < len(sortedVmiData):
+                GuestFSHelper.prelaunchHandle(sortedVmiData[i][0])
+
             startTime = time.time()
             Decomposer.decompose(pathToVMI, vmiFileName, mainServices, evalDecomp=evalDecomp)
             decompTime = time.time() - startTime
@@ -518,11 +635,18 @@ class Expelliarmus:
         return sortedVmiData
 
     def getDirSize(self, start_path):
+        """
+            Files linked more than once (e.g. package files of the package store) are only counted once
+        """
         total_size = 0
+        inodes = set()
         for dirpath, dirnames, filenames in os.walk(start_path):
             for f in filenames:
                 fp = os.path.join(dirpath, f)
-                total_size += os.path.getsize(fp)
+                stat = os.stat(fp)
+                if (stat.st_dev, stat.st_ino) not in inodes:
+                    inodes.add((stat.st_dev, stat.st_ino))
+                    total_size += stat.st_size
         return total_size
 
 
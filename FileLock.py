@@ -0,0 +1,39 @@
+import fcntl
+import threading
+
+
+class FileLock:
+    """
+        Lock shared by the threads of this process and by other processes (e.g. the worker processes creating
+        VMI descriptors), the latter through flock on a lock file. The directory of the lock file has to exist.
+
+        Usage:
+            with FileLock(path):
+                ...
+    """
+    def __init__(self, path):
+        self.path = path
+        self.threadLock = threading.Lock()
+        self.lockFile = None
+
+    def __enter__(self):
+        self.threadLock.acquire()
+        try:
+            # opened on every acquisition, worker processes do not share the lock through an inherited file
+            self.lockFile = open(self.path, "a")
+            fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_EX)
+        except:
+            if self.lockFile is not None:
+                self.lockFile.close()
+                self.lockFile = None
+            self.threadLock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_UN)
+            self.lockFile.close()
+        finally:
+            self.lockFile = None
+            self.threadLock.release()
@@ -1,38 +1,472 @@
+import atexit
+import hashlib
+import json
+import os
+import tarfile
+import threading
 import guestfs
 
+from FileLock import FileLock
+from StaticInfo import StaticInfo
+
+
+class GuestFSHandlePool:
+    """
+        Keeps launched libguestfs appliances warm between VMIs.
+        Released appliances get their drive unplugged and are reused by hot-plugging the next drive.
+        If the backend does not support hot-plugging, released appliances are shut down as before.
+        Appliances for VMIs that will be processed next can be launched in the background (prelaunch).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idleHandles = []           # launched appliances without any drive attached
+        self.prelaunched = []           # in the form of [((pathToVMI, readonly), thread, result)]
+        self.driveLabels = dict()       # in the form of {guest: label of attached drive}
+        self.hotplugSupported = None    # unknown until the first hot-plug is tried
+        self.labelCounter = 0
+
+    def newLabel(self):
+        with self.lock:
+            self.labelCounter = self.labelCounter + 1
+            return "vmi%i" % self.labelCounter
+
+    def launchHandle(self, pathToVMI, readonly):
+        label = self.newLabel()
+        guest = guestfs.GuestFS(python_return_dict=True)
+        guest.add_drive_opts(pathToVMI, readonly=readonly, label=label)
+        guest.launch()
+        with self.lock:
+            self.driveLabels[guest] = label
+        return guest
+
+    def prelaunch(self, pathToVMI, readonly=False):
+        """
+            Starts launching an appliance for pathToVMI in the background.
+            The handle is picked up by the next acquire() for the same VMI.
+        """
+        key = (pathToVMI, readonly)
+        with self.lock:
+            for (prelaunchedKey, _thread, _result) in self.prelaunched:
+                if prelaunchedKey == key:
+                    return
+        result = dict()
+
+        def run():
+            try:
+                result["guest"] = self.launchHandle(pathToVMI, readonly)
+            except RuntimeError as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        with self.lock:
+            self.prelaunched.append((key, thread, result))
+            staleEntries = self.prelaunched[:-StaticInfo.guestfsMaxPrelaunchedHandles]
+            self.prelaunched = self.prelaunched[-StaticInfo.guestfsMaxPrelaunchedHandles:]
+        for (_key, staleThread, staleResult) in staleEntries:
+            staleThread.join()
+            if "guest" in staleResult:
+                self.closeHandle(staleResult["guest"])
+
+    def acquire(self, pathToVMI, readonly=False):
+        """
+            Returns a launched handle with the drive pathToVMI attached.
+            Order of preference: prelaunched appliance, warm appliance with hot-plugged drive, fresh appliance.
+        """
+        key = (pathToVMI, readonly)
+        entry = None
+        with self.lock:
+            for prelaunchedEntry in self.prelaunched:
+                if prelaunchedEntry[0] == key:
+                    entry = prelaunchedEntry
+                    self.prelaunched.remove(prelaunchedEntry)
+                    break
+        if entry is not None:
+            (_key, thread, result) = entry
+            thread.join()
+            if "guest" in result:
+                return result["guest"]
+            print "Prelaunching appliance for \"%s\" failed (%s), launching again." % (pathToVMI, result["error"])
+
+        guest = self.hotplug(pathToVMI, readonly)
+        if guest is not None:
+            return guest
+        return self.launchHandle(pathToVMI, readonly)
+
+    def hotplug(self, pathToVMI, readonly):
+        with self.lock:
+            if self.hotplugSupported is False or len(self.idleHandles) == 0:
+                return None
+            guest = self.idleHandles.pop()
+        label = self.newLabel()
+        try:
+            guest.add_drive_opts(pathToVMI, readonly=readonly, label=label)
+        except RuntimeError:
+            # backend does not support hot-plugging, stop trying
+            self.hotplugSupported = False
+            self.closeHandle(guest)
+            self.closeIdleHandles()
+            return None
+        self.hotplugSupported = True
+        with self.lock:
+            self.driveLabels[guest] = label
+        return guest
+
+    def release(self, guest):
+        """
+            Unplugs the drive of guest and keeps the appliance for the next VMI.
+            Falls back to shutting the appliance down.
+        """
+        with self.lock:
+            label = self.driveLabels.pop(guest, None)
+            keep = self.hotplugSupported is not False \
+                   and label is not None \
+                   and len(self.idleHandles) < StaticInfo.guestfsMaxIdleHandles
+        if keep:
+            try:
+                # make sure everything is written to the image before it is detached
+                guest.sync()
+                guest.remove_drive(label)
+                with self.lock:
+                    self.idleHandles.append(guest)
+                return
+            except RuntimeError:
+                self.hotplugSupported = False
+        self.closeHandle(guest)
+
+    def closeHandle(self, guest):
+        with self.lock:
+            self.driveLabels.pop(guest, None)
+        try:
+            guest.shutdown()
+        except RuntimeError as msg:
+            print "%s (ignored)" % msg
+        guest.close()
+
+    def closeIdleHandles(self):
+        with self.lock:
+            idleHandles = self.idleHandles
+            self.idleHandles = []
+        for guest in idleHandles:
+            self.closeHandle(guest)
+
+    def closeAll(self):
+        with self.lock:
+            prelaunched = self.prelaunched
+            self.prelaunched = []
+        for (_key, thread, result) in prelaunched:
+            thread.join()
+            if "guest" in result:
+                self.closeHandle(result["guest"])
+        self.closeIdleHandles()
+
+
+class InspectionCache:
+    """
+        Persists results of inspect_os and inspect_get_* on disk, keyed by an image fingerprint.
+        The fingerprint changes whenever the image is written, so stale entries are never used.
+        Updates are serialized across processes (e.g. descriptor and decomposition workers) by a lock file.
+    """
+    fingerprintChunkSize = 1024 * 1024
+    lock = FileLock(StaticInfo.relPathLocalRepositoryInspectionCacheLock)
+
+    @staticmethod
+    def getImageFingerprint(pathToVMI):
+        """
+            Fingerprint of the image file: size, inode, modification time (full resolution), first and last chunk.
+            Images rewritten within the same second get a new fingerprint, copies and moves to another file system do too.
+        """
+        stat = os.stat(pathToVMI)
+        sha = hashlib.sha1()
+        sha.update("%i;%i;%r;" % (stat.st_size, stat.st_ino, stat.st_mtime))
+        with open(pathToVMI, "rb") as vmiFile:
+            sha.update(vmiFile.read(InspectionCache.fingerprintChunkSize))
+            if stat.st_size > InspectionCache.fingerprintChunkSize:
+                vmiFile.seek(-InspectionCache.fingerprintChunkSize, os.SEEK_END)
+                sha.update(vmiFile.read(InspectionCache.fingerprintChunkSize))
+        return sha.hexdigest()
+
+    @staticmethod
+    def load():
+        if not os.path.isfile(StaticInfo.relPathLocalRepositoryInspectionCache):
+            return dict()
+        try:
+            with open(StaticInfo.relPathLocalRepositoryInspectionCache, "r") as cacheFile:
+                return json.load(cacheFile)
+        except ValueError:
+            print "Inspection cache \"%s\" is corrupt and will be rebuilt." % StaticInfo.relPathLocalRepositoryInspectionCache
+            return dict()
+
+    @staticmethod
+    def get(fingerprint):
+        """
+        :return: inspection data (see GuestFSHelper.getInspectionData) or None
+        """
+        # the cache file is replaced in one step (see put), reading does not require the lock
+        entry = InspectionCache.load().get(fingerprint)
+        if entry is None:
+            return None
+        # json returns unicode, libguestfs expects str
+        return {
+            "root":                 str(entry["root"]),
+            "mountpoints":          dict((str(mp), str(dev)) for (mp, dev) in entry["mountpoints"].iteritems()),
+            "distribution":         str(entry["distribution"]),
+            "distributionVersion":  str(entry["distributionVersion"]),
+            "architecture":         str(entry["architecture"]),
+            "pkgManager":           str(entry["pkgManager"])
+        }
+
+    @staticmethod
+    def put(fingerprint, inspectionData):
+        if not os.path.isdir(StaticInfo.relPathLocalRepository):
+            return
+        with InspectionCache.lock:
+            cache = InspectionCache.load()
+            cache[fingerprint] = inspectionData
+            # write to temporary file first, concurrent readers never see a partial cache
+            tmpPath = "%s.%i.tmp" % (StaticInfo.relPathLocalRepositoryInspectionCache, os.getpid())
+            with open(tmpPath, "w") as cacheFile:
+                json.dump(cache, cacheFile)
+            os.rename(tmpPath, StaticInfo.relPathLocalRepositoryInspectionCache)
+
+
+class GuestFSBatchSession:
+    """
+        Attaches several VMIs read-only to a single appliance, so that only one appliance is booted for all of them.
+        The operating systems are mounted one at a time (see openVMI), commands run in the guest
+        (e.g. package queries) therefore always see exactly one VMI.
+        VMIs whose operating system cannot be assigned unambiguously to their drive
+        (e.g. clashing LVM volume group names) are not part of the session, see contains().
+
+        Usage:
+            with GuestFSBatchSession(pathsToVMIs) as session:
+                for pathToVMI in pathsToVMIs:
+                    if session.contains(pathToVMI):
+                        (guest, root) = session.openVMI(pathToVMI)
+                        ...
+                        session.closeVMI()
+    """
+    def __init__(self, pathsToVMIs):
+        self.pathsToVMIs = list(pathsToVMIs)
+        self.guest = None
+        self.roots = dict()     # in the form of {pathToVMI: root}
+        self.openedVMI = None
+
+    def __enter__(self):
+        self.guest = guestfs.GuestFS(python_return_dict=True)
+        labels = dict()
+        for i, pathToVMI in enumerate(self.pathsToVMIs):
+            label = "batch%i" % i
+            labels[label] = pathToVMI
+            self.guest.add_drive_opts(pathToVMI, readonly=True, label=label)
+        self.guest.launch()
+
+        # assign each operating system to the drive it is located on
+        labelDevices = self.guest.list_disk_labels()
+        deviceToVMI = dict((labelDevices[label], pathToVMI) for (label, pathToVMI) in labels.iteritems()
+                           if label in labelDevices)
+        rootsPerVMI = dict((pathToVMI, list()) for pathToVMI in self.pathsToVMIs)
+        for root in self.guest.inspect_os():
+            device = self.getDeviceOfFilesystem(root)
+            if device in deviceToVMI:
+                rootsPerVMI[deviceToVMI[device]].append(root)
+        for pathToVMI, roots in rootsPerVMI.iteritems():
+            if len(roots) == 1:
+                self.roots[pathToVMI] = roots[0]
+            else:
+                print "\tVMI \"%s\" cannot be handled in shared appliance (%i operating systems found)" \
+                      % (pathToVMI, len(roots))
+        return self
+
+    def __exit__(self, *args):
+        if self.openedVMI is not None:
+            self.closeVMI()
+        GuestFSHelper.inspectionData.pop(self.guest, None)
+        self.guest.shutdown()
+        self.guest.close()
+
+    def getDeviceOfFilesystem(self, filesystem):
+        """
+            Returns the drive (e.g. /dev/sdb) a filesystem (e.g. /dev/sdb1 or /dev/vg/root) is located on
+        """
+        try:
+            return self.guest.part_to_dev(filesystem)
+        except RuntimeError:
+            pass
+        if filesystem in self.guest.list_devices():
+            return filesystem
+        # logical volume: drive of the physical volumes of its volume group
+        try:
+            volumeGroup = self.guest.lvm_canonical_lv_name(filesystem).split("/")[2]
+            pvUUIDs = set(self.guest.vgpvuuids(volumeGroup))
+            for pv in self.guest.pvs_full():
+                if pv["pv_uuid"] in pvUUIDs:
+                    return self.getDeviceOfFilesystem(pv["pv_name"])
+        except RuntimeError:
+            pass
+        return None
+
+    def contains(self, pathToVMI):
+        return pathToVMI in self.roots
+
+    def openVMI(self, pathToVMI):
+        """
+            Mounts the operating system of pathToVMI (unmounting any other one)
+        :return: tuple (handle,root)
+        """
+        if self.openedVMI is not None:
+            self.closeVMI()
+        root = self.roots[pathToVMI]
+        GuestFSHelper.mountFilesystems(self.guest, self.guest.inspect_get_mountpoints(root))
+        self.openedVMI = pathToVMI
+        GuestFSHelper.inspectionData.pop(self.guest, None)
+        InspectionCache.put(InspectionCache.getImageFingerprint(pathToVMI),
+                            GuestFSHelper.getInspectionData(self.guest, root))
+        return (self.guest, root)
+
+    def closeVMI(self):
+        GuestFSHelper.inspectionData.pop(self.guest, None)
+        self.guest.umount_all()
+        self.openedVMI = None
+
+    @staticmethod
+    def chunks(pathsToVMIs, minChunks=1):
+        """
+            Splits pathsToVMIs into groups that are attached to one appliance each
+        :param int minChunks: number of groups to create at least (if there are enough VMIs), e.g. one per process
+        """
+        size = min(StaticInfo.guestfsMaxDrivesPerAppliance, max(1, -(-len(pathsToVMIs) // minChunks)))
+        return [pathsToVMIs[i:i + size] for i in range(0, len(pathsToVMIs), size)]
+
+
+class GuestFSTarStream:
+    """
+        Transfers a directory between guest and host without a temporary archive on the host.
+        tar_out/tar_in run in a background thread on one end of a pipe (passed as /dev/fd/N), tarfile reads or writes
+        the other end in stream mode. The archive is compressed in the appliance if StaticInfo.guestfsTarCompression is set.
+
+        Usage:
+            with GuestFSTarStream(guest, "/var/exportpackages", "r") as tar:
+                for member in tar:
+                    ...tar.extractfile(member)...   # members can only be read in the order of the archive
+            with GuestFSTarStream(guest, "/var/tempRepository", "w") as tar:
+                tar.add(localPath)
+    """
+    # in the form of {libguestfs compression: tarfile compression}
+    compressions = {None: "", "gzip": "gz", "bzip2": "bz2"}
+
+    def __init__(self, guest, directory, mode):
+        """
+        :param str mode: "r" to read the directory of the guest (tar_out), "w" to write into it (tar_in)
+        """
+        self.guest = guest
+        self.directory = directory
+        self.mode = mode
+        self.localFile = None
+        self.tar = None
+        self.thread = None
+        self.error = None
+
+    def __enter__(self):
+        (readFD, writeFD) = os.pipe()
+        if self.mode == "r":
+            (guestFD, self.localFile) = (writeFD, os.fdopen(readFD, "rb"))
+            transfer = lambda guestPath, **kwargs: self.guest.tar_out(self.directory, guestPath, **kwargs)
+        else:
+            (guestFD, self.localFile) = (readFD, os.fdopen(writeFD, "wb"))
+            transfer = lambda guestPath, **kwargs: self.guest.tar_in(guestPath, self.directory, **kwargs)
+        self.thread = threading.Thread(target=self.transfer, args=(transfer, guestFD))
+        self.thread.start()
+        try:
+            self.tar = tarfile.open(fileobj=self.localFile,
+                                    mode=self.mode + "|" + GuestFSTarStream.compressions[StaticInfo.guestfsTarCompression])
+        except tarfile.TarError:
+            # nothing was sent, e.g. directory does not exist in the guest
+            self.localFile.close()
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+            raise
+        return self.tar
+
+    def transfer(self, transfer, guestFD):
+        try:
+            if StaticInfo.guestfsTarCompression is None:
+                transfer("/dev/fd/%i" % guestFD)
+            else:
+                transfer("/dev/fd/%i" % guestFD, compress=StaticInfo.guestfsTarCompression)
+        except RuntimeError as e:
+            self.error = e
+        finally:
+            # end of the archive (tar_in) or no more readers (tar_out) for the other end
+            os.close(guestFD)
+
+    def __exit__(self, excType, excValue, traceback):
+        closeError = None
+        try:
+            if excType is None:
+                self.tar.close()
+                if self.mode == "r":
+                    # padding after the last member, tar_out only finishes once everything was read
+                    while self.localFile.read(65536):
+                        pass
+        except (IOError, tarfile.TarError) as e:
+            closeError = e
+        # on errors, closing the pipe makes the transfer fail instead of waiting for more data
+        self.localFile.close()
+        self.thread.join()
+        # failed transfers show up as broken pipes or truncated archives on this end, report the cause instead
+        if self.error is not None and (excType is None or issubclass(excType, (IOError, tarfile.TarError))):
+            raise self.error
+        if closeError is not None:
+            raise closeError
+
+
 class GuestFSHelper:
+    pool = GuestFSHandlePool()
+    inspectionData = dict()     # in the form of {guest: inspection data}
+
     @staticmethod
-    def getHandle(pathToVMI, rootRequired=False):
+    def getHandle(pathToVMI, rootRequired=False, readonly=False):
         """
             Returns the guestfs handle for the vmi located at pathToVMI.
             If rootRequired is specified, a tuple (handle,root) is returned
+            If readonly is specified, the drive is attached read-only (writes go to a temporary overlay)
+            and inspection results are taken from the inspection cache if the image is unchanged.
         :param pathToVMI:
         :param rootRequired:
+        :param readonly:
         :return:
         """
-        def compare(a, b):
-            return len(a) - len(b)
+        cachedData = None
+        fingerprint = None
+        if readonly:
+            fingerprint = InspectionCache.getImageFingerprint(pathToVMI)
+            cachedData = InspectionCache.get(fingerprint)
 
-        guest = guestfs.GuestFS(python_return_dict=True)
-        guest.add_drive_opts(pathToVMI, readonly=False)
-        guest.launch()
+        guest = GuestFSHelper.pool.acquire(pathToVMI, readonly=readonly)
         #guest.set_verbose(1)
 
-        # Obtain root filesystem that contains the OS
-        roots = guest.inspect_os()
-        if len(roots) == 0:
-            raise (Exception("inspect_vm: no operating systems found"))
-        if len(roots) > 1:
-            raise (Exception("inspect_vm: more than one operating system found"))
-        root = roots[0]
+        if cachedData is not None:
+            root = cachedData["root"]
+            mps = cachedData["mountpoints"]
+        else:
+            # Obtain root filesystem that contains the OS
+            roots = guest.inspect_os()
+            if len(roots) == 0:
+                raise (Exception("inspect_vm: no operating systems found"))
+            if len(roots) > 1:
+                raise (Exception("inspect_vm: more than one operating system found"))
+            root = roots[0]
+            mps = guest.inspect_get_mountpoints(root)
 
         # Obtain and try to mount all required filesystems associated with OS
-        mps = guest.inspect_get_mountpoints(root)
-        for device in sorted(mps.keys(), compare):
-            try:
-                guest.mount(mps[device], device)
-            except RuntimeError as msg:
-                print "%s (ignored)" % msg
+        GuestFSHelper.mountFilesystems(guest, mps)
+
+        if cachedData is not None:
+            GuestFSHelper.inspectionData[guest] = cachedData
+        elif readonly:
+            InspectionCache.put(fingerprint, GuestFSHelper.getInspectionData(guest, root))
 
         #guest.sh("mount -t proc proc proc/")
         #guest.sh("mount --rbind /sys sys/")
@@ -51,7 +485,69 @@ class GuestFSHelper:
         else:
             return guest
 
+    @staticmethod
+    def mountFilesystems(guest, mps):
+        """
+            Mounts the filesystems of an OS, shortest mountpoint first
+        :param mps: in the form of {mountpoint: device}, as returned by inspect_get_mountpoints
+        """
+        def compare(a, b):
+            return len(a) - len(b)
+
+        for device in sorted(mps.keys(), compare):
+            try:
+                guest.mount(mps[device], device)
+            except RuntimeError as msg:
+                print "%s (ignored)" % msg
+
+    @staticmethod
+    def getInspectionData(guest, root):
+        """
+            Returns OS information of the VMI attached to guest.
+            For handles opened from the inspection cache, no inspection calls are made.
+        :return: dict(root, mountpoints, distribution, distributionVersion, architecture, pkgManager)
+        """
+        if guest in GuestFSHelper.inspectionData:
+            return GuestFSHelper.inspectionData[guest]
+        inspectionData = {
+            "root":                 root,
+            "mountpoints":          guest.inspect_get_mountpoints(root),
+            "distribution":         guest.inspect_get_distro(root),
+            "distributionVersion":  str(guest.inspect_get_major_version(root)) + "_" +
+                                    str(guest.inspect_get_minor_version(root)),
+            "architecture":         guest.inspect_get_arch(root),
+            "pkgManager":           guest.inspect_get_package_management(root)
+        }
+        GuestFSHelper.inspectionData[guest] = inspectionData
+        return inspectionData
+
+    @staticmethod
+    def prelaunchHandle(pathToVMI, readonly=False):
+        """
+            Launches the appliance for a VMI that is processed next in the background,
+            so that getHandle for this VMI does not have to wait for the appliance to boot.
+        :param pathToVMI:
+        :param readonly: has to match the readonly flag of the following getHandle
+        """
+        GuestFSHelper.pool.prelaunch(pathToVMI, readonly=readonly)
+
     @staticmethod
     def shutdownHandle(guest):
+        GuestFSHelper.inspectionData.pop(guest, None)
         guest.umount_all()
-        guest.shutdown()
\ No newline at end of file
+        GuestFSHelper.pool.release(guest)
+
+    @staticmethod
+    def closeAllHandles():
+        GuestFSHelper.pool.closeAll()
+
+    @staticmethod
+    def initializeWorkerProcess():
+        """
+            Forked processes must not use or close the appliances of their parent
+        """
+        GuestFSHelper.pool = GuestFSHandlePool()
+        GuestFSHelper.inspectionData = dict()
+
+
+atexit.register(GuestFSHelper.closeAllHandles)
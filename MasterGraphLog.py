@@ -0,0 +1,214 @@
+import os
+import struct
+import threading
+
+from PackageGraph import PackageGraph
+from StaticInfo import StaticInfo
+
+
+class MasterGraphLog:
+    """
+        Master graphs are stored as a snapshot (graph file) plus an append-only log of the subgraphs
+        added since the snapshot was written (graph file + ".log"):
+
+            header      magic "PKGDELTA", format version
+            records     uint64 length, subgraph encoded as PackageGraphFile
+
+        The master graph is the snapshot composed with every subgraph in the order of the log (see VMIMasterDescriptor.addSubGraph).
+        Logs are compacted into the snapshot in a background thread. Snapshots and rewritten logs are synced to disk before
+        they replace the old files, the snapshot is replaced first. As composing the same subgraph twice does not change
+        the master, a compaction interrupted between replacing the snapshot and truncating the log leaves a valid master.
+        A compaction is discarded if the snapshot was replaced in the meantime (see writeSnapshot).
+    """
+    magic = "PKGDELTA"
+    formatVersion = 1
+    headerFormat = "<8sI"
+    recordFormat = "<Q"
+
+    locks = dict()  # in the form of {graphPath: threading.Lock}
+    locksLock = threading.Lock()
+    compactions = dict()  # running compactions in the form of {graphPath: thread}
+
+    @staticmethod
+    def getLogPath(graphPath):
+        return graphPath + ".log"
+
+    @staticmethod
+    def getLock(graphPath):
+        with MasterGraphLog.locksLock:
+            if graphPath not in MasterGraphLog.locks:
+                MasterGraphLog.locks[graphPath] = threading.Lock()
+            return MasterGraphLog.locks[graphPath]
+
+    @staticmethod
+    def writeTmpFile(path, data):
+        """
+            Writes data to a temporary file next to path and syncs it to disk
+        :return: path of the temporary file
+        """
+        tmpPath = "%s.%i.%i.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmpPath, "wb") as tmpFile:
+            tmpFile.write(data)
+            tmpFile.flush()
+            os.fsync(tmpFile.fileno())
+        return tmpPath
+
+    @staticmethod
+    def syncDirectory(path):
+        """
+            Syncs the directory containing path, makes renames and removals in it durable
+        """
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    @staticmethod
+    def getSnapshotID(graphPath):
+        """
+        :return: (inode, mtime) of the snapshot, changes whenever the snapshot is replaced
+        """
+        stat = os.stat(graphPath)
+        return (stat.st_ino, stat.st_mtime)
+
+    @staticmethod
+    def writeSnapshot(graphPath, graph):
+        """
+            Stores graph as the complete master in graphPath, an existing snapshot and its log are replaced
+        :param PackageGraph graph:
+        """
+        tmpGraphPath = MasterGraphLog.writeTmpFile(graphPath, graph.encode())
+        logPath = MasterGraphLog.getLogPath(graphPath)
+        with MasterGraphLog.getLock(graphPath):
+            # the log belongs to the old snapshot, it must not be applied to the new one
+            if os.path.isfile(logPath):
+                os.remove(logPath)
+                MasterGraphLog.syncDirectory(graphPath)
+            os.rename(tmpGraphPath, graphPath)
+            MasterGraphLog.syncDirectory(graphPath)
+
+    @staticmethod
+    def append(graphPath, graph):
+        """
+            Appends a subgraph to the log of the master stored in graphPath, compacts the log in the background if required
+        :param PackageGraph graph:
+        """
+        data = graph.encode()
+        logPath = MasterGraphLog.getLogPath(graphPath)
+        with MasterGraphLog.getLock(graphPath):
+            with open(logPath, "ab") as logFile:
+                if logFile.tell() == 0:
+                    logFile.write(struct.pack(MasterGraphLog.headerFormat, MasterGraphLog.magic, MasterGraphLog.formatVersion))
+                logFile.write(struct.pack(MasterGraphLog.recordFormat, len(data)))
+                logFile.write(data)
+                logFile.flush()
+                os.fsync(logFile.fileno())
+            logSize = os.path.getsize(logPath)
+        if (logSize > StaticInfo.masterGraphLogMaxBytes
+                or logSize > os.path.getsize(graphPath) * StaticInfo.masterGraphLogMaxRatio):
+            MasterGraphLog.compactInBackground(graphPath)
+
+    @staticmethod
+    def decodeRecords(data):
+        """
+        :param str data: content of a log file
+        :return: list of subgraphs, a truncated last record (interrupted append) is ignored
+        """
+        deltas = []
+        if len(data) == 0:
+            return deltas
+        (magic, version) = struct.unpack_from(MasterGraphLog.headerFormat, data)
+        if magic != MasterGraphLog.magic or version != MasterGraphLog.formatVersion:
+            raise ValueError("Unsupported master graph log.")
+        position = struct.calcsize(MasterGraphLog.headerFormat)
+        recordHeaderSize = struct.calcsize(MasterGraphLog.recordFormat)
+        while position + recordHeaderSize <= len(data):
+            (length,) = struct.unpack_from(MasterGraphLog.recordFormat, data, position)
+            position = position + recordHeaderSize
+            if position + length > len(data):
+                break
+            deltas.append(PackageGraph.decode(data[position:position + length]))
+            position = position + length
+        return deltas
+
+    @staticmethod
+    def read(graphPath):
+        """
+        :return: (snapshot, list of subgraphs in the log)
+        """
+        logPath = MasterGraphLog.getLogPath(graphPath)
+        with MasterGraphLog.getLock(graphPath):
+            snapshot = PackageGraph.read(graphPath)
+            data = ""
+            if os.path.isfile(logPath):
+                with open(logPath, "rb") as logFile:
+                    data = logFile.read()
+        return (snapshot, MasterGraphLog.decodeRecords(data))
+
+    @staticmethod
+    def apply(snapshot, deltas):
+        """
+            Same result as composing the subgraphs one by one (graph = compose(delta, graph)), in a single pass
+        """
+        if len(deltas) == 0:
+            return snapshot
+        return PackageGraph.compose(*(list(reversed(deltas)) + [snapshot]))
+
+    @staticmethod
+    def compactInBackground(graphPath):
+        with MasterGraphLog.locksLock:
+            if graphPath in MasterGraphLog.compactions and MasterGraphLog.compactions[graphPath].is_alive():
+                return
+            # not a daemon thread, the program waits for running compactions before it exits
+            thread = threading.Thread(target=MasterGraphLog.compact, args=(graphPath,))
+            MasterGraphLog.compactions[graphPath] = thread
+        thread.start()
+
+    @staticmethod
+    def compact(graphPath):
+        """
+            Writes snapshot and log into a new snapshot, records appended in the meantime are kept in the log
+        """
+        logPath = MasterGraphLog.getLogPath(graphPath)
+        with MasterGraphLog.getLock(graphPath):
+            if not os.path.isfile(logPath) or not os.path.isfile(graphPath):
+                return
+            compactedLogSize = os.path.getsize(logPath)
+            snapshotID = MasterGraphLog.getSnapshotID(graphPath)
+            snapshot = PackageGraph.read(graphPath)
+            with open(logPath, "rb") as logFile:
+                data = logFile.read(compactedLogSize)
+        # the expensive part runs without holding the lock
+        graph = MasterGraphLog.apply(snapshot, MasterGraphLog.decodeRecords(data))
+        tmpGraphPath = MasterGraphLog.writeTmpFile(graphPath, graph.encode())
+
+        with MasterGraphLog.getLock(graphPath):
+            if (not os.path.isfile(graphPath) or not os.path.isfile(logPath)
+                    or MasterGraphLog.getSnapshotID(graphPath) != snapshotID):
+                # master was removed or replaced (e.g. by a new master of the same name) in the meantime
+                os.remove(tmpGraphPath)
+                return
+            with open(logPath, "rb") as logFile:
+                logFile.seek(compactedLogSize)
+                remaining = logFile.read()
+            os.rename(tmpGraphPath, graphPath)
+            MasterGraphLog.syncDirectory(graphPath)
+            if len(remaining) == 0:
+                os.remove(logPath)
+            else:
+                tmpLogPath = MasterGraphLog.writeTmpFile(logPath, data[:struct.calcsize(MasterGraphLog.headerFormat)]
+                                                         + remaining)
+                os.rename(tmpLogPath, logPath)
+            MasterGraphLog.syncDirectory(graphPath)
+
+    @staticmethod
+    def remove(graphPath):
+        """
+            Removes snapshot and log of a master
+        """
+        logPath = MasterGraphLog.getLogPath(graphPath)
+        with MasterGraphLog.getLock(graphPath):
+            for path in (graphPath, logPath):
+                if os.path.isfile(path):
+                    os.remove(path)
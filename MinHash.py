@@ -0,0 +1,70 @@
+import zlib
+
+import numpy as np
+
+from StaticInfo import StaticInfo
+
+
+class MinHash:
+    """
+        MinHash signatures of package sets, used to find masters similar to a VMI without loading their graphs.
+        Packages are tokens in the form of "name=version". Signature i is the minimum of hash function i over all tokens,
+        the fraction of equal entries in two signatures estimates the Jaccard similarity of the package sets.
+        The signature of a union of sets is the element-wise minimum of their signatures (see merge).
+
+        For locality-sensitive hashing, signatures are split into StaticInfo.minHashBands bands. Sets that agree in all
+        values of at least one band (same bucket) are candidates, with 128 hashes in 32 bands mostly sets with a
+        Jaccard similarity above ~0.4.
+    """
+    prime = (1 << 31) - 1
+    # hash functions in the form of (a * x + b) mod prime, identical in every run
+    randomState = np.random.RandomState(20180101)
+    a = randomState.randint(1, prime, size=StaticInfo.minHashNumPermutations).astype(np.int64)
+    b = randomState.randint(0, prime, size=StaticInfo.minHashNumPermutations).astype(np.int64)
+    dtype = np.dtype("<u4")
+
+    @staticmethod
+    def getTokens(packageIndex, pkgNames=None):
+        """
+        :param dict packageIndex: in the form of {pkgName: (version, architecture, installsize)}
+        :param pkgNames: packages to use, all packages of packageIndex by default
+        """
+        if pkgNames is None:
+            pkgNames = packageIndex.iterkeys()
+        return ["%s=%s" % (pkgName, packageIndex[pkgName][0]) for pkgName in pkgNames]
+
+    @staticmethod
+    def getSignature(tokens):
+        """
+        :return: numpy array of StaticInfo.minHashNumPermutations values
+        """
+        if len(tokens) == 0:
+            return np.full(StaticInfo.minHashNumPermutations, MinHash.prime, dtype=MinHash.dtype)
+        values = np.array([zlib.crc32(token) & 0x7fffffff for token in tokens], dtype=np.int64)
+        hashes = (MinHash.a[:, np.newaxis] * values + MinHash.b[:, np.newaxis]) % MinHash.prime
+        return hashes.min(axis=1).astype(MinHash.dtype)
+
+    @staticmethod
+    def merge(signature1, signature2):
+        return np.minimum(signature1, signature2)
+
+    @staticmethod
+    def estimateJaccard(signature1, signature2):
+        return float(np.count_nonzero(signature1 == signature2)) / len(signature1)
+
+    @staticmethod
+    def getBuckets(signature):
+        """
+        :return: list in the form of [(band, bucket)]
+        """
+        rowsPerBand = len(signature) // StaticInfo.minHashBands
+        return [(band, zlib.crc32(signature[band * rowsPerBand:(band + 1) * rowsPerBand].tostring()))
+                for band in xrange(StaticInfo.minHashBands)]
+
+    @staticmethod
+    def toBlob(signature):
+        return buffer(signature.astype(MinHash.dtype).tostring())
+
+    @staticmethod
+    def fromBlob(blob):
+        return np.frombuffer(str(blob), dtype=MinHash.dtype)
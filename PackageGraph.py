@@ -0,0 +1,383 @@
+import binascii
+import cPickle
+import itertools
+from array import array
+from collections import deque
+
+import networkx as nx
+
+from PackageGraphFile import PackageGraphFile, Missing
+from StaticInfo import StaticInfo
+
+# graphs pickled before PackageGraphFile existed reference the marker by this name
+_Missing = Missing
+
+
+class PackageGraph:
+    """
+        Compact, immutable package dependency graph.
+        Packages are identified by integer IDs (position in self.names), node attributes are stored column-wise
+        and dependencies in CSR form: the edges of package i are
+            self.targets[self.offsets[i]:self.offsets[i+1]]
+        with their attributes in self.edgeData[self.edgeAttrs[e]].
+        Implements the part of the networkx MultiDiGraph interface used for VMI descriptors.
+        Graphs read from a PackageGraphFile load these attributes on first access (see __getattr__).
+    """
+    # attributes that are loaded lazily from self.graphFile, in the form of {attribute: PackageGraphFile method}
+    lazyAttributes = {
+        "names":        lambda graphFile: graphFile.readNames(),
+        "columns":      lambda graphFile: graphFile.readColumns(),
+        "edgeData":     lambda graphFile: graphFile.readEdgeData(),
+        "offsets":      lambda graphFile: graphFile.readOffsets(),
+        "targets":      lambda graphFile: graphFile.readTargets(),
+        "edgeAttrs":    lambda graphFile: graphFile.readEdgeAttrs()
+    }
+
+    def __init__(self, nodes=(), edges=()):
+        """
+        :param nodes: iterable in the form of [(pkg,{name:"pkg", version:"1.1", ...})]
+        :param edges: iterable in the form of [(pkg,deppkg,{constraint:True, operator:">=", version:"1.6"})]
+        """
+        self.names = []         # in the form of [pkgName], index is the package ID
+        self.index = dict()     # in the form of {pkgName: ID}
+        self.columns = dict()   # in the form of {attributeName: [value for every ID]}
+        self.edgeData = []      # distinct edge attributes in the form of [((attributeName, value),...)]
+        self.offsets = array("l", [0])
+        self.targets = array("l")
+        self.edgeAttrs = array("l")
+        self.graphFile = None   # type: PackageGraphFile
+
+        valuePool = dict()
+        for (name, data) in nodes:
+            self.addNode(name, data, valuePool)
+
+        edgeDataIDs = dict()
+        edgeList = []
+        for edge in edges:
+            for name in edge[:2]:
+                if name not in self.index:
+                    self.addNode(name, {}, valuePool)
+            data = tuple(sorted(edge[2].iteritems())) if len(edge) > 2 else ()
+            if data not in edgeDataIDs:
+                edgeDataIDs[data] = len(self.edgeData)
+                self.edgeData.append(data)
+            edgeList.append((self.index[edge[0]], self.index[edge[1]], edgeDataIDs[data]))
+        self.buildAdjacency(edgeList)
+
+    def addNode(self, name, data, valuePool):
+        # only used while constructing the graph
+        if name in self.index:
+            nodeID = self.index[name]
+        else:
+            nodeID = len(self.names)
+            self.index[name] = nodeID
+            self.names.append(name)
+            for column in self.columns.itervalues():
+                column.append(Missing)
+        for (key, value) in data.iteritems():
+            if key not in self.columns:
+                self.columns[key] = [Missing] * len(self.names)
+            try:
+                value = valuePool.setdefault(value, value)
+            except TypeError:
+                pass
+            self.columns[key][nodeID] = value
+
+    def buildAdjacency(self, edgeList):
+        """
+        :param edgeList: list in the form of [(fromID, toID, edgeDataID)], order of edges per package is kept
+        """
+        counts = [0] * (len(self.names) + 1)
+        for (fromID, _, _) in edgeList:
+            counts[fromID + 1] = counts[fromID + 1] + 1
+        offsets = array("l", [0]) * (len(self.names) + 1)
+        for i in xrange(len(self.names)):
+            offsets[i + 1] = offsets[i] + counts[i + 1]
+        position = array("l", offsets)
+        targets = array("l", [0]) * len(edgeList)
+        edgeAttrs = array("l", [0]) * len(edgeList)
+        for (fromID, toID, dataID) in edgeList:
+            pos = position[fromID]
+            targets[pos] = toID
+            edgeAttrs[pos] = dataID
+            position[fromID] = pos + 1
+        self.offsets = offsets
+        self.targets = targets
+        self.edgeAttrs = edgeAttrs
+
+    @staticmethod
+    def fromMultiDiGraph(graph):
+        return PackageGraph(graph.nodes(data=True), graph.edges(data=True))
+
+    def toMultiDiGraph(self):
+        graph = nx.MultiDiGraph()
+        graph.add_nodes_from(self.nodes(data=True))
+        graph.add_edges_from(self.edges(data=True))
+        return graph
+
+    @staticmethod
+    def read(path):
+        """
+            Memory-maps a graph written by write(), its parts are loaded when they are used.
+            Graphs stored as pickles by earlier versions (PackageGraph or networkx graphs) are converted.
+        """
+        if PackageGraphFile.isGraphFile(path):
+            return PackageGraph.fromGraphFile(PackageGraphFile.open(path))
+        with open(path, "rb") as graphFile:
+            graph = cPickle.load(graphFile)
+        if isinstance(graph, PackageGraph):
+            graph.graphFile = None
+            return graph
+        return PackageGraph.fromMultiDiGraph(graph)
+
+    @staticmethod
+    def fromGraphFile(graphFile):
+        graph = PackageGraph()
+        for attribute in PackageGraph.lazyAttributes.keys() + ["index"]:
+            delattr(graph, attribute)
+        graph.graphFile = graphFile
+        return graph
+
+    @staticmethod
+    def decode(data):
+        return PackageGraph.fromGraphFile(PackageGraphFile(data))
+
+    def encode(self):
+        return PackageGraphFile.encode(self)
+
+    def write(self, path):
+        PackageGraphFile.write(self, path)
+
+    def __getattr__(self, attribute):
+        # only called for attributes that are not set, i.e. parts of mapped graphs that are not loaded yet
+        if attribute == "index":
+            self.index = dict((name, nodeID) for (nodeID, name) in enumerate(self.names))
+            return self.index
+        if attribute in PackageGraph.lazyAttributes and self.__dict__.get("graphFile") is not None:
+            value = PackageGraph.lazyAttributes[attribute](self.graphFile)
+            setattr(self, attribute, value)
+            return value
+        raise AttributeError(attribute)
+
+    def __getstate__(self):
+        # mapped graphs are loaded completely before they are pickled
+        state = dict((attribute, getattr(self, attribute)) for attribute in PackageGraph.lazyAttributes)
+        state["columns"] = dict((key, list(column)) for (key, column) in state["columns"].iteritems())
+        state["index"] = self.index
+        state["graphFile"] = None
+        return state
+
+    def __len__(self):
+        if "names" not in self.__dict__ and self.__dict__.get("graphFile") is not None:
+            return self.graphFile.numNodes
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def number_of_nodes(self):
+        return len(self)
+
+    def number_of_edges(self):
+        if "targets" not in self.__dict__ and self.__dict__.get("graphFile") is not None:
+            return self.graphFile.numEdges
+        return len(self.targets)
+
+    def getNodeDataByID(self, nodeID):
+        data = dict()
+        for (key, column) in self.columns.iteritems():
+            value = column[nodeID]
+            if value is not Missing:
+                data[key] = value
+        return data
+
+    def nodes(self, data=False):
+        if data:
+            return [(name, self.getNodeDataByID(nodeID)) for (nodeID, name) in enumerate(self.names)]
+        return list(self.names)
+
+    def getNodeDataDict(self, nodeNames=None):
+        """
+        :param nodeNames: packages to return, all packages if None
+        :return: dict in the form of {pkgName: pkgInfo}
+        """
+        if nodeNames is None:
+            return dict(self.nodes(data=True))
+        return dict((name, self.getNodeDataByID(self.index[name])) for name in nodeNames)
+
+    def getNodeDataDictFromIDs(self, nodeIDs):
+        return dict((self.names[nodeID], self.getNodeDataByID(nodeID)) for nodeID in nodeIDs)
+
+    def getPackageIndex(self):
+        """
+        :return: dict in the form of {pkgName: (version, architecture, installsize as int)}
+        """
+        missing = [Missing] * len(self.names)
+        versions = self.columns.get(StaticInfo.dictKeyVersion, missing)
+        archs = self.columns.get(StaticInfo.dictKeyArchitecture, missing)
+        sizes = self.columns.get(StaticInfo.dictKeyInstallSize, missing)
+        return dict((name, (version, arch, 0 if size is Missing else int(size)))
+                    for (name, version, arch, size) in itertools.izip(self.names, versions, archs, sizes))
+
+    def getBitsetFromIDs(self, nodeIDs):
+        """
+        :return: int with bit i set for every package ID i
+        """
+        flags = bytearray((len(self.names) + 7) // 8)
+        for nodeID in nodeIDs:
+            flags[nodeID >> 3] |= 1 << (nodeID & 7)
+        if len(flags) == 0:
+            return 0
+        flags.reverse()
+        return int(binascii.hexlify(flags), 16)
+
+    def getIDsFromBitset(self, bitset):
+        if bitset == 0:
+            return []
+        flags = bytearray(binascii.unhexlify("%0*x" % (((len(self.names) + 7) // 8) * 2, bitset)))
+        flags.reverse()
+        return [(i << 3) + bit for (i, byte) in enumerate(flags) if byte for bit in xrange(8) if byte >> bit & 1]
+
+    def edges(self, data=False):
+        result = []
+        for fromID in xrange(len(self.names)):
+            for pos in xrange(self.offsets[fromID], self.offsets[fromID + 1]):
+                if data:
+                    result.append((self.names[fromID], self.names[self.targets[pos]],
+                                   dict(self.edgeData[self.edgeAttrs[pos]])))
+                else:
+                    result.append((self.names[fromID], self.names[self.targets[pos]]))
+        return result
+
+    def successors(self, name):
+        nodeID = self.index[name]
+        return [self.names[toID] for toID in self.targets[self.offsets[nodeID]:self.offsets[nodeID + 1]]]
+
+    def getReachableIDs(self, rootNodeList):
+        """
+            Breadth first search from all roots (replaces nx.bfs_tree)
+        :return: list of package IDs in the order they were reached
+        """
+        visited = bytearray(len(self.names))
+        order = []
+        queue = deque()
+        offsets = self.offsets
+        targets = self.targets
+        for name in rootNodeList:
+            if name not in self.index:
+                raise KeyError("The node %s is not in the graph." % name)
+            rootID = self.index[name]
+            if visited[rootID]:
+                continue
+            visited[rootID] = 1
+            queue.append(rootID)
+            while queue:
+                nodeID = queue.popleft()
+                order.append(nodeID)
+                for toID in targets[offsets[nodeID]:offsets[nodeID + 1]]:
+                    if not visited[toID]:
+                        visited[toID] = 1
+                        queue.append(toID)
+        return order
+
+    def getReachableBitset(self, rootNodeList, knownClosures=None):
+        """
+            Like getReachableIDs, but packages whose closure is already known are not traversed again
+        :param knownClosures: dict in the form of {package ID: bitset of packages reachable from it}
+        :return: bitset of reachable package IDs
+        """
+        if not knownClosures:
+            return self.getBitsetFromIDs(self.getReachableIDs(rootNodeList))
+        visited = bytearray(len(self.names))
+        reached = []
+        closure = 0
+        queue = deque()
+        offsets = self.offsets
+        targets = self.targets
+        for name in rootNodeList:
+            if name not in self.index:
+                raise KeyError("The node %s is not in the graph." % name)
+            rootID = self.index[name]
+            if not visited[rootID]:
+                visited[rootID] = 1
+                queue.append(rootID)
+        while queue:
+            nodeID = queue.popleft()
+            if nodeID in knownClosures:
+                closure = closure | knownClosures[nodeID]
+                continue
+            reached.append(nodeID)
+            for toID in targets[offsets[nodeID]:offsets[nodeID + 1]]:
+                if not visited[toID]:
+                    visited[toID] = 1
+                    queue.append(toID)
+        return closure | self.getBitsetFromIDs(reached)
+
+    def getReachableNodes(self, rootNodeList):
+        return [self.names[nodeID] for nodeID in self.getReachableIDs(rootNodeList)]
+
+    def subgraph(self, nodeNames):
+        """
+        :return: new PackageGraph induced by the given packages, unknown names are ignored
+        """
+        return self.subgraphFromIDs(set(self.index[name] for name in nodeNames if name in self.index))
+
+    def subgraphFromIDs(self, nodeIDs):
+        nodeIDs = sorted(nodeIDs)
+        newIDs = dict((oldID, newID) for (newID, oldID) in enumerate(nodeIDs))
+        graph = PackageGraph()
+        graph.names = [self.names[oldID] for oldID in nodeIDs]
+        graph.index = dict((name, newID) for (newID, name) in enumerate(graph.names))
+        graph.columns = dict((key, [column[oldID] for oldID in nodeIDs]) for (key, column) in self.columns.iteritems())
+        graph.edgeData = self.edgeData
+        edgeList = []
+        for oldID in nodeIDs:
+            fromID = newIDs[oldID]
+            for pos in xrange(self.offsets[oldID], self.offsets[oldID + 1]):
+                toID = newIDs.get(self.targets[pos])
+                if toID is not None:
+                    edgeList.append((fromID, toID, self.edgeAttrs[pos]))
+        graph.buildAdjacency(edgeList)
+        return graph
+
+    @staticmethod
+    def compose(*graphs):
+        """
+            Same semantics as nx.compose (nx.compose_all for more than two graphs) for MultiDiGraphs:
+            union of all graphs, attributes of later graphs take precedence
+        """
+        nodes = []
+        parallelEdges = dict()  # in the form of {(pkg,deppkg): [edges]}
+        edgeOrder = []
+        for graph in graphs:
+            nodes.extend(graph.nodes(data=True))
+            graphEdges = dict()
+            graphEdgeOrder = []
+            for edge in graph.edges(data=True):
+                pair = (edge[0], edge[1])
+                if pair not in graphEdges:
+                    graphEdges[pair] = []
+                    graphEdgeOrder.append(pair)
+                graphEdges[pair].append(edge)
+            for pair in graphEdgeOrder:
+                if pair not in parallelEdges:
+                    parallelEdges[pair] = graphEdges[pair]
+                    edgeOrder.append(pair)
+                else:
+                    # parallel edges are keyed by their position, attributes of later graphs update those of earlier ones
+                    previousEdges = parallelEdges[pair]
+                    mergedEdges = []
+                    for (position, (fromName, toName, data)) in enumerate(graphEdges[pair]):
+                        if position < len(previousEdges):
+                            mergedData = dict(previousEdges[position][2])
+                            mergedData.update(data)
+                            data = mergedData
+                        mergedEdges.append((fromName, toName, data))
+                    parallelEdges[pair] = mergedEdges + previousEdges[len(mergedEdges):]
+        edges = []
+        for pair in edgeOrder:
+            edges.extend(parallelEdges[pair])
+        return PackageGraph(nodes, edges)
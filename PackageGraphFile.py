@@ -0,0 +1,284 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+
+class Missing:
+    # marks attributes that are not set for a node (pickled by reference, identity is preserved)
+    pass
+
+
+def getArrayTypecode(itemsize):
+    for typecode in "bhil":
+        if array(typecode).itemsize == itemsize:
+            return typecode
+    raise TypeError("No array type with %i bytes available on this platform." % itemsize)
+
+
+class PackageGraphFile:
+    """
+        Versioned binary file format for PackageGraph, all numbers are little-endian:
+
+            header      magic "PKGGRAPH", format version, numNodes, numEdges, numStrings, numColumns, numEdgeData
+            sections    (offset, length) of every section listed in self.sections
+
+            stringOffsets   uint32[numStrings+1], string i is stringData[stringOffsets[i]:stringOffsets[i+1]]
+            stringData
+            names           uint32[numNodes], string ID of every package name
+            columns         per node attribute: uint32 string ID of the attribute name,
+                            uint8[numNodes] value types, int64[numNodes] values (int or string ID)
+            edgeData        per distinct edge attribute set: uint32 count, count * (uint32 name ID, uint8 type, int64 value)
+            offsets         int64[numNodes+1]   \
+            targets         uint32[numEdges]     > CSR adjacency, see PackageGraph
+            edgeAttrs       uint32[numEdges]    /
+
+        Sections are only decoded when they are accessed. Files are read into memory, only files larger than
+        mmapMinSize are memory-mapped (a mapping keeps a duplicate of the file descriptor open while the graph lives).
+    """
+    magic = "PKGGRAPH"
+    formatVersion = 1
+    headerFormat = "<8s6I"
+    sections = ["stringOffsets", "stringData", "names", "columns", "edgeData", "offsets", "targets", "edgeAttrs"]
+    sectionFormat = "<%iQ" % (2 * len(sections))
+    mmapMinSize = 64 * 1024 * 1024
+
+    # value types
+    typeMissing = 0
+    typeNone = 1
+    typeFalse = 2
+    typeTrue = 3
+    typeInt = 4
+    typeString = 5
+    typeUnicode = 6
+
+    uint8 = "B"
+    uint32 = getArrayTypecode(4)
+    int64 = getArrayTypecode(8)
+
+    @staticmethod
+    def isGraphFile(path):
+        with open(path, "rb") as graphFile:
+            return graphFile.read(len(PackageGraphFile.magic)) == PackageGraphFile.magic
+
+    @staticmethod
+    def toBytes(values):
+        if sys.byteorder == "big":
+            values = array(values.typecode, values)
+            values.byteswap()
+        return values.tostring()
+
+    @staticmethod
+    def write(graph, path):
+        with open(path, "wb") as graphFile:
+            graphFile.write(PackageGraphFile.encode(graph))
+
+    @staticmethod
+    def encode(graph):
+        """
+        :param PackageGraph graph:
+        :return: str with the graph in the file format described above
+        """
+        strings = []
+        stringIDs = dict()
+
+        def getStringID(string):
+            if string not in stringIDs:
+                stringIDs[string] = len(strings)
+                strings.append(string)
+            return stringIDs[string]
+
+        def encodeValue(value):
+            if value is Missing:
+                return (PackageGraphFile.typeMissing, 0)
+            elif value is None:
+                return (PackageGraphFile.typeNone, 0)
+            elif value is False:
+                return (PackageGraphFile.typeFalse, 0)
+            elif value is True:
+                return (PackageGraphFile.typeTrue, 0)
+            elif isinstance(value, (int, long)):
+                return (PackageGraphFile.typeInt, value)
+            elif isinstance(value, str):
+                return (PackageGraphFile.typeString, getStringID(value))
+            elif isinstance(value, unicode):
+                return (PackageGraphFile.typeUnicode, getStringID(value.encode("utf-8")))
+            raise TypeError("Graph attributes of type %s cannot be stored." % type(value))
+
+        names = array(PackageGraphFile.uint32, (getStringID(str(name)) for name in graph.names))
+
+        columns = []
+        for (key, column) in sorted(graph.columns.iteritems()):
+            types = array(PackageGraphFile.uint8)
+            values = array(PackageGraphFile.int64)
+            for value in column:
+                (valueType, encoded) = encodeValue(value)
+                types.append(valueType)
+                values.append(encoded)
+            columns.append(struct.pack("<I", getStringID(str(key))) + PackageGraphFile.toBytes(types) + PackageGraphFile.toBytes(values))
+
+        edgeData = []
+        for data in graph.edgeData:
+            edgeData.append(struct.pack("<I", len(data)))
+            for (key, value) in data:
+                (valueType, encoded) = encodeValue(value)
+                edgeData.append(struct.pack("<IBq", getStringID(str(key)), valueType, encoded))
+
+        stringOffsets = array(PackageGraphFile.uint32, [0])
+        for string in strings:
+            stringOffsets.append(stringOffsets[-1] + len(string))
+
+        sectionData = [
+            PackageGraphFile.toBytes(stringOffsets),
+            "".join(strings),
+            PackageGraphFile.toBytes(names),
+            "".join(columns),
+            "".join(edgeData),
+            PackageGraphFile.toBytes(array(PackageGraphFile.int64, graph.offsets)),
+            PackageGraphFile.toBytes(array(PackageGraphFile.uint32, graph.targets)),
+            PackageGraphFile.toBytes(array(PackageGraphFile.uint32, graph.edgeAttrs))
+        ]
+        header = struct.pack(PackageGraphFile.headerFormat, PackageGraphFile.magic, PackageGraphFile.formatVersion,
+                             len(graph.names), len(graph.targets), len(strings), len(columns), len(graph.edgeData))
+        sectionTable = []
+        offset = len(header) + struct.calcsize(PackageGraphFile.sectionFormat)
+        for data in sectionData:
+            sectionTable.extend([offset, len(data)])
+            offset = offset + len(data)
+
+        return header + struct.pack(PackageGraphFile.sectionFormat, *sectionTable) + "".join(sectionData)
+
+    @staticmethod
+    def open(path):
+        with open(path, "rb") as graphFile:
+            if os.fstat(graphFile.fileno()).st_size < PackageGraphFile.mmapMinSize:
+                return PackageGraphFile(graphFile.read())
+            return PackageGraphFile(mmap.mmap(graphFile.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __init__(self, data):
+        """
+        :param data: str or mmap with the encoded graph
+        """
+        self.data = data
+        headerSize = struct.calcsize(PackageGraphFile.headerFormat)
+        (magic, version, self.numNodes, self.numEdges, self.numStrings, self.numColumns, self.numEdgeData) = \
+            struct.unpack_from(PackageGraphFile.headerFormat, self.data)
+        if magic != PackageGraphFile.magic:
+            raise ValueError("Data is not a package graph.")
+        if version != PackageGraphFile.formatVersion:
+            raise ValueError("Package graph has unsupported format version %i." % version)
+        sectionTable = struct.unpack_from(PackageGraphFile.sectionFormat, self.data, headerSize)
+        self.sectionOffsets = dict((name, (sectionTable[2 * i], sectionTable[2 * i + 1]))
+                                   for (i, name) in enumerate(PackageGraphFile.sections))
+        self.stringOffsets = None
+        self.strings = dict()   # decoded strings in the form of {string ID: string}
+
+    def readArray(self, typecode, start, count):
+        values = array(typecode)
+        values.fromstring(self.data[start:start + count * values.itemsize])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def readSection(self, section, typecode):
+        (start, length) = self.sectionOffsets[section]
+        return self.readArray(typecode, start, length // array(typecode).itemsize)
+
+    def getString(self, stringID):
+        if stringID not in self.strings:
+            if self.stringOffsets is None:
+                self.stringOffsets = self.readSection("stringOffsets", PackageGraphFile.uint32)
+            start = self.sectionOffsets["stringData"][0]
+            self.strings[stringID] = self.data[start + self.stringOffsets[stringID]:start + self.stringOffsets[stringID + 1]]
+        return self.strings[stringID]
+
+    def decodeValue(self, valueType, value):
+        if valueType == PackageGraphFile.typeString:
+            return self.getString(value)
+        elif valueType == PackageGraphFile.typeUnicode:
+            return self.getString(value).decode("utf-8")
+        elif valueType == PackageGraphFile.typeInt:
+            return value
+        elif valueType == PackageGraphFile.typeNone:
+            return None
+        elif valueType == PackageGraphFile.typeFalse:
+            return False
+        elif valueType == PackageGraphFile.typeTrue:
+            return True
+        return Missing
+
+    def readNames(self):
+        if self.stringOffsets is None:
+            self.stringOffsets = self.readSection("stringOffsets", PackageGraphFile.uint32)
+        (start, length) = self.sectionOffsets["stringData"]
+        stringData = self.data[start:start + length]
+        stringOffsets = self.stringOffsets
+        return [stringData[stringOffsets[stringID]:stringOffsets[stringID + 1]]
+                for stringID in self.readSection("names", PackageGraphFile.uint32)]
+
+    def readColumns(self):
+        """
+        :return: dict in the form of {attributeName: MappedColumn}
+        """
+        columns = dict()
+        start = self.sectionOffsets["columns"][0]
+        columnSize = 4 + self.numNodes * (1 + 8)
+        for i in xrange(self.numColumns):
+            columnStart = start + i * columnSize
+            (keyID,) = struct.unpack_from("<I", self.data, columnStart)
+            columns[self.getString(keyID)] = MappedColumn(self, columnStart + 4)
+        return columns
+
+    def readEdgeData(self):
+        edgeData = []
+        position = self.sectionOffsets["edgeData"][0]
+        entrySize = struct.calcsize("<IBq")
+        for _ in xrange(self.numEdgeData):
+            (count,) = struct.unpack_from("<I", self.data, position)
+            position = position + 4
+            data = []
+            for _ in xrange(count):
+                (keyID, valueType, value) = struct.unpack_from("<IBq", self.data, position)
+                position = position + entrySize
+                data.append((self.getString(keyID), self.decodeValue(valueType, value)))
+            edgeData.append(tuple(data))
+        return edgeData
+
+    def readOffsets(self):
+        return array("l", self.readSection("offsets", PackageGraphFile.int64))
+
+    def readTargets(self):
+        return array("l", self.readSection("targets", PackageGraphFile.uint32))
+
+    def readEdgeAttrs(self):
+        return array("l", self.readSection("edgeAttrs", PackageGraphFile.uint32))
+
+
+class MappedColumn:
+    """
+        Node attribute column of a PackageGraphFile, values are decoded on access
+    """
+    def __init__(self, graphFile, start):
+        self.graphFile = graphFile
+        self.typesStart = start
+        self.valuesStart = start + graphFile.numNodes
+        self.types = None
+        self.values = None
+
+    def load(self):
+        if self.types is None:
+            self.types = bytearray(self.graphFile.data[self.typesStart:self.valuesStart])
+            self.values = self.graphFile.readArray(PackageGraphFile.int64, self.valuesStart, self.graphFile.numNodes)
+
+    def __len__(self):
+        return self.graphFile.numNodes
+
+    def __getitem__(self, nodeID):
+        self.load()
+        return self.graphFile.decodeValue(self.types[nodeID], self.values[nodeID])
+
+    def __iter__(self):
+        self.load()
+        for (valueType, value) in zip(self.types, self.values):
+            yield self.graphFile.decodeValue(valueType, value)
@@ -0,0 +1,133 @@
+from collections import defaultdict
+
+
+class PackageNameIndex:
+    """
+        Trigram index over package names, used to suggest packages for mistyped names.
+        Every name is split into its trigrams (substrings of length 3, including the start and end of the name marked by
+        "^" and "$"), the index maps each trigram to the IDs of the names containing it. Names sharing enough trigrams with a query are candidates, which are then ranked by
+        edit distance to the query. Names can have owners (e.g. the VMIs containing a package).
+    """
+    gramLength = 3
+
+    def __init__(self, names=()):
+        self.names = []         # in the form of [name], position is the ID of a name
+        self.nameIDs = dict()   # in the form of {name: ID}
+        self.owners = []        # in the form of [set(owner)], by name ID
+        self.postings = defaultdict(list)  # in the form of {trigram: [name IDs in ascending order]}
+        self.lengths = defaultdict(list)   # in the form of {length: [name IDs]}
+        for name in names:
+            self.add(name)
+
+    @staticmethod
+    def getGrams(name, marked=False):
+        if marked:
+            name = "^" + name + "$"
+        return set(name[i:i + PackageNameIndex.gramLength] for i in xrange(len(name) - PackageNameIndex.gramLength + 1))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.nameIDs
+
+    def add(self, name, owner=None):
+        if name not in self.nameIDs:
+            nameID = len(self.names)
+            self.nameIDs[name] = nameID
+            self.names.append(name)
+            self.owners.append(set())
+            self.lengths[len(name)].append(nameID)
+            for gram in PackageNameIndex.getGrams(name, marked=True):
+                self.postings[gram].append(nameID)
+        if owner is not None:
+            self.owners[self.nameIDs[name]].add(owner)
+
+    def getOwners(self, name):
+        if name not in self.nameIDs:
+            return set()
+        return self.owners[self.nameIDs[name]]
+
+    def countSharedGrams(self, grams):
+        """
+        :return: dict in the form of {name ID: number of trigrams shared with grams}
+        """
+        counts = defaultdict(int)
+        for gram in grams:
+            for nameID in self.postings.get(gram, ()):
+                counts[nameID] = counts[nameID] + 1
+        return counts
+
+    def getNamesContaining(self, query):
+        """
+            Same result as a substring scan over all names, only names containing every trigram of query are compared
+        :return: list of names in the order they were added
+        """
+        grams = PackageNameIndex.getGrams(query)
+        if len(grams) == 0:
+            # query shorter than a trigram
+            return [name for name in self.names if query in name]
+        candidates = None
+        for gram in sorted(grams, key=lambda gram: len(self.postings.get(gram, ()))):
+            if candidates is None:
+                candidates = set(self.postings.get(gram, ()))
+            else:
+                candidates.intersection_update(self.postings.get(gram, ()))
+            if len(candidates) == 0:
+                return []
+        return [self.names[nameID] for nameID in sorted(candidates) if query in self.names[nameID]]
+
+    def getSimilarNames(self, query, maxResults=10, maxDistance=None):
+        """
+            Names containing query and names within maxDistance edits of query (typos), closest names first
+        :param int maxDistance: defaults to a third of the length of query, at least 1
+        :return: list of names
+        """
+        if maxDistance is None:
+            maxDistance = max(1, len(query) // 3)
+        ranked = [(len(name) - len(query), name) for name in self.getNamesContaining(query)]
+        # an edit changes at most gramLength+1 trigrams (transpositions), names within maxDistance share at least
+        # minSharedGrams trigrams with query
+        grams = PackageNameIndex.getGrams(query, marked=True)
+        minSharedGrams = len(grams) - maxDistance * (PackageNameIndex.gramLength + 1)
+        if minSharedGrams > 0:
+            candidates = [nameID for (nameID, count) in self.countSharedGrams(grams).iteritems()
+                          if count >= minSharedGrams]
+        else:
+            # short query, typos may share no trigram at all (e.g. "pma" and "pam"), names of similar length are compared
+            candidates = [nameID for length in xrange(len(query) - maxDistance, len(query) + maxDistance + 1)
+                          for nameID in self.lengths.get(length, ())]
+        for nameID in candidates:
+            name = self.names[nameID]
+            if abs(len(name) - len(query)) <= maxDistance and query not in name:
+                distance = PackageNameIndex.getEditDistance(query, name, maxDistance)
+                if distance <= maxDistance:
+                    ranked.append((distance, name))
+        ranked.sort()
+        return [name for (_, name) in ranked[:maxResults]]
+
+    @staticmethod
+    def getEditDistance(name1, name2, maxDistance):
+        """
+            Edit distance counting insertions, deletions, substitutions and transpositions of adjacent characters
+            (common typos) as one edit each, computation stops once it exceeds maxDistance
+        :return: distance or maxDistance+1
+        """
+        if abs(len(name1) - len(name2)) > maxDistance:
+            return maxDistance + 1
+        beforePrevious = None
+        previous = range(len(name2) + 1)
+        for (i, char1) in enumerate(name1, 1):
+            current = [i]
+            for (j, char2) in enumerate(name2, 1):
+                distance = min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char1 != char2))
+                if i > 1 and j > 1 and char1 == name2[j - 2] and name1[i - 2] == char2:
+                    distance = min(distance, beforePrevious[j - 2] + 1)
+                current.append(distance)
+            if min(current) > maxDistance:
+                return maxDistance + 1
+            beforePrevious = previous
+            previous = current
+        return min(previous[-1], maxDistance + 1)
@@ -0,0 +1,85 @@
+import errno
+import hashlib
+import os
+import subprocess
+
+from StaticInfo import StaticInfo
+
+
+class PackageStore:
+    """
+        Content-addressed storage of package files, every distinct file content is stored once.
+        Blobs are named by the sha256 of their content (StaticInfo.relPathLocalRepositoryPackageBlobs/ab/abcdef...),
+        the package folders of the distributions (e.g. packages/ubuntu/pkg.deb) are views, in the form of hard links
+        to the blobs (reflinks or copies if the file system does not support hard links).
+        Which view belongs to which blob and how many views a blob has is kept in the repository database
+        (see RepositoryDatabase.storePackageFiles).
+    """
+    blockSize = 1 << 20
+
+    @staticmethod
+    def getBlobPath(digest):
+        return StaticInfo.relPathLocalRepositoryPackageBlobs + "/" + digest[:2] + "/" + digest
+
+    @staticmethod
+    def hashFile(path):
+        """
+        :return: sha256 of the file content as hex string
+        """
+        sha = hashlib.sha256()
+        with open(path, "rb") as packageFile:
+            for block in iter(lambda: packageFile.read(PackageStore.blockSize), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def isLinked(path, digest):
+        try:
+            return os.path.samefile(path, PackageStore.getBlobPath(digest))
+        except OSError:
+            return False
+
+    @staticmethod
+    def addFile(path):
+        """
+            Moves the content of a package file into the store, the file is replaced by a view of its blob.
+            Files with the same content as an existing blob are dropped.
+        :return: tuple in the form of (digest, size)
+        """
+        digest = PackageStore.hashFile(path)
+        blobPath = PackageStore.getBlobPath(digest)
+        if not os.path.isfile(blobPath):
+            if not os.path.isdir(os.path.dirname(blobPath)):
+                try:
+                    os.makedirs(os.path.dirname(blobPath))
+                except OSError as e:
+                    # created by another process in the meantime
+                    if e.errno != errno.EEXIST:
+                        raise
+            PackageStore.linkFile(path, blobPath)
+        elif not PackageStore.isLinked(path, digest):
+            PackageStore.linkFile(blobPath, path)
+        return (digest, os.path.getsize(blobPath))
+
+    @staticmethod
+    def linkView(digest, path):
+        """
+            (Re)creates the view of a blob at path, a file at path is replaced
+        """
+        if not PackageStore.isLinked(path, digest):
+            PackageStore.linkFile(PackageStore.getBlobPath(digest), path)
+
+    @staticmethod
+    def linkFile(source, target):
+        """
+            Hard link (or reflink, copy as last resort) from source to target, an existing target is replaced in one step
+        """
+        tmpPath = "%s.%i.link.tmp" % (target, os.getpid())
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        try:
+            os.link(source, tmpPath)
+        except OSError:
+            # e.g. file system without hard links, shares the blocks of source where supported (btrfs, xfs)
+            subprocess.check_call(["cp", "--reflink=auto", source, tmpPath])
+        os.rename(tmpPath, target)
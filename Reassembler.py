@@ -116,14 +116,14 @@ class Reassembler:
         reqPkgsSize = 0
 
         # Filter which packages already exist in VMI
-        vmiPackageDict = baseImage.getNodeData()
+        vmiPackageIndex = baseImage.getPackageIndex()
         reqPackagesFileNames = list()
 
         for pkgName,pkgInfo in packageInfoDict.iteritems():
             if not (
-                    pkgName in vmiPackageDict and
-                    vmiPackageDict[pkgName][StaticInfo.dictKeyVersion] == pkgInfo[StaticInfo.dictKeyVersion] and
-                    vmiPackageDict[pkgName][StaticInfo.dictKeyArchitecture] == pkgInfo[StaticInfo.dictKeyArchitecture]
+                    pkgName in vmiPackageIndex and
+                    vmiPackageIndex[pkgName][0] == pkgInfo[StaticInfo.dictKeyVersion] and
+                    vmiPackageIndex[pkgName][1] == pkgInfo[StaticInfo.dictKeyArchitecture]
                 ):
                 reqPackagesFileNames.append(pkgInfo[StaticInfo.dictKeyFilePath])
                 reqPkgsSize = reqPkgsSize + int(pkgInfo[StaticInfo.dictKeyInstallSize])
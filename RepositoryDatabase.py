@@ -4,10 +4,29 @@ import shutil
 import sqlite3
 from collections import defaultdict
 
+import numpy as np
+
+from BloomFilter import BloomFilter
+from MasterGraphLog import MasterGraphLog
+from MinHash import MinHash
+from PackageGraph import PackageGraph
+from PackageNameIndex import PackageNameIndex
+from PackageStore import PackageStore
 from StaticInfo import StaticInfo
 from VMIDescription import BaseImageDescriptor, VMIMasterDescriptor
 
 class RepositoryDatabase:
+    # entity types of package signatures (see MinHash)
+    signatureMaster = "master"          # main service subtrees of the master graph
+    signatureBaseImage = "baseImage"    # all packages of the base image
+    signatureVMI = "vmi"                # main services and their dependencies
+    # package names of all VMIs, in the form of (database modification time, PackageNameIndex)
+    packageNameIndexCache = None
+    # packages in the repository, in the form of (database modification time, BloomFilter), see resolvePackages
+    packageFilterCache = None
+    # key of the new base image in getBaseImageCompatibilities, IDs of stored base images start at 1
+    newBaseImageKey = 0
+
     def __init__(self,forceNew=False):
         self.dbFile = StaticInfo.relPathLocalRepositoryDatabase
         self.forceNew = forceNew
@@ -28,12 +47,19 @@ class RepositoryDatabase:
             self.db = sqlite3.connect(self.dbFile)
             self.cursor = self.db.cursor()
             self.initDB()
+        self.initPackageRepositoryIndex()
+        self.initBaseImagePackagesTable()
+        self.initSignatureTables()
+        self.initSimilarityCacheTable()
+        self.initPackageStoreTables()
         return self
 
     def __exit__(self, *args):
         self.db.close()
 
     def initDB(self):
+        # created before the basic packages are added (see addPackageDict)
+        self.initPackageStoreTables()
         self.cursor.execute('''
             CREATE TABLE PackageRepository(
               pkgID         INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -76,6 +102,152 @@ class RepositoryDatabase:
         self.db.commit()
         self.addPackageDict(StaticInfo.basicPackagesDictFedora, "fedora")
 
+    def initPackageRepositoryIndex(self):
+        # added after the initial schema, created in existing databases on first use
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS PackageRepositoryIndex
+            ON PackageRepository(name, version, architecture, distribution)
+        ''')
+        self.db.commit()
+
+    def initBaseImagePackagesTable(self):
+        # added after the initial schema, created in existing databases on first use
+        # inverted index from package names to the base images they are installed in
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS BaseImagePackages(
+                baseID        INTEGER NOT NULL,
+                name          TEXT    NOT NULL,
+                version       TEXT    NOT NULL,
+                architecture  TEXT    NOT NULL,
+                installsize   INTEGER NOT NULL,
+                FOREIGN KEY(baseID) REFERENCES baseImageRepository(baseID));
+        ''')
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS BaseImagePackagesNameIndex
+            ON BaseImagePackages(name, version, architecture, baseID)
+        ''')
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS BaseImagePackagesBaseIndex
+            ON BaseImagePackages(baseID)
+        ''')
+        self.db.commit()
+
+    def initSignatureTables(self):
+        # added after the initial schema, created in existing databases on first use
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS PackageSignatures(
+                entityType    TEXT    NOT NULL,
+                entityID      INTEGER NOT NULL,
+                signature     BLOB    NOT NULL,
+                PRIMARY KEY(entityType, entityID));
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS PackageSignatureBuckets(
+                entityType    TEXT    NOT NULL,
+                entityID      INTEGER NOT NULL,
+                band          INTEGER NOT NULL,
+                bucket        INTEGER NOT NULL);
+        ''')
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS PackageSignatureBucketsIndex
+            ON PackageSignatureBuckets(entityType, band, bucket)
+        ''')
+        # master signatures of databases created before signatures of all entity types were stored
+        self.cursor.execute('''
+            SELECT name
+            FROM sqlite_master
+            WHERE type = 'table' AND name = 'MasterSignatures'
+        ''')
+        if len(self.cursor.fetchall()) > 0:
+            # only masters that still exist and were not given a signature since (the old tables were not updated)
+            migrated = '''
+                SELECT baseID
+                FROM MasterSignatures
+                WHERE baseID IN (SELECT baseID FROM baseImageRepository)
+                AND baseID NOT IN (SELECT entityID FROM PackageSignatures WHERE entityType = ?)
+            '''
+            self.cursor.execute('''
+                INSERT INTO PackageSignatureBuckets (entityType, entityID, band, bucket)
+                SELECT ?, baseID, band, bucket
+                FROM MasterSignatureBuckets
+                WHERE baseID IN (''' + migrated + ''')
+                ''', (RepositoryDatabase.signatureMaster, RepositoryDatabase.signatureMaster)
+            )
+            self.cursor.execute('''
+                INSERT INTO PackageSignatures (entityType, entityID, signature)
+                SELECT ?, baseID, signature
+                FROM MasterSignatures
+                WHERE baseID IN (''' + migrated + ''')
+                ''', (RepositoryDatabase.signatureMaster, RepositoryDatabase.signatureMaster)
+            )
+            self.cursor.execute("DROP TABLE MasterSignatureBuckets")
+            self.cursor.execute("DROP TABLE MasterSignatures")
+        self.db.commit()
+
+    def initSimilarityCacheTable(self):
+        # added after the initial schema, created in existing databases on first use
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS SimilarityCache(
+                fingerprint1        TEXT    NOT NULL,
+                fingerprint2        TEXT    NOT NULL,
+                onlyOnMainServices  INTEGER NOT NULL,
+                similarity          REAL    NOT NULL,
+                PRIMARY KEY(fingerprint1, fingerprint2, onlyOnMainServices));
+        ''')
+        self.db.commit()
+
+    def initPackageStoreTables(self):
+        # added after the initial schema, created in existing databases on first use
+        # blobs of the package store in the form of sha256 of the content (see PackageStore),
+        # the package files linked to a blob are the rows of PackageFiles with its digest
+        self.cursor.execute('''
+            SELECT name
+            FROM sqlite_master
+            WHERE type = 'table' AND name IN ('PackageRepository', 'PackageFiles')
+        ''')
+        existingTables = set(row[0] for row in self.cursor.fetchall())
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS PackageBlobs(
+                digest        TEXT    PRIMARY KEY,
+                size          INTEGER NOT NULL);
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS PackageFiles(
+                filename      TEXT    PRIMARY KEY,
+                digest        TEXT    NOT NULL,
+                FOREIGN KEY(digest) REFERENCES PackageBlobs(digest));
+        ''')
+        # reference counts of the first version of the table were redundant to PackageFiles
+        self.cursor.execute("PRAGMA table_info(PackageBlobs)")
+        if "refcount" in [row[1] for row in self.cursor.fetchall()]:
+            self.cursor.execute("ALTER TABLE PackageBlobs RENAME TO PackageBlobsRefcount")
+            self.cursor.execute('''
+                CREATE TABLE PackageBlobs(
+                    digest        TEXT    PRIMARY KEY,
+                    size          INTEGER NOT NULL);
+            ''')
+            self.cursor.execute('''
+                INSERT INTO PackageBlobs (digest, size)
+                SELECT digest, size
+                FROM PackageBlobsRefcount
+            ''')
+            self.cursor.execute("DROP TABLE PackageBlobsRefcount")
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS PackageFilesDigestIndex
+            ON PackageFiles(digest)
+        ''')
+        self.db.commit()
+
+        # package files of repositories created before the package store are moved into it once
+        if "PackageRepository" in existingTables and "PackageFiles" not in existingTables:
+            self.cursor.execute('''
+                SELECT DISTINCT filename
+                FROM PackageRepository
+            ''')
+            filenames = [row[0] for row in self.cursor.fetchall() if os.path.isfile(row[0])]
+            print "Moving %i package files of the repository into the package store..." % len(filenames)
+            self.storePackageFiles(filenames)
+
     def initRepo(self):
         if os.path.exists(StaticInfo.relPathLocalRepository):
             shutil.rmtree(StaticInfo.relPathLocalRepository)
@@ -174,6 +346,85 @@ class RepositoryDatabase:
                 "\tsolve manually!")
             return result[0][0]
 
+    @staticmethod
+    def getPackageKey(pkgName, version, arch, distribution):
+        return ";".join(part.encode("utf-8") if isinstance(part, unicode) else str(part)
+                        for part in (pkgName, version, arch, distribution))
+
+    def getPackageFilter(self):
+        """
+            Bloom filter over all packages in the repository, rebuilt when the database was changed by others
+        :rtype: BloomFilter
+        """
+        modificationTime = os.path.getmtime(self.dbFile)
+        if (RepositoryDatabase.packageFilterCache is not None
+                and RepositoryDatabase.packageFilterCache[0] == modificationTime):
+            return RepositoryDatabase.packageFilterCache[1]
+
+        self.cursor.execute('''
+            SELECT name, version, architecture, distribution
+            FROM PackageRepository
+        ''')
+        result = self.cursor.fetchall()
+        packageFilter = BloomFilter(max(StaticInfo.packageFilterMinCapacity, 2 * len(result)),
+                                    StaticInfo.packageFilterFalsePositiveRate)
+        for row in result:
+            packageFilter.add(RepositoryDatabase.getPackageKey(*row))
+
+        RepositoryDatabase.packageFilterCache = (modificationTime, packageFilter)
+        return packageFilter
+
+    def resolvePackages(self, packages, distribution):
+        """
+            Bulk version of getPackageID, all packages are resolved in a single join.
+            With StaticInfo.packageFilterEnabled, packages not in the Bloom filter are not looked up.
+        :param packages: iterable in the form of [(pkgName, version, architecture)]
+        :param distribution:
+        :return: dict in the form of {(pkgName, version, architecture): pkgID}, only for packages that exist
+        """
+        if StaticInfo.packageFilterEnabled:
+            packageFilter = self.getPackageFilter()
+            candidates = set(package for package in packages
+                             if RepositoryDatabase.getPackageKey(package[0], package[1], package[2], distribution)
+                             in packageFilter)
+        else:
+            candidates = set(packages)
+        if len(candidates) == 0:
+            return dict()
+
+        # joined with a temporary table, the number of parameters of a query is limited
+        self.cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS RequestedPackages(
+                name          TEXT    NOT NULL,
+                version       TEXT    NOT NULL,
+                architecture  TEXT    NOT NULL)
+        ''')
+        self.cursor.execute("DELETE FROM RequestedPackages")
+        self.cursor.executemany('''
+            INSERT INTO RequestedPackages (name, version, architecture)
+            VALUES (?,?,?)
+            ''', candidates
+        )
+        self.cursor.execute('''
+            SELECT req.name, req.version, req.architecture, MIN(pkg.pkgID), COUNT(*)
+            FROM RequestedPackages req
+            JOIN PackageRepository pkg
+              ON pkg.name = req.name
+              AND pkg.version = req.version
+              AND pkg.architecture = req.architecture
+              AND pkg.distribution = ?
+            GROUP BY req.name, req.version, req.architecture
+            ''', (distribution,)
+        )
+        pkgIDs = dict()
+        for (pkgName, version, arch, pkgID, count) in self.cursor.fetchall():
+            if count > 1:
+                print("ERROR in database: multiple packages with same name, version and distribution exist:\n" \
+                    "\tSearch for name=" + pkgName + ", version=" + version + ", architecture="+arch+", distribution=" + distribution + "\n" \
+                    "\tsolve manually!")
+            pkgIDs[(pkgName, version, arch)] = pkgID
+        return pkgIDs
+
     def getPackageFileNameFromID(self,pkgID):
         self.cursor.execute('''
             SELECT filename FROM PackageRepository
@@ -217,6 +468,7 @@ class RepositoryDatabase:
             return result[0][0]
 
     def addPackageDict(self, packageInfoDict, distribution):
+        modificationTime = os.path.getmtime(self.dbFile)
         packageInfoList = [(
             pkgInfo[StaticInfo.dictKeyName],
             pkgInfo[StaticInfo.dictKeyVersion],
@@ -225,12 +477,73 @@ class RepositoryDatabase:
             pkgInfo[StaticInfo.dictKeyInstallSize],
             pkgInfo[StaticInfo.dictKeyFilePath]
         ) for pkg,pkgInfo in packageInfoDict.iteritems()]
+        self.storePackageFiles(pkgInfo[5] for pkgInfo in packageInfoList)
         self.cursor.executemany('''
                       INSERT INTO PackageRepository(name, version, architecture, distribution, installsize, filename)
                       VALUES(?,?,?,?,?,?)
                   ''', packageInfoList)
         self.db.commit()
 
+        # keep the Bloom filter up to date unless the database was changed by others in the meantime
+        if (RepositoryDatabase.packageFilterCache is not None
+                and RepositoryDatabase.packageFilterCache[0] == modificationTime):
+            packageFilter = RepositoryDatabase.packageFilterCache[1]
+            for pkgInfo in packageInfoList:
+                packageFilter.add(RepositoryDatabase.getPackageKey(*pkgInfo[:4]))
+            if packageFilter.isFull():
+                RepositoryDatabase.packageFilterCache = None
+            else:
+                RepositoryDatabase.packageFilterCache = (os.path.getmtime(self.dbFile), packageFilter)
+
+    def storePackageFiles(self, filenames):
+        """
+            Moves package files into the package store (see PackageStore), identical files are stored once.
+            Files that were stored before are linked to their blob again
+            (e.g. replaced by a VMI that exported the same package at the same time).
+        :param filenames: paths of package files in the package folders of the distributions
+        """
+        for filename in filenames:
+            self.cursor.execute('''
+                SELECT digest FROM PackageFiles
+                WHERE filename=?''',
+                (filename,)
+            )
+            result = self.cursor.fetchall()
+            if len(result) > 0:
+                PackageStore.linkView(result[0][0], filename)
+            elif not os.path.isfile(filename):
+                print "ERROR in Repository: package file \"%s\" not found, not added to package store" % filename
+            else:
+                (digest, size) = PackageStore.addFile(filename)
+                self.cursor.execute('''
+                    INSERT OR IGNORE INTO PackageBlobs (digest, size)
+                    VALUES (?,?)''',
+                    (digest, size)
+                )
+                self.cursor.execute('''
+                    INSERT INTO PackageFiles (filename, digest)
+                    VALUES (?,?)''',
+                    (filename, digest)
+                )
+        self.db.commit()
+
+    def getPackageStoreSize(self):
+        """
+        :return: tuple in the form of (size of all package files, size of the distinct blobs)
+        """
+        self.cursor.execute('''
+            SELECT COALESCE(SUM(blob.size), 0)
+            FROM PackageFiles file
+            JOIN PackageBlobs blob ON blob.digest = file.digest
+        ''')
+        (filesSize,) = self.cursor.fetchone()
+        self.cursor.execute('''
+            SELECT COALESCE(SUM(size), 0)
+            FROM PackageBlobs
+        ''')
+        (blobsSize,) = self.cursor.fetchone()
+        return (filesSize, blobsSize)
+
     def getBaseImageId(self, filename):
         self.cursor.execute('''
             SELECT baseID FROM baseImageRepository
@@ -260,8 +573,11 @@ class RepositoryDatabase:
                              baseImage.graphFileName,
                              masterGraphPath))
         self.db.commit()
+        baseID = self.getBaseImageId(baseImage.pathToVMI)
+        self.setBaseImagePackages(baseID, baseImage)
+        self.setBaseImageSignature(baseID, baseImage)
         # Return id
-        return self.getBaseImageId(baseImage.pathToVMI)
+        return baseID
 
     def removeBaseImage(self, baseID):
         self.cursor.execute('''
@@ -270,8 +586,362 @@ class RepositoryDatabase:
             WHERE baseID = ? 
             ''', (baseID,)
         )
+        self.cursor.execute('''
+            DELETE
+            FROM BaseImagePackages
+            WHERE baseID = ?
+            ''', (baseID,)
+        )
+        for entityType in (RepositoryDatabase.signatureMaster, RepositoryDatabase.signatureBaseImage):
+            self.removeSignature(entityType, baseID)
         self.db.commit()
 
+    def setBaseImagePackages(self, baseID, baseImage):
+        self.cursor.execute('''
+            DELETE
+            FROM BaseImagePackages
+            WHERE baseID = ?
+            ''', (baseID,)
+        )
+        self.cursor.executemany('''
+            INSERT INTO BaseImagePackages (baseID, name, version, architecture, installsize)
+            VALUES (?,?,?,?,?)
+            ''', [(baseID, pkgName, version, arch, installSize)
+                   for (pkgName, (version, arch, installSize)) in baseImage.getPackageIndex().iteritems()]
+        )
+        self.db.commit()
+
+    def updateMissingBaseImagePackages(self, distribution, version, architecture, pkgManager):
+        """
+            Adds the packages of base images stored before BaseImagePackages existed
+        """
+        self.cursor.execute('''
+            SELECT baseID
+            FROM baseImageRepository
+            WHERE distribution = ?
+                AND version = ?
+                AND architecture = ?
+                AND pkgManager = ?
+                AND baseID NOT IN (SELECT DISTINCT baseID FROM BaseImagePackages)
+            ''', (distribution, version, architecture, pkgManager)
+        )
+        for baseID in [int(row[0]) for row in self.cursor.fetchall()]:
+            self.setBaseImagePackages(baseID, self.getBaseImageFromID(baseID))
+
+    def updateAllMissingBaseImagePackages(self):
+        """
+            updateMissingBaseImagePackages for the base images of all distributions
+        """
+        self.cursor.execute('''
+            SELECT DISTINCT distribution, version, architecture, pkgManager
+            FROM baseImageRepository
+        ''')
+        for distributionInfo in self.cursor.fetchall():
+            self.updateMissingBaseImagePackages(*distributionInfo)
+
+    def getBaseImageCompatibilities(self, newBaseImage, newMSPackages, updateMissing=True):
+        """
+            Compatibilities between the new base image and all stored base images with the same distribution, version,
+            architecture and package manager. Base image B1 is compatible with B2 if the main services of B2 (and their
+            dependencies) can be used in B1, i.e. every package installed in B1 that is required by B2 has the same
+            version and a matching architecture (see BaseImageDescriptor.checkCompatibilityForPackages).
+            Conflicts are found in a single join of the required packages with BaseImagePackages,
+            no graphs of stored base images are loaded.
+        :param BaseImageDescriptor newBaseImage:
+        :param dict newMSPackages: in the form of dict(MS1:MS1Info,dep1:dep1Info...)
+        :param updateMissing: add the packages of base images stored before BaseImagePackages existed first,
+                              the only write to the database (see updateMissingBaseImagePackages)
+        :return: (compatibilities, installSizes)
+                    compatibilities:    dict in the form of {B1: set(B2)}, every base image is compatible with itself
+                    installSizes:       dict in the form of {B1: sum of install sizes of all packages}
+                 with base images as baseIDs, RepositoryDatabase.newBaseImageKey for the new base image
+        """
+        distributionInfo = (newBaseImage.distribution, newBaseImage.distributionVersion,
+                            newBaseImage.architecture, newBaseImage.pkgManager)
+        if updateMissing:
+            self.updateMissingBaseImagePackages(*distributionInfo)
+        newKey = RepositoryDatabase.newBaseImageKey
+
+        baseIDs = self.getBaseImageIDsWith(*distributionInfo)
+        installSizes = dict((baseID, 0) for baseID in baseIDs)
+        self.cursor.execute('''
+            SELECT bp.baseID, SUM(bp.installsize)
+            FROM BaseImagePackages bp
+            JOIN baseImageRepository base ON base.baseID = bp.baseID
+            WHERE base.distribution = ?
+                AND base.version = ?
+                AND base.architecture = ?
+                AND base.pkgManager = ?
+            GROUP BY bp.baseID
+            ''', distributionInfo
+        )
+        for row in self.cursor.fetchall():
+            installSizes[int(row[0])] = int(row[1])
+        installSizes[newKey] = int(newBaseImage.getPkgsInstallSize())
+
+        # packages required by the main services of each base image, in the form of (baseID, name, version, arch)
+        self.cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS RequiredPackages(
+                baseID        INTEGER NOT NULL,
+                name          TEXT    NOT NULL,
+                version       TEXT    NOT NULL,
+                architecture  TEXT    NOT NULL)
+        ''')
+        self.cursor.execute("DELETE FROM RequiredPackages")
+        self.cursor.execute('''
+            INSERT INTO RequiredPackages (baseID, name, version, architecture)
+            SELECT DISTINCT vmi.baseImageID, pkg.name, pkg.version, pkg.architecture
+            FROM vmiRepository vmi
+            JOIN baseImageRepository base ON base.baseID = vmi.baseImageID
+            JOIN PackageDependencies dep ON dep.vmiID = vmi.vmiID
+            JOIN PackageRepository pkg ON pkg.pkgID IN (dep.pkgID, dep.deppkgID)
+            WHERE base.distribution = ?
+                AND base.version = ?
+                AND base.architecture = ?
+                AND base.pkgManager = ?
+            ''', distributionInfo
+        )
+        self.cursor.executemany('''
+            INSERT INTO RequiredPackages (baseID, name, version, architecture)
+            VALUES (?,?,?,?)
+            ''', [(newKey, pkgName, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture])
+                   for (pkgName, pkgInfo) in (newMSPackages or dict()).iteritems()]
+        )
+
+        # in the form of {name: {(version, architecture): [positions of base images]}}
+        baseImages = sorted(installSizes.iterkeys())
+        positions = dict((baseImage, position) for (position, baseImage) in enumerate(baseImages))
+        required = defaultdict(lambda: defaultdict(list))
+        self.cursor.execute('''
+            SELECT baseID, name, version, architecture
+            FROM RequiredPackages
+        ''')
+        for (baseID, pkgName, version, arch) in self.cursor.fetchall():
+            required[pkgName][(version, arch)].append(positions[baseID])
+        installed = defaultdict(lambda: defaultdict(list))
+        # answered from the index alone, base images of other distributions are skipped afterwards
+        self.cursor.execute('''
+            SELECT name, version, architecture, group_concat(baseID)
+            FROM BaseImagePackages
+            WHERE name IN (SELECT name FROM RequiredPackages)
+            GROUP BY name, version, architecture
+        ''')
+        for (pkgName, version, arch, baseIDs) in self.cursor.fetchall():
+            installing = [positions[baseID] for baseID in map(int, baseIDs.split(",")) if baseID in positions]
+            if len(installing) > 0:
+                installed[pkgName][(version, arch)] = installing
+        # new base image, its packages are only known in memory
+        packageIndex = newBaseImage.getPackageIndex()
+        for pkgName in required.iterkeys():
+            if pkgName in packageIndex:
+                (version, arch, _) = packageIndex[pkgName]
+                installed[pkgName][(version, arch)].append(positions[newKey])
+
+        # conflicts[i][j] = True -> base image j requires a package that is installed in base image i
+        # with another version or architecture, one block per required package instead of one check per pair
+        conflicts = np.zeros((len(baseImages), len(baseImages)), dtype=np.bool_)
+        for (pkgName, requiredVersions) in required.iteritems():
+            for ((version, arch), requiring) in requiredVersions.iteritems():
+                conflicting = [position
+                               for ((installedVersion, installedArch), installing) in installed[pkgName].iteritems()
+                               if not (installedVersion == version
+                                       and (installedArch == arch or installedArch == "all" or arch == "all"))
+                               for position in installing]
+                if len(conflicting) > 0:
+                    conflicts[np.ix_(conflicting, requiring)] = True
+        np.fill_diagonal(conflicts, False)
+
+        compatibilities = dict((baseImage, set(baseImages[position] for position in np.flatnonzero(~conflicts[i])))
+                               for (i, baseImage) in enumerate(baseImages))
+        return (compatibilities, installSizes)
+
+    def getSignature(self, entityType, entityID):
+        """
+        :param entityType: one of RepositoryDatabase.signatureMaster, signatureBaseImage or signatureVMI
+        :return: MinHash signature or None
+        """
+        self.cursor.execute('''
+            SELECT signature
+            FROM PackageSignatures
+            WHERE entityType = ? AND entityID = ?
+            ''', (entityType, entityID)
+        )
+        result = self.cursor.fetchall()
+        if len(result) == 1:
+            return MinHash.fromBlob(result[0][0])
+        else:
+            return None
+
+    def getSignatures(self, entityType, entityIDs=None):
+        """
+        :return: dict in the form of {entityID: signature}, for all entities of entityType by default
+        """
+        if entityIDs is None:
+            self.cursor.execute('''
+                SELECT entityID, signature
+                FROM PackageSignatures
+                WHERE entityType = ?
+                ''', (entityType,)
+            )
+        else:
+            self.cursor.execute('''
+                SELECT entityID, signature
+                FROM PackageSignatures
+                WHERE entityType = ? AND entityID IN (%s)
+                ''' % ",".join(["?"] * len(entityIDs)),
+                [entityType] + list(entityIDs)
+            )
+        return dict((int(row[0]), MinHash.fromBlob(row[1])) for row in self.cursor.fetchall())
+
+    def setSignature(self, entityType, entityID, signature):
+        self.removeSignature(entityType, entityID)
+        self.cursor.execute('''
+            INSERT INTO PackageSignatures (entityType, entityID, signature)
+            VALUES (?,?,?)
+            ''', (entityType, entityID, MinHash.toBlob(signature))
+        )
+        self.cursor.executemany('''
+            INSERT INTO PackageSignatureBuckets (entityType, entityID, band, bucket)
+            VALUES (?,?,?,?)
+            ''', [(entityType, entityID, band, bucket) for (band, bucket) in MinHash.getBuckets(signature)]
+        )
+        self.db.commit()
+
+    def removeSignature(self, entityType, entityID):
+        self.cursor.execute('''
+            DELETE
+            FROM PackageSignatures
+            WHERE entityType = ? AND entityID = ?
+            ''', (entityType, entityID)
+        )
+        self.cursor.execute('''
+            DELETE
+            FROM PackageSignatureBuckets
+            WHERE entityType = ? AND entityID = ?
+            ''', (entityType, entityID)
+        )
+        self.db.commit()
+
+    def getMasterSignature(self, baseID):
+        return self.getSignature(RepositoryDatabase.signatureMaster, baseID)
+
+    def setMasterSignature(self, baseID, signature):
+        self.setSignature(RepositoryDatabase.signatureMaster, baseID, signature)
+
+    def updateMissingSignatures(self):
+        """
+            Computes signatures of entities stored before signatures existed (or before the signature of their type did)
+        """
+        self.cursor.execute('''
+            SELECT baseID
+            FROM baseImageRepository
+            WHERE baseID NOT IN (SELECT entityID FROM PackageSignatures WHERE entityType = ?)
+            ''', (RepositoryDatabase.signatureMaster,)
+        )
+        for baseID in [int(row[0]) for row in self.cursor.fetchall()]:
+            master = self.getVMIMasterDescriptorFromBaseID(baseID)
+            self.setMasterSignature(baseID, master.getMainServicesSignature())
+
+        self.cursor.execute('''
+            SELECT baseID
+            FROM baseImageRepository
+            WHERE baseID NOT IN (SELECT entityID FROM PackageSignatures WHERE entityType = ?)
+            ''', (RepositoryDatabase.signatureBaseImage,)
+        )
+        for baseID in [int(row[0]) for row in self.cursor.fetchall()]:
+            self.setBaseImageSignature(baseID, self.getBaseImageFromID(baseID))
+
+        self.cursor.execute('''
+            SELECT vmiID
+            FROM vmiRepository
+            WHERE vmiID NOT IN (SELECT entityID FROM PackageSignatures WHERE entityType = ?)
+            ''', (RepositoryDatabase.signatureVMI,)
+        )
+        for vmiID in [int(row[0]) for row in self.cursor.fetchall()]:
+            self.setVmiSignature(vmiID)
+
+    def setBaseImageSignature(self, baseID, baseImage):
+        self.setSignature(RepositoryDatabase.signatureBaseImage, baseID,
+                          MinHash.getSignature(MinHash.getTokens(baseImage.getPackageIndex())))
+
+    def setVmiSignature(self, vmiID):
+        """
+            Signature of the main services and their dependencies, the packages of the base image are added
+            when VMIs are compared (see getNearest), as VMIs can be moved to other base images
+        """
+        self.cursor.execute('''
+            SELECT DISTINCT pkg.name, pkg.version
+            FROM PackageDependencies dep
+            JOIN PackageRepository pkg ON pkg.pkgID = dep.pkgID OR pkg.pkgID = dep.deppkgID
+            WHERE dep.vmiID = ?
+            ''', (vmiID,)
+        )
+        tokens = ["%s=%s" % (row[0], row[1]) for row in self.cursor.fetchall()]
+        self.setSignature(RepositoryDatabase.signatureVMI, vmiID, MinHash.getSignature(tokens))
+
+    def getMasterCandidates(self, signature, numCandidates):
+        """
+            Masters whose main services are most similar to the packages of signature, estimated by MinHash.
+            Masters sharing an LSH bucket with signature come first, if there are less than numCandidates of them
+            the remaining ones are chosen by their estimated similarity.
+        :return: list of baseIDs, most similar first
+        """
+        self.updateMissingSignatures()
+
+        buckets = MinHash.getBuckets(signature)
+        self.cursor.execute('''
+            SELECT DISTINCT entityID
+            FROM PackageSignatureBuckets
+            WHERE entityType = ? AND (''' + " OR ".join(["(band = ? AND bucket = ?)"] * len(buckets)) + ")",
+            [RepositoryDatabase.signatureMaster] + [value for bucket in buckets for value in bucket]
+        )
+        lshCandidates = [int(row[0]) for row in self.cursor.fetchall()]
+
+        if len(lshCandidates) >= numCandidates:
+            signatures = self.getSignatures(RepositoryDatabase.signatureMaster, lshCandidates)
+        else:
+            signatures = self.getSignatures(RepositoryDatabase.signatureMaster)
+        lshCandidates = set(lshCandidates)
+        ranked = sorted((baseID not in lshCandidates, -MinHash.estimateJaccard(signature, masterSignature), baseID)
+                        for (baseID, masterSignature) in signatures.iteritems())
+        return [baseID for (_, _, baseID) in ranked[:numCandidates]]
+
+    def getNearest(self, signature, k, scope):
+        """
+            Stored entities whose packages are most similar to the packages of signature, estimated by MinHash
+        :param scope: RepositoryDatabase.signatureMaster (signature of main service subtrees),
+                      RepositoryDatabase.signatureBaseImage or RepositoryDatabase.signatureVMI (signature of all packages)
+        :return: list in the form of [(name, estimated similarity)], most similar first
+        """
+        self.updateMissingSignatures()
+        if scope == RepositoryDatabase.signatureVMI:
+            self.cursor.execute('''
+                SELECT vmiID, name, baseImageID
+                FROM vmiRepository
+                '''
+            )
+            entities = [(int(row[0]), str(row[1]), int(row[2])) for row in self.cursor.fetchall()]
+            vmiSignatures = self.getSignatures(RepositoryDatabase.signatureVMI)
+            baseSignatures = self.getSignatures(RepositoryDatabase.signatureBaseImage)
+            # packages of a VMI are the packages of its base image and its main services with dependencies
+            signatures = [MinHash.merge(vmiSignatures[vmiID], baseSignatures[baseID])
+                          for (vmiID, _, baseID) in entities]
+        else:
+            self.cursor.execute('''
+                SELECT baseID, filename
+                FROM baseImageRepository
+                '''
+            )
+            entities = [(int(row[0]), str(row[1])) for row in self.cursor.fetchall()]
+            entitySignatures = self.getSignatures(scope)
+            signatures = [entitySignatures[entity[0]] for entity in entities]
+        if len(entities) == 0:
+            return list()
+
+        estimates = (np.vstack(signatures) == signature).mean(axis=1)
+        nearest = np.argsort(-estimates, kind="mergesort")[:k]
+        return [(entities[i][1], float(estimates[i])) for i in nearest]
+
     def getVmiID(self,vmiName):
         self.cursor.execute('''
             SELECT vmiID FROM vmiRepository
@@ -398,11 +1068,26 @@ class RepositoryDatabase:
             info = [str(col) for col in
                     result[0]]  # -> returns [distribution,version,architecture,pkgManager,filename,masterGraphPath]
             master = VMIMasterDescriptor(info[4])
-            master.initializeMasterFromRepo(info[0], info[1], info[2], info[3], info[5], self.getMainServicesForBaseImage(baseID))
+            master.initializeMasterFromRepo(info[0], info[1], info[2], info[3], info[5], self.getMainServicesForBaseImage(baseID),
+                                            signature=self.getMasterSignature(baseID))
             return master
         else:
             return None
 
+    def getMasterGraphPathFromBaseID(self, baseID):
+        self.cursor.execute('''
+                            SELECT masterGraphPath
+                            FROM baseImageRepository
+                            WHERE baseID = ?
+                            ''',
+                            (baseID,)
+                            )
+        result = self.cursor.fetchall()
+        if len(result) == 1:
+            return str(result[0][0])
+        else:
+            return None
+
     def getVMIMasterDescriptors(self):
         self.cursor.execute('''
                 SELECT baseID
@@ -435,24 +1120,6 @@ class RepositoryDatabase:
         else:
             return None
 
-    def getBaseImagesWithCompatiblePackages(self, distribution, version, architecture, pkgManager):
-        """
-        :param distribution:
-        :param version:
-        :param architecture:
-        :param pkgManager:
-        :return: baseImagesAndCompatiblePackages:
-                    in the form:    dict(base1: MSPackages, base2:...)
-                    MSPackages:     dict(MS1:MS1Info,dep1:dep1Info...)
-                    xInfo:          dict(name:"curl",version:"1.1",...)
-        """
-        baseImageIDs = self.getBaseImageIDsWith(distribution, version, architecture, pkgManager)
-        baseImagesAndCompatiblePackages = dict()
-        for baseID in baseImageIDs:
-            baseImage = self.getBaseImageFromID(baseID)
-            baseImagesAndCompatiblePackages[baseImage] = self.getCompPkgDictForBaseImageID(baseID)
-        return baseImagesAndCompatiblePackages
-
     def getMainServicesForBaseImage(self,baseID):
         self.cursor.execute('''
                     SELECT name
@@ -490,9 +1157,9 @@ class RepositoryDatabase:
                 os.remove(oldBase.graphFileName)
 
             if oldBaseID is not None:
-                masterGraphFileName = self.getVMIMasterDescriptorFromBaseID(oldBaseID).graphFileName
-                if os.path.isfile(masterGraphFileName):
-                    os.remove(masterGraphFileName)
+                masterGraphFileName = self.getMasterGraphPathFromBaseID(oldBaseID)
+                if masterGraphFileName is not None:
+                    MasterGraphLog.remove(masterGraphFileName)
 
                 # update VMIs to use new base image and remove old base image
                 self.updateVMIs(oldBaseID,newBaseID)
@@ -545,34 +1212,34 @@ class RepositoryDatabase:
                 # Note: root is mainservice and part of the dict
         :return:
         """
+        # IDs of all main services and dependencies, resolved at once
+        pkgIDs = self.resolvePackages(
+            [(pkgName, pkgInfo[StaticInfo.dictKeyVersion], pkgInfo[StaticInfo.dictKeyArchitecture])
+             for (_, pkgDict) in mainServicesDepList for (pkgName, pkgInfo) in pkgDict.iteritems()],
+            distribution
+        )
+
         # transform input data into list readable by database connector
         depList = []
-        # format: [(vmiID,pkgID,deppkgName, deppkgVersion, deppkgArch, deppkgDistribution)]
+        # format: [(vmiID,pkgID,deppkgID)]
         for mainServiceName,pkgDict in mainServicesDepList:
-            mainServiceID = self.getPackageID(mainServiceName,
-                                              pkgDict[mainServiceName][StaticInfo.dictKeyVersion],
-                                              pkgDict[mainServiceName][StaticInfo.dictKeyArchitecture],
-                                              distribution)
+            mainServiceID = pkgIDs.get((mainServiceName,
+                                        pkgDict[mainServiceName][StaticInfo.dictKeyVersion],
+                                        pkgDict[mainServiceName][StaticInfo.dictKeyArchitecture]))
             assert(mainServiceID != None)
             for depName,depInfo in pkgDict.iteritems():
                 if depName != mainServiceName:
-                    depList.append((
-                        vmiID,
-                        mainServiceID,
-                        depName,
-                        depInfo[StaticInfo.dictKeyVersion],
-                        depInfo[StaticInfo.dictKeyArchitecture],
-                        distribution
-                    ))
+                    depID = pkgIDs.get((depName,
+                                        depInfo[StaticInfo.dictKeyVersion],
+                                        depInfo[StaticInfo.dictKeyArchitecture]))
+                    assert(depID != None)
+                    depList.append((vmiID, mainServiceID, depID))
         self.cursor.executemany('''
                 INSERT INTO PackageDependencies (vmiID,pkgID, deppkgID)
-                VALUES (?, ?, (SELECT pkgID FROM PackageRepository
-                                WHERE name=?
-                                AND version=?
-                                AND architecture=?
-                                AND distribution=?))
+                VALUES (?, ?, ?)
             ''', (depList))
         self.db.commit()
+        self.setVmiSignature(vmiID)
 
     def getMainServicesForVmiID(self, vmiID):
         self.cursor.execute('''
@@ -832,6 +1499,95 @@ class RepositoryDatabase:
 
         return vmiNames
 
+    def getPackageNameIndex(self):
+        """
+            Index over the packages of all VMIs in the repository (base image packages and main service dependencies),
+            owners are the names of the VMIs containing a package. Rebuilt when the database changes.
+        :rtype: PackageNameIndex
+        """
+        modificationTime = os.path.getmtime(self.dbFile)
+        if (RepositoryDatabase.packageNameIndexCache is not None
+                and RepositoryDatabase.packageNameIndexCache[0] == modificationTime):
+            return RepositoryDatabase.packageNameIndexCache[1]
+
+        index = PackageNameIndex()
+        self.cursor.execute('''
+            SELECT vmi.name, base.graphPath
+            FROM vmiRepository vmi
+            JOIN baseImageRepository base ON base.baseID = vmi.baseImageID
+            '''
+        )
+        vmisForGraph = defaultdict(list)
+        for row in self.cursor.fetchall():
+            vmisForGraph[str(row[1])].append(str(row[0]))
+        for (graphPath, vmiNames) in vmisForGraph.iteritems():
+            if not os.path.isfile(graphPath):
+                print "ERROR in database: graph file \"%s\" does not exist" % graphPath
+                continue
+            # only the names section of the graph file is read
+            for pkgName in PackageGraph.read(graphPath).names:
+                for vmiName in vmiNames:
+                    index.add(pkgName, vmiName)
+        self.cursor.execute('''
+            SELECT DISTINCT vmi.name, pkg.name
+            FROM PackageDependencies dep
+            JOIN vmiRepository vmi ON vmi.vmiID = dep.vmiID
+            JOIN PackageRepository pkg ON pkg.pkgID = dep.deppkgID
+            '''
+        )
+        for row in self.cursor.fetchall():
+            index.add(str(row[1]), str(row[0]))
+
+        RepositoryDatabase.packageNameIndexCache = (modificationTime, index)
+        return index
+
+    def getVmisWithPackagesLike(self, pkgName, maxResults=10):
+        """
+        :return: list in the form of [(pkgName, [vmiName])], packages containing pkgName or similar to it, closest first
+        """
+        index = self.getPackageNameIndex()
+        return [(similarName, sorted(index.getOwners(similarName)))
+                for similarName in index.getSimilarNames(pkgName, maxResults=maxResults)]
+
+    def getCachedSimilarities(self, fingerprints, onlyOnMainServices):
+        """
+        :param fingerprints: package set fingerprints, see VMIDescriptor.getSimilarityFingerprint
+        :return: dict in the form of {(fingerprint1, fingerprint2): similarity} with fingerprint1 <= fingerprint2,
+                 for all cached pairs of fingerprints
+        """
+        # joined with a temporary table, the number of parameters of a query is limited
+        self.cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS RequestedFingerprints(
+                fingerprint   TEXT    PRIMARY KEY)
+        ''')
+        self.cursor.execute("DELETE FROM RequestedFingerprints")
+        self.cursor.executemany('''
+            INSERT OR IGNORE INTO RequestedFingerprints (fingerprint)
+            VALUES (?)
+            ''', [(fingerprint,) for fingerprint in fingerprints]
+        )
+        self.cursor.execute('''
+            SELECT cache.fingerprint1, cache.fingerprint2, cache.similarity
+            FROM SimilarityCache cache
+            JOIN RequestedFingerprints fp1 ON fp1.fingerprint = cache.fingerprint1
+            JOIN RequestedFingerprints fp2 ON fp2.fingerprint = cache.fingerprint2
+            WHERE cache.onlyOnMainServices = ?
+            ''', (int(onlyOnMainServices),)
+        )
+        return dict(((str(row[0]), str(row[1])), float(row[2])) for row in self.cursor.fetchall())
+
+    def addCachedSimilarities(self, similarities, onlyOnMainServices):
+        """
+        :param similarities: dict in the form of {(fingerprint1, fingerprint2): similarity} with fingerprint1 <= fingerprint2
+        """
+        self.cursor.executemany('''
+            INSERT OR REPLACE INTO SimilarityCache (fingerprint1, fingerprint2, onlyOnMainServices, similarity)
+            VALUES (?,?,?,?)
+            ''', [(fingerprint1, fingerprint2, int(onlyOnMainServices), similarity)
+                   for ((fingerprint1, fingerprint2), similarity) in similarities.iteritems()]
+        )
+        self.db.commit()
+
     def getVmiMetaInfo(self, vmiID):
         self.cursor.execute('''
                     SELECT distribution, version, architecture, pkgManager
@@ -0,0 +1,126 @@
+import numpy as np
+
+
+class SimilarityMatrix:
+    """
+        Weighted similarity (see SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors) between many VMIs.
+        Every VMI is encoded once over a global vocabulary of package names. Only installed packages are stored,
+        one entry per package and VMI, sorted by column (compressed sparse columns):
+            entryVMIs       index of the VMI
+            entrySizes      install size of the package
+            entryVersions   ID of the installed version
+            entryArchs      ID of the architecture
+            entryCompared   package is compared (installed, or part of the main service subtrees if onlyOnMainServices)
+            columnStarts    entries of column c are entries[columnStarts[c]:columnStarts[c + 1]]
+        Similarities of one VMI to all others are computed with array operations on the entries of the columns of its
+        packages, the sums over packages installed in only one of two VMIs are taken from comparedSizes.
+        The normalization by the maximum install size in the original definition cancels out and is left away.
+    """
+
+    def __init__(self, vmiDescriptors, onlyOnMainServices):
+        """
+        :param list vmiDescriptors: list of BaseImageDescriptors, masters included
+        :param Boolean onlyOnMainServices: compare only packages in the main service subtrees of both VMIs
+        """
+        self.vmiDescriptors = vmiDescriptors
+        self.onlyOnMainServices = onlyOnMainServices
+
+        vocabulary = dict()         # in the form of {pkgName: column}
+        versionIDs = dict()         # in the form of {version: ID}
+        self.archIDs = {"all": 0}   # in the form of {architecture: ID}
+        columns = []
+        sizes = []
+        versions = []
+        archs = []
+        compared = []
+        numEntries = []             # number of packages by VMI
+        for vmi in vmiDescriptors:
+            packageIndex = vmi.getPackageIndex()
+            if onlyOnMainServices:
+                comparedNames = set(vmi.getNamesFromSubTrees(vmi.mainServices))
+            for (pkgName, (version, arch, size)) in packageIndex.iteritems():
+                columns.append(vocabulary.setdefault(pkgName, len(vocabulary)))
+                sizes.append(size)
+                versions.append(versionIDs.setdefault(version, len(versionIDs)))
+                archs.append(self.archIDs.setdefault(arch, len(self.archIDs)))
+                compared.append(not onlyOnMainServices or pkgName in comparedNames)
+            numEntries.append(len(packageIndex))
+
+        columns = np.array(columns, dtype=np.intp)
+        vmis = np.repeat(np.arange(len(vmiDescriptors), dtype=np.intp), numEntries)
+        # stable, entries of a column are ordered by VMI
+        order = np.argsort(columns, kind="mergesort")
+        self.entryColumns = columns[order]
+        self.entryVMIs = vmis[order]
+        self.entrySizes = np.array(sizes, dtype=np.int64)[order]
+        self.entryVersions = np.array(versions, dtype=np.int32)[order]
+        self.entryArchs = np.array(archs, dtype=np.int32)[order]
+        self.entryCompared = np.array(compared, dtype=np.bool_)[order]
+        self.columnStarts = np.zeros(len(vocabulary) + 1, dtype=np.intp)
+        np.cumsum(np.bincount(columns, minlength=len(vocabulary)), out=self.columnStarts[1:])
+        # entries of VMI i are entries[vmiEntries[vmiStarts[i]:vmiStarts[i + 1]]]
+        self.vmiEntries = np.empty(len(order), dtype=np.intp)
+        self.vmiEntries[order] = np.arange(len(order), dtype=np.intp)
+        self.vmiStarts = np.zeros(len(vmiDescriptors) + 1, dtype=np.intp)
+        np.cumsum(numEntries, out=self.vmiStarts[1:])
+        # sum of the install sizes of compared packages, by VMI
+        self.comparedSizes = np.bincount(self.entryVMIs, weights=self.entrySizes * self.entryCompared,
+                                         minlength=len(vmiDescriptors))
+
+    def getSimilarities(self, i, others=None):
+        """
+        :param int i: index of the VMI in vmiDescriptors
+        :param others: indices (list or slice) of the VMIs to compare with, all VMIs by default
+        :return: numpy array of similarities to the VMIs in others
+        """
+        if others is None:
+            others = slice(None)
+        numVMIs = len(self.vmiDescriptors)
+        # pairs of entries (own, other) of the packages of VMI i that are installed in both VMIs
+        own = self.vmiEntries[self.vmiStarts[i]:self.vmiStarts[i + 1]]
+        if isinstance(others, slice) and others.start is not None and others.start > i:
+            # only VMIs after i, they follow the entry of VMI i in every column
+            starts = own + 1
+        else:
+            starts = self.columnStarts[self.entryColumns[own]]
+        counts = self.columnStarts[self.entryColumns[own] + 1] - starts
+        other = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        own = np.repeat(own, counts)
+        vmis = self.entryVMIs[other]
+
+        sizes = self.entrySizes[other]
+        compared = self.entryCompared[other]
+        ownSizes = self.entrySizes[own]
+        ownCompared = self.entryCompared[own]
+
+        # packages installed in both VMIs and compared in either weigh with the larger install size,
+        # all others with their size in the VMI they are installed in
+        weights = np.maximum(sizes, ownSizes)
+        union = compared | ownCompared
+        sumAll = self.comparedSizes[i] + self.comparedSizes + np.bincount(
+            vmis, weights=weights * union - sizes * compared - ownSizes * ownCompared, minlength=numVMIs)
+
+        # matching packages: same version, same architecture or at least one says "all"
+        archs = self.entryArchs[other]
+        ownArchs = self.entryArchs[own]
+        matches = (self.entryVersions[other] == self.entryVersions[own]) \
+            & ((archs == ownArchs) | (archs == self.archIDs["all"]) | (ownArchs == self.archIDs["all"]))
+        sumMatches = np.bincount(vmis, weights=weights * (union & matches), minlength=numVMIs)
+
+        sumAll = sumAll[others]
+        sumMatches = sumMatches[others]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(sumAll > 0, sumMatches / sumAll, 0.0)
+
+    def getMatrix(self):
+        """
+            Similarities between all VMIs, the metric is symmetric and every pair is only computed once
+        :return: numpy array in the form of matrix[i][j] = similarity between VMI i and VMI j
+        """
+        numVMIs = len(self.vmiDescriptors)
+        matrix = np.zeros((numVMIs, numVMIs), dtype=np.float64)
+        for i in xrange(numVMIs - 1):
+            similarities = self.getSimilarities(i, slice(i + 1, numVMIs))
+            matrix[i, i + 1:] = similarities
+            matrix[i + 1:, i] = similarities
+        return matrix
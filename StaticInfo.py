@@ -1,3 +1,4 @@
+import multiprocessing
 
 
 class StaticInfo:
@@ -9,15 +10,61 @@ class StaticInfo:
     # List of supported VMI formats/extensions
     validVMIFormats = ["qcow2"]
 
+    # libguestfs appliance handling
+    # launched appliances that are kept warm for hot-plugging the next VMI
+    guestfsMaxIdleHandles = 1
+    # appliances that are launched in the background for VMIs processed next
+    guestfsMaxPrelaunchedHandles = 2
+    # VMIs attached read-only to one appliance in batch sessions
+    guestfsMaxDrivesPerAppliance = 20
+    # compression of directories streamed from and to the appliance ("gzip", "bzip2" or None, see GuestFSTarStream),
+    # packages are compressed already
+    guestfsTarCompression = None
+    # worker processes (each running one appliance at a time) creating VMI descriptors for similarity evaluations
+    guestfsMaxConcurrentAppliances = multiprocessing.cpu_count()
+    # worker processes running the guest phases of decompositions (package export and removal) and the plans of
+    # decomposition dry runs when processing a folder, 1 processes one VMI after another in this process.
+    # Off by default: every worker runs its own appliance, and exported package counts and sizes in evaluations are only
+    # comparable with sequential runs (see Decomposer.decomposeMany). To enable, set e.g. min(4, multiprocessing.cpu_count())
+    decompositionMaxConcurrentVMIs = 1
+
+    # create VMI graphs by downloading the package database (dpkg status file or rpmdb) and parsing it on the host
+    # instead of running package manager queries in the appliance
+    parsePackageDBOnHost = True
+    # graphs cached by checksum of the package database, least recently written or used graphs are removed first
+    graphCacheMaxEntries = 100
+    # master graphs: subgraphs are appended to a log, which is compacted into the master graph file in the background
+    # once it exceeds either limit (absolute size or size relative to the master graph file)
+    masterGraphLogMaxBytes = 16 * 1024 * 1024
+    masterGraphLogMaxRatio = 1.0
+    # MinHash signatures of master main services (see MinHash), masters exactly compared with a new VMI
+    minHashNumPermutations = 128
+    minHashBands = 32
+    masterSimilarityCandidates = 5
+    # Bloom filter over all packages in the repository, skips database lookups of packages that were never exported
+    # (see RepositoryDatabase.resolvePackages), sized for at least twice the number of packages when it is built.
+    # Only kept per process and rebuilt whenever another process wrote to the database, which is after every VMI
+    # when decomposing several VMIs at once, so it only pays off for many lookups between writes. Off by default,
+    # the joins on the package index are fast without it.
+    packageFilterEnabled = False
+    packageFilterMinCapacity = 10000
+    packageFilterFalsePositiveRate = 0.01
+
     # local repository folders
     relPathLocalRepository = "localRepository"
     relPathLocalRepositoryPackages = relPathLocalRepository + "/packages"
     relPathLocalRepositoryPackagesBasic = relPathLocalRepository + "/packages/basic"
+    # content-addressed package files, package folders of the distributions link to them (see PackageStore)
+    relPathLocalRepositoryPackageBlobs = relPathLocalRepository + "/packages/blobs"
     relPathLocalRepositoryBaseImages = relPathLocalRepository + "/BaseImages"
     relPathLocalRepositoryUserFolders = relPathLocalRepository + "/UserFolders"
     relPathLocalRepositoryDatabase = relPathLocalRepository + "/db_repo_metadata.sqlite"
-
-    relPathLocalRepositoryTempDepInfo = "localRepository/tempDependencies.txt"
+    relPathLocalRepositoryInspectionCache = relPathLocalRepository + "/inspectionCache.json"
+    relPathLocalRepositoryGraphCache = relPathLocalRepository + "/graphCache"
+    relPathLocalRepositoryGraphCacheIndex = relPathLocalRepositoryGraphCache + "/index.json"
+    # lock files of the caches above, shared by all processes using the repository
+    relPathLocalRepositoryInspectionCacheLock = relPathLocalRepository + "/inspectionCache.lock"
+    relPathLocalRepositoryGraphCacheLock = relPathLocalRepository + "/graphCache.lock"
 
     # basic files and folders that need to be present
     relPathInitPackages = "files/basic"
@@ -1,8 +1,14 @@
 from abc import ABCMeta, abstractmethod
-import networkx as nx
+import hashlib
 import os
+from GuestFSHelper import GuestFSHelper
+from MasterGraphLog import MasterGraphLog
+from MinHash import MinHash
+from PackageGraph import PackageGraph
+from PackageGraphFile import PackageGraphFile
+from PackageNameIndex import PackageNameIndex
 from StaticInfo import StaticInfo
-from VMIGraph import VMIGraph
+from VMIGraph import GraphCache
 
 
 class BaseImageDescriptor():
@@ -13,19 +19,44 @@ class BaseImageDescriptor():
         self.distributionVersion = None
         self.architecture = None
         self.pkgManager = None
-        self.graph = None  # type: nx.MultiDiGraph
         self.graphFileName = None
+        self.graph = None  # type: PackageGraph
 
+    @property
+    def graph(self):
+        if self._graph is None and self.graphFileName is not None:
+            # descriptors initialized from the repository load their graph on first access
+            self.graph = self.loadGraph()
+        return self._graph
+
+    @graph.setter
+    def graph(self, graph):
+        self._graph = graph
+        # memoized reachability, in the form of {rootNode: bitset of package IDs (see PackageGraph.getBitsetFromIDs)}
+        self.closures = dict()
+        self.packageIndex = None
+        self.packageNameIndex = None
+
+    def loadGraph(self):
+        return PackageGraph.read(self.graphFileName)
 
     def initializeNew(self, guest, root, verbose=False):
         #print "Creating new Descriptor for \"%s\"" % self.pathToVMI
-        self.distribution = guest.inspect_get_distro(root)
-        self.distributionVersion = str(guest.inspect_get_major_version(root)) + \
-                                   "_" + \
-                                   str(guest.inspect_get_minor_version(root))
-        self.architecture = guest.inspect_get_arch(root)
-        self.pkgManager = guest.inspect_get_package_management(root)
-        self.graph = VMIGraph.createGraph(guest, self.pkgManager, verbose=verbose)
+        inspectionData = GuestFSHelper.getInspectionData(guest, root)
+        graph = GraphCache.getGraph(guest, inspectionData["pkgManager"], self.pathToVMI, verbose=verbose)
+        self.initializeFromInspectionData(inspectionData, graph)
+
+    def initializeFromInspectionData(self, inspectionData, graph):
+        """
+            For descriptors whose graph was created elsewhere, e.g. in a worker process
+        :param dict inspectionData: see GuestFSHelper.getInspectionData
+        :param PackageGraph graph:
+        """
+        self.distribution = inspectionData["distribution"]
+        self.distributionVersion = inspectionData["distributionVersion"]
+        self.architecture = inspectionData["architecture"]
+        self.pkgManager = inspectionData["pkgManager"]
+        self.graph = graph
 
     def initializeFromRepo(self, distribution, distributionVersion, architecture, pkgManager, graphFileName):
         self.distribution = distribution
@@ -33,14 +64,15 @@ class BaseImageDescriptor():
         self.architecture = architecture
         self.pkgManager = pkgManager
         self.graphFileName = graphFileName
-        self.graph = nx.read_gpickle(graphFileName)
+        self.graph = None
 
     def saveGraph(self):
+        graph = self.graph # load before an existing file is removed
         if self.graphFileName is None:
-            self.graphFileName = "_".join(self.pathToVMI.rsplit(".",1)) + ".pkl"
+            self.graphFileName = "_".join(self.pathToVMI.rsplit(".",1)) + ".graph"
         if os.path.isfile(self.graphFileName):
             os.remove(self.graphFileName)
-        nx.write_gpickle(self.graph, self.graphFileName)
+        graph.write(self.graphFileName)
 
     def getVMIMasterDescriptor(self):
         master = VMIMasterDescriptor(self.pathToVMI)
@@ -50,50 +82,86 @@ class BaseImageDescriptor():
 
     def getNodeData(self):
         assert (self.graph != None)
-        return dict((pkgName, pkgInfo) for (pkgName, pkgInfo) in self.graph.nodes(data=True))
+        return self.graph.getNodeDataDict()
+
+    def getPackageIndex(self):
+        """
+            Kept until the graph changes, use instead of getNodeData where only these attributes are needed
+        :return: dict in the form of {pkgName: (version, architecture, installsize)}
+        """
+        if self.packageIndex is None:
+            self.packageIndex = self.graph.getPackageIndex()
+        return self.packageIndex
+
+    def getPackageNameIndex(self):
+        """
+            Kept until the graph changes
+        :rtype: PackageNameIndex
+        """
+        if self.packageNameIndex is None:
+            self.packageNameIndex = PackageNameIndex(self.getPackageIndex().iterkeys())
+        return self.packageNameIndex
+
+    def getPackageSetFingerprint(self, rootNodeList=None):
+        """
+            Changes whenever a package, its version, architecture or install size changes
+        :param rootNodeList: if given, the packages in the subtrees of these roots are part of the fingerprint
+        :return: sha1 hex digest
+        """
+        sha = hashlib.sha1()
+        for (pkgName, (version, architecture, installSize)) in sorted(self.getPackageIndex().iteritems()):
+            sha.update("%s;%s;%s;%i\n" % (pkgName, version, architecture, installSize))
+        if rootNodeList is not None:
+            sha.update("\n" + "\n".join(sorted(self.getNamesFromSubTrees(rootNodeList))))
+        return sha.hexdigest()
 
     def getNumberOfPackages(self):
         return len(self.graph)
 
     def getPkgsInstallSize(self):
-        size = 0
-        for pkg, pkgInfo in self.graph.nodes(data=True):
-            size = size + int(pkgInfo[StaticInfo.dictKeyInstallSize])
-        return size
+        return sum(installSize for (_, _, installSize) in self.getPackageIndex().itervalues())
+
+    def getClosure(self, rootNode):
+        """
+            Packages reachable from rootNode, computed once until the graph changes
+        :return: bitset of package IDs
+        """
+        if rootNode not in self.closures:
+            # closures of other roots are reused where the search reaches them
+            knownClosures = dict((self.graph.index[name], closure) for (name, closure) in self.closures.iteritems())
+            self.closures[rootNode] = self.graph.getReachableBitset([rootNode], knownClosures)
+        return self.closures[rootNode]
+
+    def getClosureOfRoots(self, rootNodeList):
+        closure = 0
+        for rootNode in rootNodeList:
+            closure = closure | self.getClosure(rootNode)
+        return closure
 
     def getSubGraphFromRoots(self, rootNodeList):
-        nodeList = list()
-        for name in rootNodeList:
-            nodeList = nodeList + list(nx.bfs_tree(self.graph, name))
-        return nx.MultiDiGraph(self.graph.subgraph(nodeList))
+        return self.graph.subgraphFromIDs(self.graph.getIDsFromBitset(self.getClosureOfRoots(rootNodeList)))
 
-    def getSubGraphFromRootsOLD(self, rootNodeList):
-        nodeList = list()
-        for name in rootNodeList:
-            nodeList.append(nx.bfs_tree(self.graph, name))
-        return nx.MultiDiGraph(self.graph.subgraph(nodeList))
+    def getNamesFromSubTrees(self, rootNodeList):
+        return [self.graph.names[pkgID] for pkgID in self.graph.getIDsFromBitset(self.getClosureOfRoots(rootNodeList))]
 
     def getNodeDataFromSubTree(self, rootNode):
-        nodeList = nx.bfs_tree(self.graph, rootNode)
-        NodeDataDict = dict((pkgName, pkgInfo) for (pkgName, pkgInfo) in self.graph.subgraph(nodeList).nodes(data=True))
-        return NodeDataDict
+        return self.getNodeDataFromSubTrees([rootNode])
 
     def getNodeDataFromSubTrees(self, rootNodeList):
-        result = dict()
-        for name in rootNodeList:
-            nodeList = nx.bfs_tree(self.graph, name)
-            result.update(dict((pkgName, pkgInfo) for (pkgName, pkgInfo) in self.graph.subgraph(nodeList).nodes(data=True)))
-        return result
+        return self.graph.getNodeDataDictFromIDs(self.graph.getIDsFromBitset(self.getClosureOfRoots(rootNodeList)))
 
     def checkIfNodeExists(self, nodeName):
         return nodeName in self.graph
 
     def getListOfNodesContaining (self, name):
-        ret = list()
-        for node in self.graph.nodes():
-            if name in node:
-                ret.append(node)
-        return ret
+        return self.getPackageNameIndex().getNamesContaining(name)
+
+    def getSimilarNodes(self, name, maxResults=10):
+        """
+            Suggestions for a mistyped package name, packages containing name or differing in few characters
+        :return: list of package names, closest first
+        """
+        return self.getPackageNameIndex().getSimilarNames(name, maxResults=maxResults)
 
     def checkCompatibilityForPackages(self, packageDict, verbose=False):
         """
@@ -101,20 +169,20 @@ class BaseImageDescriptor():
                 in the form of dict{pkgName, pkgInfo} with pkgInfo = dict{version:?, Arch:?,...}
         :return:
         """
-        graphNodeData = self.getNodeData()
+        packageIndex = self.getPackageIndex()
         if packageDict is None:
             return True
         for pkg2Name,pkg2Data in packageDict.iteritems():
-            if pkg2Name in graphNodeData:
+            if pkg2Name in packageIndex:
                 # pkg2 is in graph, version and architecture has to match, otherwise return False:
-                pkg1Data = graphNodeData[pkg2Name]
+                (pkg1Version, pkg1Arch, _) = packageIndex[pkg2Name]
                 if not (
                         # Version has to be the same
-                        pkg1Data[StaticInfo.dictKeyVersion] == pkg2Data[StaticInfo.dictKeyVersion]
+                        pkg1Version == pkg2Data[StaticInfo.dictKeyVersion]
                         # Architecture has to be the same, or at least on has to say all
                         and (
-                            pkg1Data[StaticInfo.dictKeyArchitecture] == pkg2Data[StaticInfo.dictKeyArchitecture]
-                            or pkg1Data[StaticInfo.dictKeyArchitecture] == "all"
+                            pkg1Arch == pkg2Data[StaticInfo.dictKeyArchitecture]
+                            or pkg1Arch == "all"
                             or pkg2Data[StaticInfo.dictKeyArchitecture] == "all"
                         )
                 ):
@@ -122,18 +190,22 @@ class BaseImageDescriptor():
                         print "Failed Compatibility Check"
                         print "failed on package:"
                         print "\t" + pkg2Name
-                        print "\t" + pkg1Data[StaticInfo.dictKeyVersion] + " vs " + pkg2Data[StaticInfo.dictKeyVersion]
-                        print "\t" + pkg1Data[StaticInfo.dictKeyArchitecture] + " vs " + pkg2Data[StaticInfo.dictKeyArchitecture]
+                        print "\t" + pkg1Version + " vs " + pkg2Data[StaticInfo.dictKeyVersion]
+                        print "\t" + pkg1Arch + " vs " + pkg2Data[StaticInfo.dictKeyArchitecture]
                     return False
         return True
 
 
 class VMIDescriptor(BaseImageDescriptor):
     def __init__(self, pathToVMI, vmiName, mainServices, guest, root, verbose=False):
+        """
+        :param guest: if None, the descriptor has to be initialized with initializeFromInspectionData
+        """
         super(VMIDescriptor, self).__init__(pathToVMI)
         self.vmiName = vmiName
         self.mainServices = mainServices
-        self.initializeNew(guest, root, verbose=verbose)
+        if guest is not None:
+            self.initializeNew(guest, root, verbose=verbose)
 
     def getMainServicesDepList(self):
         return [
@@ -150,6 +222,17 @@ class VMIDescriptor(BaseImageDescriptor):
     def getSubGraphForMainServices(self):
         return self.getSubGraphFromRoots(self.mainServices)
 
+    def getSimilarityFingerprint(self, onlyOnMainServices):
+        """
+            Identifies the input of the weighted similarity, see SimilarityCalculator.computeSimilarityMatrix
+        """
+        if onlyOnMainServices:
+            return self.getPackageSetFingerprint(self.mainServices)
+        return self.getPackageSetFingerprint()
+
+    def getMainServicesSignature(self):
+        return MinHash.getSignature(MinHash.getTokens(self.getPackageIndex(), self.getNamesFromSubTrees(self.mainServices)))
+
     def getBaseImageDescriptor(self, guest, root):
         base = BaseImageDescriptor(self.pathToVMI)
         base.initializeNew(guest, root)
@@ -159,31 +242,81 @@ class VMIMasterDescriptor(BaseImageDescriptor):
     def __init__(self, pathToVMI):
         super(VMIMasterDescriptor, self).__init__(pathToVMI)
         self.mainServices = None
+        self.pendingSubGraphs = []  # added subgraphs that are not composed into the graph yet
+        self.unsavedSubGraphs = []  # added subgraphs that are not written yet
+        self.signature = None       # MinHash signature of the main service subtrees, see getMainServicesSignature
+
+    def getGraph(self):
+        graph = BaseImageDescriptor.graph.fget(self)
+        if len(self.pendingSubGraphs) > 0:
+            graph = MasterGraphLog.apply(graph, self.pendingSubGraphs)
+            self.graph = graph
+            self.pendingSubGraphs = []
+        return graph
+
+    # subgraphs added by addSubGraph are composed on first access
+    graph = property(getGraph, BaseImageDescriptor.graph.fset)
+
+    def loadGraph(self):
+        (snapshot, subGraphs) = MasterGraphLog.read(self.graphFileName)
+        # subgraphs from the log are composed on first access, like the ones added by addSubGraph
+        self.pendingSubGraphs = subGraphs + self.pendingSubGraphs
+        return snapshot
+
+    def getPackageIndex(self):
+        if self.packageIndex is None:
+            packageIndex = BaseImageDescriptor.graph.fget(self).getPackageIndex()
+            for subGraph in self.pendingSubGraphs:
+                VMIMasterDescriptor.updatePackageIndex(packageIndex, subGraph)
+            self.packageIndex = packageIndex
+        return self.packageIndex
+
+    @staticmethod
+    def updatePackageIndex(packageIndex, subGraph):
+        # packages that are already part of the master keep their attributes (see addSubGraph)
+        for (pkgName, pkgInfo) in subGraph.getPackageIndex().iteritems():
+            packageIndex.setdefault(pkgName, pkgInfo)
 
     def createNew(self, distribution, distributionVersion, architecture, pkgManager, graph, mainServices):
         self.distribution = distribution
         self.distributionVersion = distributionVersion
         self.architecture = architecture
         self.pkgManager = pkgManager
-        self.graph = nx.MultiDiGraph(graph)
+        self.graph = graph # PackageGraph is immutable and can be shared
         self.mainServices = set(mainServices)
         self.graphFileName = None
+        self.pendingSubGraphs = []
+        self.unsavedSubGraphs = []
+        self.signature = None
 
-    def initializeMasterFromRepo(self, distribution, distributionVersion, architecture, pkgManager, graphFileName, mainServices):
+    def initializeMasterFromRepo(self, distribution, distributionVersion, architecture, pkgManager, graphFileName, mainServices,
+                                 signature=None):
         self.distribution = distribution
         self.distributionVersion = distributionVersion
         self.architecture = architecture
         self.pkgManager = pkgManager
         self.graphFileName = graphFileName
-        self.graph = nx.read_gpickle(graphFileName)
+        self.graph = None
         self.mainServices = set(mainServices)
+        self.pendingSubGraphs = []
+        self.unsavedSubGraphs = []
+        self.signature = signature
 
     def saveGraph(self):
+        """
+            Masters that are already stored only append the subgraphs added since, see MasterGraphLog
+        """
+        if (self.graphFileName is not None
+                and os.path.isfile(self.graphFileName)
+                and PackageGraphFile.isGraphFile(self.graphFileName)):
+            for subGraph in self.unsavedSubGraphs:
+                MasterGraphLog.append(self.graphFileName, subGraph)
+            self.unsavedSubGraphs = []
+            return
         if self.graphFileName is None:
-            self.graphFileName = "_".join(self.pathToVMI.rsplit(".",1)) + "_MASTER.pkl"
-        if os.path.isfile(self.graphFileName):
-            os.remove(self.graphFileName)
-        nx.write_gpickle(self.graph, self.graphFileName)
+            self.graphFileName = "_".join(self.pathToVMI.rsplit(".",1)) + "_MASTER.graph"
+        MasterGraphLog.writeSnapshot(self.graphFileName, self.graph)
+        self.unsavedSubGraphs = []
 
     def getSubGraphForMainServices(self):
         return self.getSubGraphFromRoots(self.mainServices)
@@ -191,12 +324,33 @@ class VMIMasterDescriptor(BaseImageDescriptor):
     def getNodeDataFromMainServicesSubtrees(self):
         return self.getNodeDataFromSubTrees(self.mainServices)
 
+    def getMainServicesSignature(self):
+        """
+            Computed once, afterwards kept up to date by addSubGraph without composing the graph
+        """
+        if self.signature is None:
+            self.signature = MinHash.getSignature(MinHash.getTokens(self.getPackageIndex(),
+                                                                    self.getNamesFromSubTrees(self.mainServices)))
+        return self.signature
+
     def addSubGraph(self, mainServices, newGraph):
         # Check compatibility
-        newPkgDict = dict((pkgName, pkgInfo) for (pkgName, pkgInfo) in newGraph.nodes(data=True))
+        newPkgDict = newGraph.getNodeDataDict()
         if not self.checkCompatibilityForPackages(newPkgDict):
             print "ERROR in Mastergraph: trying to add packages that are not compatible to mastergraph!"
             return False
 
-        self.graph = nx.compose(newGraph, self.graph)
+        # composed with the master on the next access of self.graph (nx.compose semantics: attributes of packages
+        # that are already part of the master are kept), saveGraph only writes the subgraph
+        self.pendingSubGraphs.append(newGraph)
+        self.unsavedSubGraphs.append(newGraph)
+        if self.packageIndex is not None:
+            VMIMasterDescriptor.updatePackageIndex(self.packageIndex, newGraph)
+        if self.packageNameIndex is not None:
+            for pkgName in newGraph:
+                self.packageNameIndex.add(pkgName)
+        self.closures = dict()
+        if self.signature is not None:
+            # all packages of the subgraph belong to the subtrees of its main services
+            self.signature = MinHash.merge(self.signature, MinHash.getSignature(MinHash.getTokens(newGraph.getPackageIndex())))
         self.mainServices = self.mainServices.union(set(mainServices))
\ No newline at end of file
@@ -1,12 +1,22 @@
 import guestfs
+import itertools
+import json
+import pipes
 import re
+import shutil
+import subprocess
 import sys
+import tempfile
 from abc import ABCMeta, abstractmethod
+from cStringIO import StringIO
+from collections import defaultdict
+from distutils.spawn import find_executable
 
-import networkx as nx
 import os
-from enum import IntEnum
 
+from FileLock import FileLock
+from GuestFSHelper import GuestFSTarStream
+from PackageGraph import PackageGraph
 from StaticInfo import StaticInfo
 
 
@@ -22,211 +32,481 @@ class VMIGraph:
     GEdgeAttrOperator = "operator"
     GEdgeAttrVersion = "version"
 
+    dpkgStatusPath = "/var/lib/dpkg/status"
+    dpkgStatusFields = {"Package", "Status", "Version", "Architecture", "Essential", "Installed-Size", "Depends", "Pre-Depends"}
+    dpkgRelationFields = {"Depends", "Pre-Depends"}
+    # Regular Expressions for pattern matching dependencies in the form of "name:arch (operator version)"
+    dpkgDepMatcher = re.compile(r"^ *([^(): ]*) *(?:: *([^(): ]*))? *(?:\( *([^()]*) *\))? *$")
+    rpmDBPath = "/var/lib/rpm"
+    # one line per package ("@"), followed by one line per required ("R") and provided ("P") capability
+    rpmQueryFormat = "@%{NAME};%{VERSION};%{ARCH};%{SIZE}\\n[R%{REQUIRENAME}\\n][P%{PROVIDENAME}\\n]"
+
     @staticmethod
     def createGraph(guest, pkgManagement, verbose=False):
         if pkgManagement == "apt":
+            if StaticInfo.parsePackageDBOnHost:
+                return VMIGraph.createGraphAPTFromStatusFile(guest, verbose=verbose)
             return VMIGraph.createGraphAPT(guest, verbose=verbose)
         elif pkgManagement == "dnf":
+            if StaticInfo.parsePackageDBOnHost and VMIGraph.hostRpmAvailable():
+                try:
+                    return VMIGraph.createGraphDNFFromRpmDB(guest, verbose=verbose)
+                except (subprocess.CalledProcessError, OSError) as e:
+                    print "\tReading the rpm database on the host failed (%s), querying in the guest instead." % e
             return VMIGraph.createGraphDNF(guest, verbose=verbose)
         else:
             sys.exit("ERROR in VMIGraph: trying to create Graph for VMI with unsupported package manager \"%s\"" % pkgManagement)
 
     @staticmethod
     def createGraphAPT(guest, verbose=False):
-        # Enum more understandable list access
-        class Q(IntEnum):
-            Name        = 0
-            Version     = 1
-            Arch        = 2
-            Essential   = 3
-            InstallSize = 4
-            Depends     = 5
-            PreDepends  = 6
-
-        # Regular Expressions for pattern matching Package's info
-        patternPkgName = r"([^(): ]*)"
-        patternArch = r"(?:: *([^(): ]*))?"
-        patternVersionConstraint = r"(?:\( *([^()]*) *\))?"
-        depMatcher = re.compile(r"^ *" + patternPkgName + " *" + patternArch + " *" + patternVersionConstraint + " *$")
-
-        # Init Graph
-        graph = nx.MultiDiGraph()
-
         # Obtain Package Data from guest
         # install size is in kbytes
         pkgsInfoString = guest.sh(
             "dpkg-query --show --showformat='${Package};${Version};${Architecture};${Essential};${Installed-Size};${Depends};${Pre-Depends}\\n'")[:-1]
         # returns lines of form "curl;1.1;amd64;no;dep1, dep2,...;dep3, dep4,..."
+        return VMIGraph.createGraphAPTFromRecords(line.rstrip("\n").split(";") for line in StringIO(pkgsInfoString))
+
+    @staticmethod
+    def createGraphAPTFromStatusFile(guest, verbose=False):
+        """
+            Creates the graph from the dpkg database (/var/lib/dpkg/status) of the guest.
+            The file is downloaded once and parsed on the host, no package manager is run in the appliance.
+        """
+        (fd, localStatusPath) = tempfile.mkstemp(prefix="dpkgStatus_", dir=StaticInfo.relPathLocalRepository)
+        os.close(fd)
+        try:
+            guest.download(VMIGraph.dpkgStatusPath, localStatusPath)
+            with open(localStatusPath, "r") as statusFile:
+                return VMIGraph.createGraphAPTFromRecords(VMIGraph.parseDpkgStatus(statusFile))
+        finally:
+            os.remove(localStatusPath)
 
+    @staticmethod
+    def parseDpkgStatus(statusFile):
+        """
+            Streaming parser for dpkg status files.
+            Yields the same records as the dpkg-query call in createGraphAPT, i.e. one record for every
+            package that is not in state "not-installed":
+            [name, version, architecture, essential("yes" or ""), installsize(kbytes), depends, pre-depends]
+        """
+        fields = dict()
+        lastField = None
+        for line in itertools.chain(statusFile, [""]):
+            line = line.rstrip("\n")
+            if line == "":
+                # end of package stanza
+                if "Package" in fields and not fields.get("Status", "").endswith(" not-installed"):
+                    yield [fields["Package"],
+                           fields.get("Version", ""),
+                           fields.get("Architecture", ""),
+                           fields.get("Essential", ""),
+                           fields.get("Installed-Size", "0"),
+                           fields.get("Depends", ""),
+                           fields.get("Pre-Depends", "")]
+                fields = dict()
+                lastField = None
+            elif line[0] in " \t":
+                # continuation line, only multi-line fields that are not used here (e.g. Description, Conffiles)
+                # are continued in practice, but relationship fields may be folded as well
+                if lastField in VMIGraph.dpkgRelationFields:
+                    fields[lastField] = fields[lastField] + " " + line.strip()
+            else:
+                (field, _, value) = line.partition(":")
+                lastField = field
+                if field in VMIGraph.dpkgStatusFields:
+                    fields[field] = value.strip()
+
+    @staticmethod
+    def parseDpkgDependency(depPossibility, cache):
+        """
+            Tokenizes one alternative of a dpkg relationship field, e.g. "libc6:any (>= 2.14)".
+            Results are memoized in cache as the same relations are used by many packages.
+        :return: tuple in the form of (name, architecture, {constraint:True, operator:">=", version:"2.14"})
+        """
+        result = cache.get(depPossibility)
+        if result is None:
+            matchResult = VMIGraph.dpkgDepMatcher.match(depPossibility)
+            if not matchResult:
+                return None
+            (depPkgName, depPkgArch, depPkgVersConstraint) = matchResult.groups()
+            constraint = False
+            operator = ""
+            version = ""
+            if depPkgVersConstraint != None:
+                versConstraintTuple = depPkgVersConstraint.split(" ")
+                if len(versConstraintTuple) != 2:
+                    sys.exit("Error could not read Version constraint tuple: \"" + str(versConstraintTuple) + "\"")
+                constraint = True
+                operator = versConstraintTuple[0]
+                version = versConstraintTuple[1]
+            # edge attributes are interned by PackageGraph, one dict can be shared by all edges of this relation
+            result = (depPkgName, depPkgArch,
+                      {
+                          StaticInfo.dictKeyConstraint: constraint,
+                          StaticInfo.dictKeyOperator: operator,
+                          StaticInfo.dictKeyVersion: version})
+            cache[depPossibility] = result
+        return result
+
+    @staticmethod
+    def createGraphAPTFromRecords(pkgRecords):
+        """
+            Builds the graph in two passes: the first pass consumes the records one by one and keeps
+            only the node attributes and a compact (name, relations) tuple per package,
+            the second pass resolves the relations against the installed packages.
+        :param pkgRecords: iterable of [name, version, architecture, essential, installsize(kbytes), depends, pre-depends]
+        :return: PackageGraph
+        """
         # List of node names and attributes
         pkgsInfo = []   # in the form of [(pkg,{name:"pkg", version:"1.1", architecture:"amd64", essential:False, installsize:10})]
-        pkgHelperDict = dict()
-        for line in pkgsInfoString.split("\n"):
-            lineData = line.split(";")
-            essentialPkg = True if lineData[Q.Essential] == "yes" else False
-            pkgsInfo.append((lineData[Q.Name],
+        pkgArchs = dict()  # in the form of {pkg: architecture}
+        pkgRelations = []  # in the form of [(pkg, "dep1, dep2 | dep3,...")]
+        for (name, version, arch, essential, installSize, depends, preDepends) in pkgRecords:
+            pkgsInfo.append((name,
                              {
-                                 StaticInfo.dictKeyName: lineData[Q.Name],
-                                 StaticInfo.dictKeyVersion: lineData[Q.Version],
-                                 StaticInfo.dictKeyArchitecture: lineData[Q.Arch],
-                                 StaticInfo.dictKeyEssential: essentialPkg,
-                                 StaticInfo.dictKeyInstallSize: int(lineData[Q.InstallSize])*1000,
+                                 StaticInfo.dictKeyName: name,
+                                 StaticInfo.dictKeyVersion: version,
+                                 StaticInfo.dictKeyArchitecture: arch,
+                                 StaticInfo.dictKeyEssential: essential == "yes",
+                                 StaticInfo.dictKeyInstallSize: int(installSize)*1000,
                                  StaticInfo.dictKeyFilePath: None
                             }))
-            pkgHelperDict[lineData[Q.Name]] = {StaticInfo.dictKeyName: lineData[Q.Name],
-                                               StaticInfo.dictKeyVersion: lineData[Q.Version],
-                                               StaticInfo.dictKeyArchitecture: lineData[Q.Arch],
-                                               StaticInfo.dictKeyEssential: essentialPkg,
-                                               StaticInfo.dictKeyInstallSize: int(lineData[Q.InstallSize])*1000,
-                                               StaticInfo.dictKeyFilePath: None}
+            pkgArchs[name] = arch
+            if depends != "" or preDepends != "":
+                pkgRelations.append((name, depends + "," + preDepends))
 
         # List of edge data (fromNode, toNode and attributes)
         depList = []  # in the form of [(pkg,deppkg,{constraint:True, operator:">=", version:"1.6"})]
-        for line in pkgsInfoString.split("\n"):
-            lineData = line.split(";")
-            deps = [dep for dep in (lineData[Q.Depends] + "," + lineData[Q.PreDepends]).split(",") if dep != ""]
-            for dep in deps:
-                #print lineData[Q.Name] + ": \"" + dep + "\""
+        depCache = dict()
+        for (name, relations) in pkgRelations:
+            for dep in relations.split(","):
+                if dep == "":
+                    continue
                 for depPossibility in dep.split("|"):
-                    #print "\"" + depPossibility + "\""
-                    matchResult = depMatcher.match(depPossibility)
-                    if not matchResult:
-                        sys.exit("ERROR: Could not match Dependency line: \"" + lineData[Q.Name] + "\" -> \"" + depPossibility + "\"")
-                    if matchResult:
-                        depPkgName = matchResult.group(1)
-                        depPkgArch = matchResult.group(2)
-                        depPkgVersConstraint = matchResult.group(3)
-                        Zinstalled = depPkgName in pkgHelperDict
-                        #if Zinstalled:
-                        #    ZarchSpecified = depPkgArch == None
-                        #    ZarchAny       = depPkgArch == "any"
-                        #    ZArchAllAllowed= pkgHelperDict[depPkgName]["architecture"] == "all"
-                        if depPkgName in pkgHelperDict and (depPkgArch == None or depPkgArch == "any" or pkgHelperDict[depPkgName][StaticInfo.dictKeyArchitecture] == "all"):
-                            constraint = False
-                            operator = ""
-                            version = ""
-                            if depPkgVersConstraint != None:
-                                versConstraintTuple = depPkgVersConstraint.split(" ")
-                                if len(versConstraintTuple) != 2:
-                                    sys.exit("Error could not read Version constraint tuple: \"" + str(versConstraintTuple) + "\"")
-                                constraint = True
-                                operator = versConstraintTuple[0]
-                                version = versConstraintTuple[1]
-                            depList.append((lineData[Q.Name],depPkgName,
-                                            {
-                                                StaticInfo.dictKeyConstraint:constraint,
-                                                StaticInfo.dictKeyOperator:operator,
-                                                StaticInfo.dictKeyVersion:version}))
-                            break # innermost for loop: possible packages that satisfy dependency, first is taken here
+                    parsedDep = VMIGraph.parseDpkgDependency(depPossibility, depCache)
+                    if parsedDep is None:
+                        sys.exit("ERROR: Could not match Dependency line: \"" + name + "\" -> \"" + depPossibility + "\"")
+                    (depPkgName, depPkgArch, depAttributes) = parsedDep
+                    if depPkgName in pkgArchs and (depPkgArch == None or depPkgArch == "any" or pkgArchs[depPkgName] == "all"):
+                        depList.append((name, depPkgName, depAttributes))
+                        break # innermost for loop: possible packages that satisfy dependency, first is taken here
 
         # Fill Graph with nodes and edges
-        graph.add_nodes_from(pkgsInfo)
-        graph.add_edges_from(depList)
-        return graph
+        return PackageGraph(pkgsInfo, depList)
 
     @staticmethod
     def createGraphDNF(guest, verbose=False):
-        # Enum more understandable list access
-        class Q(IntEnum):
-            Name = 0
-            Version = 1
-            Arch = 2
-            InstallSize = 3
+        """
+            Creates the graph by querying the rpm database inside the guest.
+            Requires and provides of all packages are collected in one pass and resolved on the host.
+        """
+        # output is written to a file in the guest and downloaded, replies of guest.sh are limited in size
+        # (libguestfs protocol message limit) and the query lists every capability of every package
+        vmiPathQueryOutput = "/var/tempRpmQuery.txt"
 
-        ignoreSet = {"filesystem"}
-        ignoredPackages = set()
+        def runInGuest(script):
+            try:
+                guest.sh("(" + script + ") > " + vmiPathQueryOutput)
+            except RuntimeError as e:
+                sys.exit("ERROR while fetching dependency information from guest:\n" + e.message)
+            (fd, localQueryOutput) = tempfile.mkstemp(prefix="rpmQuery_", dir=StaticInfo.relPathLocalRepository)
+            os.close(fd)
+            try:
+                guest.download(vmiPathQueryOutput, localQueryOutput)
+                guest.rm_rf(vmiPathQueryOutput)
+                with open(localQueryOutput, "r") as queryOutput:
+                    return queryOutput.read()
+            finally:
+                os.remove(localQueryOutput)
 
-        # Regular Expressions for pattern matching Package's info
-        patternLevel = r"\(level [0-9]*\)"
-        patternPkgName = r"([^ ]*)"
-        depMatcher = re.compile(r"^" + patternLevel + " " + patternPkgName + " -> " + patternPkgName + " *$")
+        return VMIGraph.createGraphDNFFromQuery(VMIGraph.runRpmQuery(runInGuest, "rpm"),
+                                                lambda fileNames: VMIGraph.getRpmFileOwners(runInGuest, "rpm", fileNames),
+                                                verbose=verbose)
 
-        # Init Graph
-        graph = nx.MultiDiGraph()
+    @staticmethod
+    def hostRpmAvailable():
+        return find_executable("rpm") is not None
 
-        # tag size specifies installsize in bytes
-        # see http://ftp.rpm.org/max-rpm/ch-queryformat-tags.html
-        # Obtain Package Data from guest
-        pkgsInfoString = guest.sh(
-            "rpm --query --all --queryformat "
-            "'%{NAME};%{VERSION};%{ARCH};%{SIZE}\n'")[:-1]
-        # returns lines of form "curl;1.1;amd64;10"
+    @staticmethod
+    def createGraphDNFFromRpmDB(guest, verbose=False):
+        """
+            Creates the graph from the rpm database (/var/lib/rpm) of the guest.
+            The database is downloaded once and queried with the rpm installation of the host,
+            no package manager is run in the appliance.
+        """
+        localDBFolder = tempfile.mkdtemp(prefix="rpmdb_", dir=StaticInfo.relPathLocalRepository)
+        try:
+            with GuestFSTarStream(guest, VMIGraph.rpmDBPath, "r") as tar:
+                tar.extractall(path=localDBFolder)
 
-        # List of node names and attributes
-        pkgsInfo = []  # in the form of [(pkg,{name:"pkg", version:"1.1", architecture:"amd64", essential:False, installsize:10})]
-                       # essential not present in dnf
-        pkgHelperDict = dict()
-        for line in pkgsInfoString.split("\n"):
-            lineData = line.split(";")
-            if lineData[Q.Name] in ignoreSet:
-                ignoredPackages.add(lineData[Q.Name])
-            else:
-                pkgsInfo.append((lineData[Q.Name],
-                                 {
-                                     StaticInfo.dictKeyName: lineData[Q.Name],
-                                     StaticInfo.dictKeyVersion: lineData[Q.Version],
-                                     StaticInfo.dictKeyArchitecture: lineData[Q.Arch],
-                                     StaticInfo.dictKeyEssential: False,
-                                     StaticInfo.dictKeyInstallSize: lineData[Q.InstallSize],
-                                     StaticInfo.dictKeyFilePath: None
-                                 }))
-                pkgHelperDict[lineData[Q.Name]] = {StaticInfo.dictKeyName: lineData[Q.Name],
-                                                   StaticInfo.dictKeyVersion: lineData[Q.Version],
-                                                   StaticInfo.dictKeyArchitecture: lineData[Q.Arch],
-                                                   StaticInfo.dictKeyEssential: False,
-                                                   StaticInfo.dictKeyInstallSize: lineData[Q.InstallSize],
-                                                   StaticInfo.dictKeyFilePath: None}
-
-        graph.add_nodes_from(pkgsInfo)
-
-
-        # Obtain Package Dependencies from guest
-        vmiPathDepInfo = "/var/tempDependencies.txt"
+            rpmCommand = "rpm --dbpath " + pipes.quote(os.path.abspath(localDBFolder))
 
-        try:
-            guest.sh("rpmdep -level --all > %s" % vmiPathDepInfo)
-        except RuntimeError as e:
-            if "WARNING (name2pac) can not find who provides " in e.message:
-                pass
-            else:
-                sys.exit("ERROR while fetching dependency information from guest:\n" + e.message)
+            def runOnHost(script):
+                return subprocess.check_output(["sh", "-c", script])
 
-        guest.download(vmiPathDepInfo, StaticInfo.relPathLocalRepositoryTempDepInfo)
-        guest.rm_rf(vmiPathDepInfo)
+            return VMIGraph.createGraphDNFFromQuery(VMIGraph.runRpmQuery(runOnHost, rpmCommand),
+                                                    lambda fileNames: VMIGraph.getRpmFileOwners(runOnHost, rpmCommand, fileNames),
+                                                    verbose=verbose)
+        finally:
+            shutil.rmtree(localDBFolder)
 
-        pkgsDepString = open(StaticInfo.relPathLocalRepositoryTempDepInfo, "r").read()
-        os.remove(StaticInfo.relPathLocalRepositoryTempDepInfo)
+    @staticmethod
+    def runRpmQuery(run, rpmCommand):
+        """
+            Queries name, version, architecture, size, requires and provides of all packages in one pass
+        :param run: function that executes a shell command (in the guest or on the host) and returns its output
+        :param rpmCommand: e.g. "rpm" or "rpm --dbpath /path/to/db"
+        :return: lines of output
+        """
+        return run(rpmCommand + " --query --all --queryformat '" + VMIGraph.rpmQueryFormat + "'").split("\n")
 
-        # List of edge data (fromNode, toNode and attributes)
-        depList = []  # in the form of [(pkg,deppkg,{constraint:True, operator:">=", version:"1.6"})]
+    @staticmethod
+    def getRpmFileOwners(run, rpmCommand, fileNames):
+        """
+            Resolves file capabilities (e.g. "/bin/sh") to the packages owning these files, with one call to run
+        :return: dict in the form of {fileName: set(pkgName)}
+        """
+        owners = defaultdict(set)
+        if len(fileNames) == 0:
+            return owners
+        script = "for f in " + " ".join(pipes.quote(fileName) for fileName in fileNames) + "; do " \
+                 "echo \"#$f\"; " + rpmCommand + " --query --file --queryformat '%{NAME}\\n' \"$f\"; " \
+                 "done; true"
+        fileName = None
+        for line in run(script).split("\n"):
+            if line.startswith("#"):
+                fileName = line[1:]
+            elif fileName is not None and line != "" and " " not in line:
+                # lines with spaces are messages like "file /x is not owned by any package"
+                owners[fileName].add(line)
+        return owners
 
-        for line in pkgsDepString.split("\n"):
-            matchResult = depMatcher.match(line)
-            if not matchResult:
-                #print "ERROR: Could not match Dependency line: \"%s\"" % line
-                pass
-            if matchResult:
-                pkgName = matchResult.group(1)
-                depName = matchResult.group(2)
-                if ("rpmlib" in pkgName or
-                    "rpmlib" in depName or
-                    pkgName in ignoreSet or
-                    depName in ignoreSet):
-                    pass
-                elif (pkgName in pkgHelperDict and
-                      depName in pkgHelperDict):
-                    depList.append((pkgName, depName))
-                    depList.append((pkgName, depName,
-                                    {
-                                        StaticInfo.dictKeyConstraint: False,
-                                        StaticInfo.dictKeyOperator: "",
-                                        StaticInfo.dictKeyVersion: ""}))
+    @staticmethod
+    def createGraphDNFFromQuery(queryLines, getFileOwners, verbose=False):
+        """
+            Creates the graph from the output of runRpmQuery.
+            Required capabilities are resolved to packages through an index of provided capabilities,
+            required files are resolved with getFileOwners.
+        :param queryLines: output of runRpmQuery
+        :param getFileOwners: function in the form of getRpmFileOwners(fileNames) -> {fileName: set(pkgName)}
+        :return: PackageGraph
+        """
+        ignoreSet = {"filesystem"}
+        ignoredPackages = set()
 
+        # List of node names and attributes
+        pkgsInfo = []  # in the form of [(pkg,{name:"pkg", version:"1.1", architecture:"amd64", essential:False, installsize:10})]
+                       # essential not present in dnf
+        requires = []  # in the form of [(pkg, capability)]
+        providers = defaultdict(set)  # in the form of {capability: set(pkg)}
+        pkgName = None
+        for line in queryLines:
+            if line.startswith("@"):
+                lineData = line[1:].split(";")
+                pkgName = lineData[0]
+                if pkgName in ignoreSet:
+                    ignoredPackages.add(pkgName)
+                    pkgName = None
                 else:
-                    print "Not processed: %s -> %s" % (pkgName, depName)
+                    pkgsInfo.append((pkgName,
+                                     {
+                                         StaticInfo.dictKeyName: lineData[0],
+                                         StaticInfo.dictKeyVersion: lineData[1],
+                                         StaticInfo.dictKeyArchitecture: lineData[2],
+                                         StaticInfo.dictKeyEssential: False,
+                                         StaticInfo.dictKeyInstallSize: lineData[3],
+                                         StaticInfo.dictKeyFilePath: None
+                                     }))
+            elif pkgName is None:
+                pass
+            elif line.startswith("R"):
+                requires.append((pkgName, line[1:]))
+            elif line.startswith("P"):
+                providers[line[1:]].add(pkgName)
+
+        # files are not part of the provides, resolve required files that are not provided explicitly
+        requiredFiles = sorted(set(capability for (_, capability) in requires
+                                   if capability.startswith("/") and capability not in providers))
+        for fileName, owners in getFileOwners(requiredFiles).iteritems():
+            providers[fileName].update(owners)
+
+        # List of edge data (fromNode, toNode and attributes)
+        pkgNames = set(pkg for (pkg, _) in pkgsInfo)
+        depSet = set()  # in the form of {(pkg,deppkg)}
+        unresolved = set()
+        for (pkg, capability) in requires:
+            if capability.startswith("rpmlib("):
+                continue
+            if capability not in providers:
+                unresolved.add(capability)
+            for depPkg in providers.get(capability, ()):
+                if depPkg != pkg and depPkg in pkgNames:
+                    depSet.add((pkg, depPkg))
+        depList = [(pkg, depPkg,
+                    {
+                        StaticInfo.dictKeyConstraint: False,
+                        StaticInfo.dictKeyOperator: "",
+                        StaticInfo.dictKeyVersion: ""})
+                   for (pkg, depPkg) in sorted(depSet)]
 
-        graph.add_edges_from(depList)
+        graph = PackageGraph(pkgsInfo, depList)
         if verbose==True and len(ignoredPackages) > 0:
             print "\tThe following packages were ignored while creating the VMI graph:"
             print "\t\t" + ",".join(ignoredPackages)
-        return graph
\ No newline at end of file
+        if verbose==True and len(unresolved) > 0:
+            print "\t%i required capabilities are not provided by any installed package." % len(unresolved)
+        return graph
+
+    @staticmethod
+    def getInstalledPackages(guest, pkgManagement):
+        """
+            Lists installed packages without resolving any dependencies (only supported for dnf,
+            for apt creating the graph from the status file is not more expensive)
+        :return: dict in the form of {pkgName: (version, architecture)} or None if not supported
+        """
+        if pkgManagement != "dnf":
+            return None
+        pkgsInfoString = guest.sh("rpm --query --all --queryformat '%{NAME};%{VERSION};%{ARCH}\\n'")
+        installed = dict()
+        for line in pkgsInfoString.split("\n"):
+            if line != "":
+                (name, version, arch) = line.split(";")
+                installed[name] = (version, arch)
+        return installed
+
+
+class GraphCache:
+    """
+        Persists VMI graphs on disk, keyed by a checksum of the package database of the guest.
+        If the package database of a VMI changed since its graph was cached and packages were only removed
+        (e.g. after decomposition), the new graph is derived from the cached one instead of being rebuilt.
+        Updates are serialized across processes (e.g. descriptor and decomposition workers) by a lock file.
+    """
+    packageDBFiles = {
+        "apt": ["/var/lib/dpkg/status"],
+        "dnf": ["/var/lib/rpm/Packages", "/var/lib/rpm/rpmdb.sqlite"]
+    }
+    lock = FileLock(StaticInfo.relPathLocalRepositoryGraphCacheLock)
+
+    @staticmethod
+    def getGraph(guest, pkgManagement, pathToVMI, verbose=False):
+        """
+            Returns the graph of the guest from the cache or creates it with VMIGraph.createGraph
+        """
+        fingerprint = GraphCache.getFingerprint(guest, pkgManagement)
+        if fingerprint is None:
+            return VMIGraph.createGraph(guest, pkgManagement, verbose=verbose)
+
+        graph = GraphCache.get(fingerprint)
+        if graph is not None:
+            if verbose:
+                print "\tPackage database unchanged, using cached graph."
+        else:
+            graph = GraphCache.getGraphFromDelta(guest, pkgManagement, pathToVMI, verbose=verbose)
+            if graph is None:
+                graph = VMIGraph.createGraph(guest, pkgManagement, verbose=verbose)
+        GraphCache.put(pathToVMI, fingerprint, graph)
+        return graph
+
+    @staticmethod
+    def getFingerprint(guest, pkgManagement):
+        for path in GraphCache.packageDBFiles.get(pkgManagement, []):
+            if guest.is_file(path):
+                return pkgManagement + "_" + guest.checksum("sha1", path)
+        return None
+
+    @staticmethod
+    def getGraphFromDelta(guest, pkgManagement, pathToVMI, verbose=False):
+        """
+            Derives the graph from the last cached graph of the same VMI if packages were only removed
+        :return: PackageGraph or None if the graph has to be rebuilt
+        """
+        # the index is replaced in one step (see put), reading does not require the lock
+        previousFingerprint = GraphCache.loadIndex().get(os.path.realpath(pathToVMI))
+        if previousFingerprint is None:
+            return None
+        previousGraph = GraphCache.get(previousFingerprint)
+        if previousGraph is None:
+            return None
+        installed = VMIGraph.getInstalledPackages(guest, pkgManagement)
+        if installed is None:
+            return None
+        previousNodeData = previousGraph.getNodeDataDict()
+        for (name, (version, arch)) in installed.iteritems():
+            if (name not in previousNodeData
+                    or previousNodeData[name][StaticInfo.dictKeyVersion] != version
+                    or previousNodeData[name][StaticInfo.dictKeyArchitecture] != arch):
+                return None
+        if verbose:
+            print "\tPackage database changed, %i package(s) removed from cached graph." \
+                  % (len(previousNodeData) - len(installed))
+        # ignored packages (see createGraphDNFFromQuery) are not part of the graph and are dropped by subgraph
+        return previousGraph.subgraph(installed.keys())
+
+    @staticmethod
+    def getGraphPath(fingerprint):
+        return StaticInfo.relPathLocalRepositoryGraphCache + "/" + fingerprint + ".graph"
+
+    @staticmethod
+    def loadIndex():
+        """
+        :return: dict in the form of {absolute path to VMI: fingerprint of its last cached graph}
+        """
+        if not os.path.isfile(StaticInfo.relPathLocalRepositoryGraphCacheIndex):
+            return dict()
+        try:
+            with open(StaticInfo.relPathLocalRepositoryGraphCacheIndex, "r") as indexFile:
+                return dict((str(path), str(fingerprint)) for (path, fingerprint) in json.load(indexFile).iteritems())
+        except ValueError:
+            return dict()
+
+    @staticmethod
+    def get(fingerprint):
+        graphPath = GraphCache.getGraphPath(fingerprint)
+        if not os.path.isfile(graphPath):
+            return None
+        try:
+            return PackageGraph.read(graphPath)
+        except Exception as e:
+            print "Cached graph \"%s\" cannot be read (%s) and will be rebuilt." % (graphPath, e)
+            return None
+
+    @staticmethod
+    def put(pathToVMI, fingerprint, graph):
+        if not os.path.isdir(StaticInfo.relPathLocalRepository):
+            return
+        with GraphCache.lock:
+            if not os.path.isdir(StaticInfo.relPathLocalRepositoryGraphCache):
+                os.mkdir(StaticInfo.relPathLocalRepositoryGraphCache)
+            graphPath = GraphCache.getGraphPath(fingerprint)
+            if not os.path.isfile(graphPath):
+                # write to temporary file first, concurrent readers never see a partial graph
+                tmpPath = "%s.%i.tmp" % (graphPath, os.getpid())
+                graph.write(tmpPath)
+                os.rename(tmpPath, graphPath)
+            else:
+                # used again, removed last (see removeUnusedGraphs)
+                os.utime(graphPath, None)
+            index = GraphCache.loadIndex()
+            index[os.path.realpath(pathToVMI)] = fingerprint
+            GraphCache.removeUnusedGraphs(index)
+            tmpPath = "%s.%i.tmp" % (StaticInfo.relPathLocalRepositoryGraphCacheIndex, os.getpid())
+            with open(tmpPath, "w") as indexFile:
+                json.dump(index, indexFile)
+            os.rename(tmpPath, StaticInfo.relPathLocalRepositoryGraphCacheIndex)
+
+    @staticmethod
+    def removeUnusedGraphs(index):
+        """
+            Keeps at most StaticInfo.graphCacheMaxEntries graphs, least recently written or used graphs are removed first
+        """
+        graphFiles = [fileName for fileName in os.listdir(StaticInfo.relPathLocalRepositoryGraphCache) if fileName.endswith(".graph")]
+        if len(graphFiles) <= StaticInfo.graphCacheMaxEntries:
+            return
+        graphFiles.sort(key=lambda fileName: os.path.getmtime(StaticInfo.relPathLocalRepositoryGraphCache + "/" + fileName))
+        for fileName in graphFiles[:len(graphFiles) - StaticInfo.graphCacheMaxEntries]:
+            os.remove(StaticInfo.relPathLocalRepositoryGraphCache + "/" + fileName)
+            fingerprint = fileName[:-len(".graph")]
+            for (path, indexedFingerprint) in index.items():
+                if indexedFingerprint == fingerprint:
+                    del index[path]
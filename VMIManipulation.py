@@ -5,12 +5,12 @@ import itertools
 import threading
 import time
 import guestfs
-import tarfile
 from abc import ABCMeta, abstractmethod
 import subprocess
 
 import shutil
 
+from GuestFSHelper import GuestFSHelper, GuestFSTarStream
 from StaticInfo import StaticInfo
 
 
@@ -33,12 +33,13 @@ class VMIManipulator:
     @staticmethod
     def getVMIManipulator(pathToVMI, vmiName, guest, root, pkgManager=None, distro=None, arch=None):
         #print ('Creating VMIManipulator for disk: \"' + pathToVMI + '\"')
+        inspectionData = GuestFSHelper.getInspectionData(guest, root)
         if pkgManager is None:
-            pkgManager  = guest.inspect_get_package_management(root)
+            pkgManager  = inspectionData["pkgManager"]
         if distro is None:
-            distro      = guest.inspect_get_distro(root)
+            distro      = inspectionData["distribution"]
         if arch is None:
-            arch        = guest.inspect_get_arch(root)
+            arch        = inspectionData["architecture"]
         '''print "VMIManipulatorAPT"
         print "Distribution:\t\t" + distro
         print "Package Management:\t" + pkgManager'''
@@ -49,6 +50,34 @@ class VMIManipulator:
         else:
             raise (Exception("VMI's Package Management \"" + pkgManager + "\" is not supported."))
 
+    def downloadFiles(self, guestFolder, localFolder):
+        """
+            Streams all files in guestFolder into localFolder (flattens directory structure), without a temporary
+            archive on the host. Files are written under a temporary name and replaced in one step
+            (VMIs decomposed at the same time can export the same package).
+        :return: list of local paths
+        """
+        localPaths = []
+        with GuestFSTarStream(self.guest, guestFolder, "r") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                localPath = localFolder + "/" + os.path.basename(member.name)
+                tmpPath = "%s.%s.%i.tmp" % (localPath, self.vmiName, os.getpid())
+                with open(tmpPath, "wb") as localFile:
+                    shutil.copyfileobj(tar.extractfile(member), localFile)
+                os.rename(tmpPath, localPath)
+                localPaths.append(localPath)
+        return localPaths
+
+    def uploadFiles(self, localPaths, guestFolder):
+        """
+            Streams files into guestFolder (relative paths are kept), without a temporary archive on the host
+        """
+        with GuestFSTarStream(self.guest, guestFolder, "w") as tar:
+            for localPath in localPaths:
+                tar.add(localPath)
+
     def checkSELinux(self):
         try:
             self.guest.sh("sestatus")
@@ -66,6 +95,9 @@ class VMIManipulator:
     @abstractmethod
     def removePackages(self, packageList):pass
 
+    @abstractmethod
+    def simulateRemovePackages(self, packageList):pass
+
     @abstractmethod
     def exportHomeDir(self): pass
 
@@ -211,13 +243,9 @@ class VMIManipulatorAPT(VMIManipulator):
             packageFileNames = self.guest.sh(
                 "cd /var/exportpackages && fakeroot -u dpkg-repack " + " ".join(packageDict.keys()))
 
-            # Download and extract packages, delete temp folder in guest
-            localpackagesFilePath = self.local_packageFolder + "/" + self.vmiName + "Packages.tar"
-            self.guest.tar_out(self.vmi_repackagingFolder, localpackagesFilePath)
+            # Download packages, delete temp folder in guest
+            self.downloadFiles(self.vmi_repackagingFolder, self.local_packageFolder)
             self.guest.rm_rf(self.vmi_repackagingFolder)
-            with tarfile.open(localpackagesFilePath) as tar:
-                tar.extractall(path=self.local_packageFolder)
-            os.remove(localpackagesFilePath)
 
             # save filename information of packages
             for line in packageFileNames.split("\n"):
@@ -243,18 +271,12 @@ class VMIManipulatorAPT(VMIManipulator):
 
         # check if installation necessary
         if len(mainServices) > 0:
-            # prepare tarfile with compressed packages for import
-            localpackagesFilePath = self.local_packageFolder + "/" + self.vmiName + "Packages.tar"
-            with tarfile.open(localpackagesFilePath, mode='w') as tar:
-                for pkgFileName in filenames:
-                    tar.add(pkgFileName)
-
             # Upload packages to temporary repository
             try:
                 self.guest.mkdir(self.vmi_repoFolder)
             except:
                 print "\"" + self.vmi_repoFolder + "\" already exist in guest. Proceeding anyway."
-            self.guest.tar_in(localpackagesFilePath, self.vmi_repoFolder)
+            self.uploadFiles(filenames, self.vmi_repoFolder)
 
             # Rename default .list
             self.guest.rename("/etc/apt/sources.list", "/etc/apt/sources.list2")
@@ -290,9 +312,6 @@ class VMIManipulatorAPT(VMIManipulator):
             self.guest.rename("/etc/apt/sources.list2", "/etc/apt/sources.list")
             self.guest.rename("/etc/apt/sources.list.d2", "/etc/apt/sources.list.d")
 
-            # Remove temporary tarfile
-            os.remove(localpackagesFilePath)
-
         return errorString
 
     def removePackages(self, packageList):
@@ -304,6 +323,22 @@ class VMIManipulatorAPT(VMIManipulator):
         self.guest.sh("DEBIAN_FRONTEND=noninteractive apt-get purge --auto-remove -y " + " ".join(packageList))
         self.guest.sh("DEBIAN_FRONTEND=noninteractive apt-get clean")
 
+    def simulateRemovePackages(self, packageList):
+        """
+            Same removal as removePackages, only simulated (apt-get -s), the VMI is not changed
+        :param packageList: packages to remove (main services)
+        :return: set of packages that would be removed
+        """
+        output = self.guest.sh("DEBIAN_FRONTEND=noninteractive apt-get -s purge --auto-remove -y " + " ".join(packageList))
+        # in the form of "Purg pkg [1.1]" or "Purg pkg:amd64 [1.1]"
+        removeMatcher = re.compile(r"^(?:Purg|Remv) ([^ :]+)")
+        removedPackages = set()
+        for line in output.split("\n"):
+            matchResult = removeMatcher.match(line)
+            if matchResult:
+                removedPackages.add(matchResult.group(1))
+        return removedPackages
+
     def exportHomeDir(self):
         if os.path.isfile(self.localUserBackupPath):
             print "\tExisting user folder in " + self.localUserBackupPath + " will be replaced."
@@ -381,22 +416,9 @@ class VMIManipulatorDNF(VMIManipulator):
                     print "\t\tOutput of repackaging:"
                     print "\t\t" + str(output)
             print ""
-            # Download and extract packages, delete temp folder in guest
-            localTempFileFolder = self.local_packageFolder + "/" + self.vmiName
-            os.mkdir(localTempFileFolder)
-            localTempPackagesTar = localTempFileFolder + "/Packages.tar"
-
-            self.guest.tar_out(self.vmi_repackagingFolder, localTempPackagesTar)
+            # Download packages (flattens directory structure), delete temp folder in guest
+            self.downloadFiles(self.vmi_repackagingFolder, self.local_packageFolder)
             self.guest.rm_rf(self.vmi_repackagingFolder)
-            with tarfile.open(localTempPackagesTar) as tar:
-                tar.extractall(path=localTempFileFolder)
-            os.remove(localTempPackagesTar)
-
-            # move files in temp folder to actual repository folder (flattens directory structure)
-            for root, _dirs, files in os.walk(localTempFileFolder):
-                for filename in files:
-                    shutil.move(root + "/" + filename, self.local_packageFolder + "/" + filename)
-            shutil.rmtree(localTempFileFolder)
 
         # make sure every package in packageInfoDict has a path
         for pkg, pkgInfo in packageInfoDict.iteritems():
@@ -408,19 +430,13 @@ class VMIManipulatorDNF(VMIManipulator):
     def importPackages(self, mainServices, filenames):
         if len(mainServices) > 0:
 
-            # prepare tarfile with compressed packages for import
-            localPkgsTarPath = self.local_packageFolder + "/" + self.vmiName + "Packages.tar"
-            with tarfile.open(localPkgsTarPath, mode='w') as tar:
-                for pkgFileName in filenames:
-                    tar.add(pkgFileName)
-
             # Upload packages to temporary repository
             try:
                 self.guest.mkdir(self.vmi_repoFolder)
             except:
                 print "\"" + self.vmi_repoFolder + "\" already exist in guest. Proceeding anyway."
 
-            self.guest.tar_in(localPkgsTarPath, self.vmi_repoFolder)
+            self.uploadFiles(filenames, self.vmi_repoFolder)
 
             # Backup VMI repo configs locally and remove in vmi
             localVmiRepoConfigBackup = StaticInfo.relPathLocalRepository + "/" + self.vmiName + "_repoConfigs.tar"
@@ -451,9 +467,6 @@ class VMIManipulatorDNF(VMIManipulator):
             # Remove original repo config backup
             os.remove(localVmiRepoConfigBackup)
 
-            # Remove temporary tarfile
-            os.remove(localPkgsTarPath)
-
             # Cleanup repository
             self.guest.sh("dnf clean all")
 
@@ -467,6 +480,30 @@ class VMIManipulatorDNF(VMIManipulator):
         self.guest.sh("dnf autoremove")
         self.guest.sh("dnf clean all")
 
+    def simulateRemovePackages(self, packageList):
+        """
+            Same removal as removePackages, only simulated (dnf --assumeno), the VMI is not changed.
+            Packages orphaned before the removal (removed by "dnf autoremove") are not included.
+        :param packageList: packages to remove (main services)
+        :return: set of packages that would be removed
+        """
+        # dnf prints the transaction and fails when the answer is no
+        output = self.guest.sh("dnf remove --assumeno " + " ".join(packageList) + " 2>&1; true")
+        if "Problem: The operation would result in removing the following protected packages:" in output:
+            sys.exit("Cannot remove main services \"%s\". Error:\n%s" % (",".join(packageList), output))
+        # packages are listed after "Removing:" (and "Removing unused dependencies:" etc.) in the form of
+        # " pkg   x86_64   1.1-1.fc26   @updates   1.2 M", long names are continued on the next line
+        removedPackages = set()
+        inTransaction = False
+        for line in output.split("\n"):
+            if line.startswith("Removing"):
+                inTransaction = True
+            elif line.startswith("Transaction Summary"):
+                break
+            elif inTransaction and line.startswith(" ") and not line.startswith("  "):
+                removedPackages.add(line.split()[0])
+        return removedPackages
+
     def exportHomeDir(self):
         if os.path.isfile(self.localUserBackupPath):
             print "Existing user folder in " + self.localUserBackupPath + " will be replaced."
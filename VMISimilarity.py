@@ -1,11 +1,72 @@
+import itertools
+import multiprocessing
 import sys
 from collections import defaultdict
 
 from StaticInfo import StaticInfo
-from GuestFSHelper import GuestFSHelper
+from GuestFSHelper import GuestFSHelper, GuestFSBatchSession
+from MinHash import MinHash
+from PackageGraph import PackageGraph
+from RepositoryDatabase import RepositoryDatabase
+from SimilarityMatrix import SimilarityMatrix
 from VMIDescription import VMIDescriptor
+from VMIGraph import GraphCache
+
+
+def extractPackageTables(vmiDataChunk):
+    """
+        Runs in worker processes of SimilarityCalculator.createVMIDescriptors, attaches all VMIs to one appliance.
+        Only the package tables are sent back: graphs encoded as PackageGraphFile instead of pickled descriptors.
+    :param vmiDataChunk: in the form of [(pathToVMI, vmiFileName, [MS1,MS2])]
+    :return: tuple in the form of (error message or None, [(inspectionData, encoded PackageGraph)])
+    """
+    packageTables = list()
+    try:
+        with GuestFSBatchSession([pathToVMI for (pathToVMI, _, _) in vmiDataChunk]) as session:
+            for (pathToVMI, _, _) in vmiDataChunk:
+                if session.contains(pathToVMI):
+                    (guest, root) = session.openVMI(pathToVMI)
+                    inspectionData = GuestFSHelper.getInspectionData(guest, root)
+                    graph = GraphCache.getGraph(guest, inspectionData["pkgManager"], pathToVMI)
+                    session.closeVMI()
+                else:
+                    (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True, readonly=True)
+                    inspectionData = GuestFSHelper.getInspectionData(guest, root)
+                    graph = GraphCache.getGraph(guest, inspectionData["pkgManager"], pathToVMI)
+                    GuestFSHelper.shutdownHandle(guest)
+                packageTables.append((inspectionData, graph.encode()))
+    except SystemExit as e:
+        # e.g. unknown package manager in VMIGraph, must not end the worker process (pool.imap would wait forever)
+        return (str(e), packageTables)
+    finally:
+        # appliances kept warm by the handle pool would outlive the worker process
+        GuestFSHelper.closeAllHandles()
+    return (None, packageTables)
+
 
 class SimilarityCalculator:
+    # scopes of nearest, in the form of {scope: entity type of the package signatures}
+    nearestScopes = {
+        "masters":      RepositoryDatabase.signatureMaster,
+        "baseimages":   RepositoryDatabase.signatureBaseImage,
+        "vmis":         RepositoryDatabase.signatureVMI
+    }
+
+    @staticmethod
+    def nearest(vmi, k, scope):
+        """
+            Stored entities most similar to vmi, estimated from precomputed package signatures (no graph is loaded)
+        :param VMIDescriptor vmi:
+        :param str scope: "masters" (compared on main services), "baseimages" or "vmis" (compared on all packages)
+        :return: list in the form of [(name, estimated similarity)], most similar first
+        """
+        if scope == "masters":
+            signature = vmi.getMainServicesSignature()
+        else:
+            signature = MinHash.getSignature(MinHash.getTokens(vmi.getPackageIndex()))
+        with RepositoryDatabase() as repoManager:
+            return repoManager.getNearest(signature, k, SimilarityCalculator.nearestScopes[scope])
+
     @staticmethod
     def checkMainServicesExistence(vmiDescriptor1,mainServices):
         for pkgName in mainServices:
@@ -43,8 +104,8 @@ class SimilarityCalculator:
             else:
                 return y
 
-        g1NodesDict = vmi1.getNodeData()
-        g2NodesDict = vmi2.getNodeData()
+        g1NodesDict = vmi1.getPackageIndex()  # in the form of {pkgName: (version, architecture, installsize)}
+        g2NodesDict = vmi2.getPackageIndex()
         numG1Nodes = len(g1NodesDict)
         numG2Nodes = len(g2NodesDict)
 
@@ -72,17 +133,13 @@ class SimilarityCalculator:
 
         # Check similarity for all (prefiltered) packages
         for pkgName in nodesToCheck:
-            pkg1Data = g1NodesDict[pkgName]
-            pkg2Data = g2NodesDict[pkgName]
+            (version1, arch1, _) = g1NodesDict[pkgName]
+            (version2, arch2, _) = g2NodesDict[pkgName]
             if (
                     # Version has to be the same
-                            pkg1Data[StaticInfo.dictKeyVersion] == pkg2Data[StaticInfo.dictKeyVersion]
+                            version1 == version2
                     # Architecture has to be the same, or at least on has to say all
-                    and (
-                            pkg1Data[StaticInfo.dictKeyArchitecture] == pkg2Data[StaticInfo.dictKeyArchitecture]
-                            or pkg1Data[StaticInfo.dictKeyArchitecture] == "all"
-                            or pkg2Data[StaticInfo.dictKeyArchitecture] == "all"
-                    )
+                    and (arch1 == arch2 or arch1 == "all" or arch2 == "all")
             ):
                 numMatches = numMatches + 1
 
@@ -125,8 +182,8 @@ class SimilarityCalculator:
             else:
                 return y
 
-        g1NodesDict = vmi1.getNodeData()
-        g2NodesDict = vmi2.getNodeData()
+        g1NodesDict = vmi1.getPackageIndex()  # in the form of {pkgName: (version, architecture, installsize)}
+        g2NodesDict = vmi2.getPackageIndex()
         numG1Nodes = len(g1NodesDict)
         numG2Nodes = len(g2NodesDict)
 
@@ -152,23 +209,22 @@ class SimilarityCalculator:
         maxInstallSize = 0
         for pkg in nodesToCheck:
             if pkg in g1NodesDict:
-                maxInstallSize = max(maxInstallSize, int(g1NodesDict[pkg][StaticInfo.dictKeyInstallSize]))
+                maxInstallSize = max(maxInstallSize, g1NodesDict[pkg][2])
             if pkg in g2NodesDict:
-                maxInstallSize = max(maxInstallSize, int(g2NodesDict[pkg][StaticInfo.dictKeyInstallSize]))
+                maxInstallSize = max(maxInstallSize, g2NodesDict[pkg][2])
 
         # calculate sumNormSizeAll as sum of normalized sizes (weights)
         sumNormSizeAll = 0.0
         for pkg in nodesToCheck:
             if pkg in g1NodesDict and pkg in g2NodesDict:
                 sumNormSizeAll = sumNormSizeAll +\
-                                 max(g1NodesDict[pkg][StaticInfo.dictKeyInstallSize],
-                                     g2NodesDict[pkg][StaticInfo.dictKeyInstallSize])/maxInstallSize
+                                 max(g1NodesDict[pkg][2], g2NodesDict[pkg][2])/maxInstallSize
             elif pkg in g1NodesDict:
                 sumNormSizeAll = sumNormSizeAll + \
-                                 float(g1NodesDict[pkg][StaticInfo.dictKeyInstallSize]) / maxInstallSize
+                                 float(g1NodesDict[pkg][2]) / maxInstallSize
             elif pkg in g2NodesDict:
                 sumNormSizeAll = sumNormSizeAll + \
-                                 float(g2NodesDict[pkg][StaticInfo.dictKeyInstallSize]) / maxInstallSize
+                                 float(g2NodesDict[pkg][2]) / maxInstallSize
 
         # prefilter nodesToCheck by name occurring in both graphs
         nodesToCheck = nodesToCheck.intersection(set(g1NodesDict.keys()))
@@ -179,22 +235,17 @@ class SimilarityCalculator:
 
         # Check similarity for all (prefiltered) packages
         for pkgName in nodesToCheck:
-            pkg1Data = g1NodesDict[pkgName]
-            pkg2Data = g2NodesDict[pkgName]
+            (version1, arch1, size1) = g1NodesDict[pkgName]
+            (version2, arch2, size2) = g2NodesDict[pkgName]
             if (
                     # Version has to be the same
-                    pkg1Data[StaticInfo.dictKeyVersion] == pkg2Data[StaticInfo.dictKeyVersion]
+                    version1 == version2
                     # Architecture has to be the same, or at least one has to say all
-                    and (
-                            pkg1Data[StaticInfo.dictKeyArchitecture] == pkg2Data[StaticInfo.dictKeyArchitecture]
-                            or pkg1Data[StaticInfo.dictKeyArchitecture] == "all"
-                            or pkg2Data[StaticInfo.dictKeyArchitecture] == "all"
-                    )
+                    and (arch1 == arch2 or arch1 == "all" or arch2 == "all")
             ):
                 numMatches = numMatches + 1
                 sumNormSizeMatches = sumNormSizeMatches\
-                                     + max(pkg1Data[StaticInfo.dictKeyInstallSize],
-                                           pkg2Data[StaticInfo.dictKeyInstallSize])/maxInstallSize
+                                     + max(size1, size2)/maxInstallSize
 
         similarity = float(sumNormSizeMatches) / float(sumNormSizeAll)
 
@@ -221,12 +272,13 @@ class SimilarityCalculator:
 
         # Create Descriptors/Graphs for each VMI
         print "\n=== Creating Descriptor for VMI \"%s\"" % (pathToVMI1)
-        (guest, root) = GuestFSHelper.getHandle(pathToVMI1, rootRequired=True)
+        GuestFSHelper.prelaunchHandle(pathToVMI2, readonly=True)
+        (guest, root) = GuestFSHelper.getHandle(pathToVMI1, rootRequired=True, readonly=True)
         vmi1 = VMIDescriptor(pathToVMI1, "internal_vmi1", mainServices1, guest, root)
         GuestFSHelper.shutdownHandle(guest)
 
         print "\n=== Creating Descriptor for VMI \"%s\"" % (pathToVMI2)
-        (guest, root) = GuestFSHelper.getHandle(pathToVMI2, rootRequired=True)
+        (guest, root) = GuestFSHelper.getHandle(pathToVMI2, rootRequired=True, readonly=True)
         vmi2 = VMIDescriptor(pathToVMI2, "internal_vmi2", mainServices2, guest, root)
         GuestFSHelper.shutdownHandle(guest)
 
@@ -238,6 +290,86 @@ class SimilarityCalculator:
         graphSimilarity = SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors(vmi1, vmi2, onlyOnMainServices)
         return graphSimilarity
 
+    @staticmethod
+    def createVMIDescriptors(vmiData):
+        """
+            Creates descriptors for many VMIs in StaticInfo.guestfsMaxConcurrentAppliances worker processes,
+            each attaching a group of VMIs to one shared appliance
+        :param vmiData: in the form of [(pathToVMI, vmiFileName, [MS1,MS2])]
+        :return: list of VMIDescriptors in the same order
+        """
+        numProcesses = max(1, min(StaticInfo.guestfsMaxConcurrentAppliances, len(vmiData)))
+        vmiDataChunks = GuestFSBatchSession.chunks(vmiData, minChunks=numProcesses)
+        pool = None
+        if numProcesses == 1:
+            packageTableChunks = itertools.imap(extractPackageTables, vmiDataChunks)
+        else:
+            pool = multiprocessing.Pool(processes=numProcesses, initializer=GuestFSHelper.initializeWorkerProcess)
+            packageTableChunks = pool.imap(extractPackageTables, vmiDataChunks)
+
+        vmiDescriptors = list()
+        try:
+            for (vmiDataChunk, (error, packageTables)) in itertools.izip(vmiDataChunks, packageTableChunks):
+                for ((pathToVMI, vmiFileName, mainServices), (inspectionData, graphData)) in zip(vmiDataChunk, packageTables):
+                    print "Created Descriptor for vmi \"%s\" (%i/%i)" % (vmiFileName, len(vmiDescriptors) + 1, len(vmiData))
+                    vmi = VMIDescriptor(pathToVMI, vmiFileName, mainServices, None, None)
+                    vmi.initializeFromInspectionData(inspectionData, PackageGraph.decode(graphData))
+                    vmiDescriptors.append(vmi)
+                if error is not None:
+                    sys.exit(error)
+        except:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+                pool = None
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return vmiDescriptors
+
+    @staticmethod
+    def computeSimilarityMatrix(vmiDescriptors, onlyOnMainServices):
+        """
+            Weighted similarities between all VMIs, pairs of package sets that were compared before are taken
+            from the similarity cache in the repository database
+        :param list vmiDescriptors: list of VMIDescriptors
+        :return: list of lists in the form of matrix[i][j] = similarity between VMI i and VMI j
+        """
+        fingerprints = [vmi.getSimilarityFingerprint(onlyOnMainServices) for vmi in vmiDescriptors]
+        with RepositoryDatabase() as repoManager:
+            cachedSimilarities = repoManager.getCachedSimilarities(fingerprints, onlyOnMainServices)
+
+        matrix = [[0.0] * len(vmiDescriptors) for _ in vmiDescriptors]
+        missingPairs = defaultdict(list)  # in the form of {i: [j]} with i < j
+        for i in range(len(vmiDescriptors)):
+            for j in range(i + 1, len(vmiDescriptors)):
+                key = tuple(sorted((fingerprints[i], fingerprints[j])))
+                if key in cachedSimilarities:
+                    matrix[i][j] = matrix[j][i] = cachedSimilarities[key]
+                else:
+                    missingPairs[i].append(j)
+        numMissing = sum(len(others) for others in missingPairs.itervalues())
+        print "Similarities: %i pairs taken from cache, %i to compute" \
+              % (len(vmiDescriptors) * (len(vmiDescriptors) - 1) / 2 - numMissing, numMissing)
+        if numMissing == 0:
+            return matrix
+
+        # only VMIs of missing pairs are encoded
+        missingVMIs = sorted(set(missingPairs.keys()).union(*missingPairs.values()))
+        positions = dict((i, position) for (position, i) in enumerate(missingVMIs))
+        similarityMatrix = SimilarityMatrix([vmiDescriptors[i] for i in missingVMIs], onlyOnMainServices)
+        newSimilarities = dict()
+        for (i, others) in missingPairs.iteritems():
+            similarities = similarityMatrix.getSimilarities(positions[i], [positions[j] for j in others])
+            for (j, similarity) in zip(others, similarities):
+                matrix[i][j] = matrix[j][i] = float(similarity)
+                newSimilarities[tuple(sorted((fingerprints[i], fingerprints[j])))] = float(similarity)
+        with RepositoryDatabase() as repoManager:
+            repoManager.addCachedSimilarities(newSimilarities, onlyOnMainServices)
+        return matrix
+
     @staticmethod
     def computeSimilarityManyToMany(vmiData, onlyOnMainServices):
         if onlyOnMainServices:
@@ -245,30 +377,20 @@ class SimilarityCalculator:
         else:
             print "=====Calculating similarities between each of %i VMIs" % len(vmiData)
 
-        sortedVMIDescriptorList = list()
-        count = 0
-        for (pathToVMI, vmiFileName, mainServices) in vmiData:
-            count = count + 1
-            print "Creating Descriptor for vmi \"%s\" (%i/%i)..." % (vmiFileName, count, len(vmiData))
-            (guest, root) = GuestFSHelper.getHandle(pathToVMI, rootRequired=True)
-            vmi = VMIDescriptor(pathToVMI, vmiFileName, mainServices, guest, root)
-            GuestFSHelper.shutdownHandle(guest)
-            sortedVMIDescriptorList.append(vmi)
+        sortedVMIDescriptorList = SimilarityCalculator.createVMIDescriptors(vmiData)
+        for vmi in sortedVMIDescriptorList:
+            # Check if Main Services exist
+            SimilarityCalculator.checkMainServicesExistence(vmi, vmi.mainServices)
 
+        matrix = SimilarityCalculator.computeSimilarityMatrix(sortedVMIDescriptorList, onlyOnMainServices)
         similarities = defaultdict(dict)
-        for vmi1 in sortedVMIDescriptorList:
+        for (i, vmi1) in enumerate(sortedVMIDescriptorList):
             print "Similarities for VMI \"%s\":" % vmi1.vmiName
-            for vmi2 in sortedVMIDescriptorList:
+            for (j, vmi2) in enumerate(sortedVMIDescriptorList):
                 if vmi1.pathToVMI == vmi2.pathToVMI:
                     similarities[vmi1.vmiName][vmi2.vmiName] = None
                 else:
-                    # Check if Main Services exist
-                    SimilarityCalculator.checkMainServicesExistence(vmi1, vmi1.mainServices)
-                    SimilarityCalculator.checkMainServicesExistence(vmi2, vmi2.mainServices)
-
-                    sim = SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors(vmi1, vmi2,
-                                                                                              onlyOnMainServices,
-                                                                                              verbose=False)
+                    sim = float(matrix[i][j])
                     similarities[vmi1.vmiName][vmi2.vmiName] = sim
                     print "\t%0.2f similarity to VMI \"%s\"" % (sim, vmi2.vmiName)
         return similarities
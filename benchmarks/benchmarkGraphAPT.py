@@ -0,0 +1,81 @@
+"""
+    Benchmark of VMIGraph.createGraphAPT on a recorded dpkg-query output, no appliance is required.
+
+    Usage (from the repository root):
+        python2 benchmarks/benchmarkGraphAPT.py [pathToFixture] [repetitions]
+        python2 benchmarks/benchmarkGraphAPT.py --generate pathToFixture
+
+    The default fixture is a synthetic dump of 3,000 packages (fixtures/dpkgQuery3000.txt.gz) in the format of the
+    dpkg-query call in createGraphAPT, with 8 relations per package (shared libraries with version constraints,
+    alternatives, :any qualifiers and Pre-Depends). The digest of the graph is printed to check that two
+    implementations create the same graph, e.g. when running the benchmark on two commits.
+"""
+import gzip
+import hashlib
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from VMIGraph import VMIGraph
+
+defaultFixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "dpkgQuery3000.txt.gz")
+
+
+class RecordedGuest:
+    """
+        Replays the recorded output of guest.sh
+    """
+    def __init__(self, output):
+        self.output = output
+
+    def sh(self, command):
+        return self.output
+
+
+def generateFixture(path, numPackages=3000, seed=1):
+    random.seed(seed)
+    names = ["pkg%i" % i for i in range(numPackages)]
+    libraries = ["libc6 (>= 2.14)", "libssl1.1 (>= 1.1.0)", "zlib1g (>= 1:1.1.4)", "libgcc1 (>= 1:3.0)",
+                 "debconf (>= 0.5) | debconf-2.0", "perl:any", "python3:any (>= 3.5~)"]
+    lines = []
+    for (i, name) in enumerate(names):
+        depends = random.sample(libraries, 3) \
+            + ["%s (= 1.%i)" % (random.choice(names), i % 7) for _ in range(4)] \
+            + ["%s | %s" % (random.choice(names), random.choice(names))]
+        lines.append("%s;1.%i;%s;%s;%i;%s;%s" % (name, i, random.choice(["amd64", "all"]),
+                                                "yes" if i % 50 == 0 else "no", i, ", ".join(depends),
+                                                "dpkg (>= 1.15)" if i % 10 == 0 else ""))
+    lines.extend(["libc6;2.27;amd64;no;100;;", "libssl1.1;1.1;amd64;no;1;;", "zlib1g;1;amd64;no;1;;",
+                  "libgcc1;1;amd64;no;1;;", "debconf;1;all;no;1;;", "perl;5;amd64;no;1;;", "python3;3.6;amd64;no;1;;",
+                  "dpkg;1.19;amd64;yes;1;;"])
+    with gzip.open(path, "wb") as fixture:
+        fixture.write("\n".join(lines) + "\n")
+
+
+def getGraphDigest(graph):
+    return hashlib.md5(repr(sorted(graph.nodes(data=True))) + repr(sorted(graph.edges(data=True)))).hexdigest()
+
+
+def benchmark(pathToFixture, repetitions):
+    with gzip.open(pathToFixture, "rb") as fixture:
+        guest = RecordedGuest(fixture.read())
+    graph = VMIGraph.createGraphAPT(guest)
+    startTime = time.time()
+    for _ in xrange(repetitions):
+        graph = VMIGraph.createGraphAPT(guest)
+    elapsed = (time.time() - startTime) / repetitions
+    print "createGraphAPT: %.3fs (mean of %i runs), max RSS %i KB" \
+          % (elapsed, repetitions, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    print "graph: %i packages, %i dependencies, digest %s" \
+          % (graph.number_of_nodes(), graph.number_of_edges(), getGraphDigest(graph))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--generate":
+        generateFixture(sys.argv[2])
+    else:
+        benchmark(sys.argv[1] if len(sys.argv) > 1 else defaultFixture,
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 5)
@@ -0,0 +1,38 @@
+import unittest
+
+from BloomFilter import BloomFilter
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.capacity = 20000
+        self.falsePositiveRate = 0.01
+        self.bloomFilter = BloomFilter(self.capacity, self.falsePositiveRate)
+        self.keys = ["pkg%i" % i for i in xrange(self.capacity)]
+        for key in self.keys:
+            self.bloomFilter.add(key)
+
+    def testNoFalseNegatives(self):
+        for key in self.keys:
+            self.assertIn(key, self.bloomFilter)
+
+    def testFalsePositiveRate(self):
+        numTests = 100000
+        falsePositives = sum(1 for i in xrange(numTests) if "other%i" % i in self.bloomFilter)
+        self.assertLess(float(falsePositives) / numTests, 1.5 * self.falsePositiveRate)
+
+    def testIsFull(self):
+        self.assertFalse(self.bloomFilter.isFull())
+        self.bloomFilter.add("pkg%i" % self.capacity)
+        self.assertTrue(self.bloomFilter.isFull())
+
+    def testEmpty(self):
+        bloomFilter = BloomFilter(0, self.falsePositiveRate)
+        self.assertNotIn("pkg", bloomFilter)
+        bloomFilter.add("pkg")
+        self.assertIn("pkg", bloomFilter)
+
+
+if __name__ == "__main__":
+    unittest.main()
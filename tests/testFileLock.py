@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from FileLock import FileLock
+
+
+def increment(arguments):
+    """
+        Read-modify-write of a counter file, loses updates without the lock
+    """
+    (lockPath, counterPath, repetitions) = arguments
+    lock = FileLock(lockPath)
+    for _ in xrange(repetitions):
+        with lock:
+            with open(counterPath, "r") as counterFile:
+                value = int(counterFile.read())
+            with open(counterPath, "w") as counterFile:
+                counterFile.write(str(value + 1))
+
+
+class FileLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.counterPath = os.path.join(self.directory, "counter")
+        with open(self.counterPath, "w") as counterFile:
+            counterFile.write("0")
+        self.lockPath = os.path.join(self.directory, "counter.lock")
+        self.lock = FileLock(self.lockPath)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testProcesses(self):
+        pool = multiprocessing.Pool(processes=4)
+        try:
+            pool.map(increment, [(self.lockPath, self.counterPath, 200)] * 4)
+        finally:
+            pool.close()
+            pool.join()
+        with open(self.counterPath, "r") as counterFile:
+            self.assertEqual(int(counterFile.read()), 800)
+
+    def testReleasedOnError(self):
+        def fail():
+            with self.lock:
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        with self.lock:
+            pass
+
+
+if __name__ == "__main__":
+    unittest.main()
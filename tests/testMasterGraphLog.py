@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import networkx as nx
+
+from MasterGraphLog import MasterGraphLog
+from PackageGraph import PackageGraph
+from StaticInfo import StaticInfo
+from testPackageGraph import createRandomGraph, canonical
+
+
+class MasterGraphLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.graphPath = os.path.join(self.directory, "master.graph")
+        # no compaction in the background, tests compact explicitly
+        self.masterGraphLogMaxBytes = StaticInfo.masterGraphLogMaxBytes
+        self.masterGraphLogMaxRatio = StaticInfo.masterGraphLogMaxRatio
+        StaticInfo.masterGraphLogMaxBytes = 1 << 40
+        StaticInfo.masterGraphLogMaxRatio = 1 << 40
+
+        self.nxMaster = createRandomGraph(100, 200, seed=10)
+        PackageGraph.fromMultiDiGraph(self.nxMaster).write(self.graphPath)
+        # overlapping subgraphs with different attributes for the same packages
+        self.nxDeltas = [createRandomGraph(60 + 20 * i, 100, seed=11 + i) for i in xrange(4)]
+        for delta in self.nxDeltas:
+            MasterGraphLog.append(self.graphPath, PackageGraph.fromMultiDiGraph(delta))
+
+    def tearDown(self):
+        StaticInfo.masterGraphLogMaxBytes = self.masterGraphLogMaxBytes
+        StaticInfo.masterGraphLogMaxRatio = self.masterGraphLogMaxRatio
+        shutil.rmtree(self.directory)
+
+    def getExpectedMaster(self):
+        # subgraphs are added one by one with graph = compose(delta, graph), packages already in the master keep their data
+        expected = self.nxMaster
+        for delta in self.nxDeltas:
+            expected = nx.compose(delta, expected)
+        return expected
+
+    def testReadApply(self):
+        (snapshot, deltas) = MasterGraphLog.read(self.graphPath)
+        self.assertEqual(len(deltas), len(self.nxDeltas))
+        self.assertEqual(canonical(snapshot), canonical(self.nxMaster))
+        self.assertEqual(canonical(MasterGraphLog.apply(snapshot, deltas)), canonical(self.getExpectedMaster()))
+
+    def testApplyWithoutLog(self):
+        os.remove(MasterGraphLog.getLogPath(self.graphPath))
+        (snapshot, deltas) = MasterGraphLog.read(self.graphPath)
+        self.assertEqual(deltas, [])
+        self.assertIs(MasterGraphLog.apply(snapshot, deltas), snapshot)
+
+    def testCompact(self):
+        MasterGraphLog.compact(self.graphPath)
+        self.assertFalse(os.path.isfile(MasterGraphLog.getLogPath(self.graphPath)))
+        (snapshot, deltas) = MasterGraphLog.read(self.graphPath)
+        self.assertEqual(deltas, [])
+        self.assertEqual(canonical(snapshot), canonical(self.getExpectedMaster()))
+
+        # appending after a compaction starts a new log
+        self.nxDeltas.append(createRandomGraph(150, 100, seed=20))
+        MasterGraphLog.append(self.graphPath, PackageGraph.fromMultiDiGraph(self.nxDeltas[-1]))
+        (snapshot, deltas) = MasterGraphLog.read(self.graphPath)
+        self.assertEqual(len(deltas), 1)
+        self.assertEqual(canonical(MasterGraphLog.apply(snapshot, deltas)), canonical(self.getExpectedMaster()))
+
+    def testCompactTwice(self):
+        # an interrupted compaction replays subgraphs that are already in the snapshot
+        logPath = MasterGraphLog.getLogPath(self.graphPath)
+        with open(logPath, "rb") as logFile:
+            data = logFile.read()
+        MasterGraphLog.compact(self.graphPath)
+        with open(logPath, "wb") as logFile:
+            logFile.write(data)
+        MasterGraphLog.compact(self.graphPath)
+        self.assertEqual(canonical(PackageGraph.read(self.graphPath)), canonical(self.getExpectedMaster()))
+
+    def testWriteSnapshot(self):
+        newMaster = createRandomGraph(80, 150, seed=21)
+        MasterGraphLog.writeSnapshot(self.graphPath, PackageGraph.fromMultiDiGraph(newMaster))
+        self.assertFalse(os.path.isfile(MasterGraphLog.getLogPath(self.graphPath)))
+        (snapshot, deltas) = MasterGraphLog.read(self.graphPath)
+        self.assertEqual(deltas, [])
+        self.assertEqual(canonical(snapshot), canonical(newMaster))
+        self.assertEqual([name for name in os.listdir(self.directory) if name.endswith(".tmp")], [])
+
+    def testCompactAfterReplace(self):
+        # a new master of the same name is stored while the compaction of the old one is running
+        newMaster = createRandomGraph(80, 150, seed=21)
+        newDelta = createRandomGraph(40, 50, seed=22)
+        apply = MasterGraphLog.apply
+
+        def replaceMaster(snapshot, deltas):
+            MasterGraphLog.writeSnapshot(self.graphPath, PackageGraph.fromMultiDiGraph(newMaster))
+            MasterGraphLog.append(self.graphPath, PackageGraph.fromMultiDiGraph(newDelta))
+            return apply(snapshot, deltas)
+
+        MasterGraphLog.apply = staticmethod(replaceMaster)
+        try:
+            MasterGraphLog.compact(self.graphPath)
+        finally:
+            MasterGraphLog.apply = staticmethod(apply)
+        (snapshot, deltas) = MasterGraphLog.read(self.graphPath)
+        self.assertEqual(canonical(snapshot), canonical(newMaster))
+        self.assertEqual(len(deltas), 1)
+        self.assertEqual([name for name in os.listdir(self.directory) if name.endswith(".tmp")], [])
+
+    def testTruncatedRecord(self):
+        logPath = MasterGraphLog.getLogPath(self.graphPath)
+        with open(logPath, "ab") as logFile:
+            logFile.write(PackageGraph.fromMultiDiGraph(self.nxMaster).encode()[:100])
+        (_, deltas) = MasterGraphLog.read(self.graphPath)
+        self.assertEqual(len(deltas), len(self.nxDeltas))
+
+    def testUnsupportedLog(self):
+        self.assertRaises(ValueError, MasterGraphLog.decodeRecords, "PKGOTHER" + "\0" * 20)
+
+    def testRemove(self):
+        MasterGraphLog.remove(self.graphPath)
+        self.assertFalse(os.path.isfile(self.graphPath))
+        self.assertFalse(os.path.isfile(MasterGraphLog.getLogPath(self.graphPath)))
+
+
+if __name__ == "__main__":
+    unittest.main()
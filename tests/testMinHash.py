@@ -0,0 +1,61 @@
+import random
+import unittest
+
+import numpy as np
+
+from MinHash import MinHash
+from StaticInfo import StaticInfo
+
+
+class MinHashTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(50)
+        self.tokens = ["pkg%i=1.%i" % (i, i % 3) for i in xrange(1000)]
+
+    def testTokens(self):
+        packageIndex = {"a": ("1.0", "amd64", 10), "b": ("2.0", "all", 20)}
+        self.assertEqual(sorted(MinHash.getTokens(packageIndex)), ["a=1.0", "b=2.0"])
+        self.assertEqual(MinHash.getTokens(packageIndex, ["b"]), ["b=2.0"])
+
+    def testEstimateJaccard(self):
+        for _ in xrange(20):
+            tokens1 = set(random.sample(self.tokens, 300))
+            tokens2 = set(random.sample(tokens1, random.randint(0, 300)) + random.sample(self.tokens, random.randint(0, 300)))
+            jaccard = float(len(tokens1 & tokens2)) / len(tokens1 | tokens2)
+            estimate = MinHash.estimateJaccard(MinHash.getSignature(list(tokens1)), MinHash.getSignature(list(tokens2)))
+            # standard deviation of the estimate is at most 0.5 / sqrt(numPermutations)
+            self.assertLess(abs(estimate - jaccard), 4 * 0.5 / StaticInfo.minHashNumPermutations ** 0.5)
+
+    def testMerge(self):
+        tokens1 = random.sample(self.tokens, 200)
+        tokens2 = random.sample(self.tokens, 200)
+        merged = MinHash.merge(MinHash.getSignature(tokens1), MinHash.getSignature(tokens2))
+        self.assertTrue(np.array_equal(merged, MinHash.getSignature(tokens1 + tokens2)))
+        self.assertTrue(np.array_equal(MinHash.merge(MinHash.getSignature([]), MinHash.getSignature(tokens1)),
+                                       MinHash.getSignature(tokens1)))
+
+    def testEmpty(self):
+        signature = MinHash.getSignature([])
+        self.assertEqual(len(signature), StaticInfo.minHashNumPermutations)
+        self.assertEqual(MinHash.estimateJaccard(signature, MinHash.getSignature(self.tokens)), 0.0)
+
+    def testBlob(self):
+        signature = MinHash.getSignature(self.tokens)
+        self.assertEqual(signature.dtype, MinHash.dtype)
+        self.assertTrue(np.array_equal(MinHash.fromBlob(MinHash.toBlob(signature)), signature))
+
+    def testBuckets(self):
+        tokens = random.sample(self.tokens, 100)
+        buckets = MinHash.getBuckets(MinHash.getSignature(tokens))
+        self.assertEqual(len(buckets), StaticInfo.minHashBands)
+        self.assertEqual(buckets, MinHash.getBuckets(MinHash.getSignature(list(reversed(tokens)))))
+        # sets with a high Jaccard similarity share a bucket, disjoint sets do not
+        similar = tokens[:95] + random.sample(self.tokens, 5)
+        self.assertTrue(set(buckets) & set(MinHash.getBuckets(MinHash.getSignature(similar))))
+        disjoint = [token for token in self.tokens if token not in tokens][:100]
+        self.assertFalse(set(buckets) & set(MinHash.getBuckets(MinHash.getSignature(disjoint))))
+
+
+if __name__ == "__main__":
+    unittest.main()
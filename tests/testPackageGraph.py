@@ -0,0 +1,90 @@
+import random
+import unittest
+
+import networkx as nx
+
+from PackageGraph import PackageGraph
+
+
+def createRandomGraph(numNodes, numEdges, seed):
+    random.seed(seed)
+    graph = nx.MultiDiGraph()
+    for i in xrange(numNodes):
+        graph.add_node("pkg%i" % i, name="pkg%i" % i, version="1.%i" % (i % 5), architecture=random.choice(["amd64", "all"]),
+                       size=random.randint(0, 1000))
+    for _ in xrange(numEdges):
+        data = random.choice([{}, {"constraint": False}, {"constraint": True, "operator": ">=", "version": "1.2"}])
+        graph.add_edge("pkg%i" % random.randrange(numNodes), "pkg%i" % random.randrange(numNodes), **data)
+    return graph
+
+
+def canonical(graph):
+    """
+    :return: nodes and edges with attributes in an order that does not depend on the graph implementation
+    """
+    return (sorted(graph.nodes(data=True)),
+            sorted((u, v, sorted(data.items())) for (u, v, data) in graph.edges(data=True)))
+
+
+class PackageGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nxGraph = createRandomGraph(300, 900, seed=1)
+        self.graph = PackageGraph.fromMultiDiGraph(self.nxGraph)
+
+    def testConversion(self):
+        self.assertEqual(canonical(self.graph), canonical(self.nxGraph))
+        self.assertEqual(canonical(self.graph.toMultiDiGraph()), canonical(self.nxGraph))
+        self.assertEqual(len(self.graph), self.nxGraph.number_of_nodes())
+        self.assertEqual(self.graph.number_of_edges(), self.nxGraph.number_of_edges())
+
+    def testReachability(self):
+        random.seed(2)
+        for _ in xrange(20):
+            roots = random.sample(self.graph.nodes(), random.randint(1, 3))
+            expected = set(roots)
+            for root in roots:
+                expected.update(nx.descendants(self.nxGraph, root))
+            reachable = self.graph.getReachableNodes(roots)
+            self.assertEqual(len(reachable), len(expected))
+            self.assertEqual(set(reachable), expected)
+            self.assertEqual(self.graph.getReachableBitset(roots),
+                             self.graph.getBitsetFromIDs(self.graph.getReachableIDs(roots)))
+
+    def testReachabilityWithKnownClosures(self):
+        knownClosures = dict((self.graph.index[name], self.graph.getReachableBitset([name]))
+                             for name in random.sample(self.graph.nodes(), 30))
+        for name in self.graph.nodes():
+            self.assertEqual(self.graph.getReachableBitset([name], knownClosures),
+                             self.graph.getReachableBitset([name]))
+
+    def testReachabilityOfUnknownNode(self):
+        self.assertRaises(KeyError, self.graph.getReachableNodes, ["unknown"])
+
+    def testBitsets(self):
+        nodeIDs = [0, 7, 8, 100, len(self.graph) - 1]
+        self.assertEqual(self.graph.getIDsFromBitset(self.graph.getBitsetFromIDs(nodeIDs)), nodeIDs)
+        self.assertEqual(self.graph.getIDsFromBitset(0), [])
+
+    def testSubgraph(self):
+        random.seed(3)
+        for size in (0, 1, 50, 300):
+            names = random.sample(self.graph.nodes(), size) + ["unknown"]
+            expected = self.nxGraph.subgraph([name for name in names if name in self.nxGraph])
+            self.assertEqual(canonical(self.graph.subgraph(names)), canonical(expected))
+
+    def testCompose(self):
+        other = PackageGraph.fromMultiDiGraph(createRandomGraph(350, 500, seed=4))
+        expected = nx.compose(self.nxGraph, other.toMultiDiGraph())
+        self.assertEqual(canonical(PackageGraph.compose(self.graph, other)), canonical(expected))
+
+    def testPackageIndex(self):
+        packageIndex = self.graph.getPackageIndex()
+        for (name, data) in self.nxGraph.nodes(data=True):
+            self.assertEqual(packageIndex[name], (data["version"], data["architecture"], data["size"]))
+        # packages only known from edges have no attributes
+        self.assertEqual(PackageGraph([], [("a", "b")]).getPackageIndex()["b"][2], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
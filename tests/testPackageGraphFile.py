@@ -0,0 +1,91 @@
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+
+import networkx as nx
+
+from PackageGraph import PackageGraph
+from PackageGraphFile import PackageGraphFile, Missing
+from testPackageGraph import createRandomGraph, canonical
+
+
+class PackageGraphFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.graph = PackageGraph.fromMultiDiGraph(createRandomGraph(200, 600, seed=5))
+        # attribute values of all supported types
+        self.graph.columns["misc"] = [None, True, False, -(1 << 40), u"\xe4", "", Missing] + [0] * (len(self.graph) - 7)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testEncodeDecode(self):
+        decoded = PackageGraph.decode(self.graph.encode())
+        self.assertEqual(canonical(decoded), canonical(self.graph))
+        self.assertEqual(decoded.getNodeDataByID(4)["misc"], u"\xe4")
+        self.assertNotIn("misc", decoded.getNodeDataByID(6))
+        self.assertEqual(decoded.getPackageIndex(), self.graph.getPackageIndex())
+
+    def testDecodeIsLazy(self):
+        decoded = PackageGraph.decode(self.graph.encode())
+        self.assertEqual(len(decoded), len(self.graph))
+        self.assertEqual(decoded.number_of_edges(), self.graph.number_of_edges())
+        self.assertNotIn("names", decoded.__dict__)
+        self.assertNotIn("targets", decoded.__dict__)
+
+    def testEmptyGraph(self):
+        self.assertEqual(canonical(PackageGraph.decode(PackageGraph().encode())), ([], []))
+
+    def testWriteRead(self):
+        path = os.path.join(self.directory, "graph")
+        self.graph.write(path)
+        self.assertTrue(PackageGraphFile.isGraphFile(path))
+        self.assertEqual(canonical(PackageGraph.read(path)), canonical(self.graph))
+
+    def testWriteReadMapped(self):
+        path = os.path.join(self.directory, "graph")
+        self.graph.write(path)
+        mmapMinSize = PackageGraphFile.mmapMinSize
+        PackageGraphFile.mmapMinSize = 0
+        try:
+            graph = PackageGraph.read(path)
+        finally:
+            PackageGraphFile.mmapMinSize = mmapMinSize
+        self.assertNotIsInstance(graph.graphFile.data, str)
+        self.assertEqual(canonical(graph), canonical(self.graph))
+
+    def testPickleReadGraph(self):
+        path = os.path.join(self.directory, "graph")
+        self.graph.write(path)
+        unpickled = cPickle.loads(cPickle.dumps(PackageGraph.read(path), 2))
+        self.assertEqual(canonical(unpickled), canonical(self.graph))
+
+    def testReadLegacyPickledPackageGraph(self):
+        # graphs pickled before PackageGraphFile existed reference the attribute marker as PackageGraph._Missing
+        data = cPickle.dumps(self.graph, 2)
+        self.assertIn("cPackageGraphFile\nMissing\n", data)
+        data = data.replace("cPackageGraphFile\nMissing\n", "cPackageGraph\n_Missing\n")
+        path = os.path.join(self.directory, "legacy.graph")
+        with open(path, "wb") as graphFile:
+            graphFile.write(data)
+        self.assertFalse(PackageGraphFile.isGraphFile(path))
+        graph = PackageGraph.read(path)
+        self.assertIsNone(graph.graphFile)
+        self.assertEqual(canonical(graph), canonical(self.graph))
+        self.assertNotIn("misc", graph.getNodeDataByID(6))
+
+    def testReadLegacyNetworkxGraph(self):
+        nxGraph = createRandomGraph(100, 300, seed=6)
+        path = os.path.join(self.directory, "legacy.graph")
+        nx.write_gpickle(nxGraph, path)
+        self.assertEqual(canonical(PackageGraph.read(path)), canonical(nxGraph))
+
+    def testRejectsOtherData(self):
+        self.assertRaises(ValueError, PackageGraphFile, "NOTAGRAPH" + "\0" * 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import random
+import unittest
+
+from PackageNameIndex import PackageNameIndex
+
+
+def getEditDistance(name1, name2):
+    """
+        Uncapped reference of PackageNameIndex.getEditDistance (optimal string alignment)
+    """
+    distances = dict()
+    for i in xrange(len(name1) + 1):
+        for j in xrange(len(name2) + 1):
+            if i == 0 or j == 0:
+                distances[i, j] = i + j
+                continue
+            distances[i, j] = min(distances[i - 1, j] + 1,
+                                  distances[i, j - 1] + 1,
+                                  distances[i - 1, j - 1] + (name1[i - 1] != name2[j - 1]))
+            if i > 1 and j > 1 and name1[i - 1] == name2[j - 2] and name1[i - 2] == name2[j - 1]:
+                distances[i, j] = min(distances[i, j], distances[i - 2, j - 2] + 1)
+    return distances[len(name1), len(name2)]
+
+
+def createTypo(name):
+    position = random.randrange(len(name))
+    edit = random.choice(["insert", "delete", "substitute", "transpose"])
+    if edit == "insert":
+        return name[:position] + random.choice("abcxyz-") + name[position:]
+    if edit == "delete":
+        return name[:position] + name[position + 1:]
+    if edit == "substitute":
+        return name[:position] + random.choice("abcxyz-") + name[position + 1:]
+    position = min(position, len(name) - 2)
+    return name[:position] + name[position + 1] + name[position] + name[position + 2:]
+
+
+class PackageNameIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(30)
+        prefixes = ["lib", "python-", "python3-", "php7.2-", "", "", ""]
+        stems = ["ssl", "apache2", "mysql", "nginx", "zlib", "curl", "xml", "perl", "gcc", "pam", "db", "x"]
+        suffixes = ["", "-dev", "-common", "1.1", "-data", "6", "-bin"]
+        self.names = sorted(set(random.choice(prefixes) + random.choice(stems) + random.choice(suffixes)
+                                for _ in xrange(500)))
+        random.shuffle(self.names)
+        self.index = PackageNameIndex(self.names)
+
+    def testIndex(self):
+        self.assertEqual(len(self.index), len(self.names))
+        self.assertIn(self.names[0], self.index)
+        self.assertNotIn("unknown", self.index)
+        self.index.add(self.names[0], "vmi1")
+        self.index.add(self.names[0], "vmi2")
+        self.assertEqual(len(self.index), len(self.names))
+        self.assertEqual(self.index.getOwners(self.names[0]), set(["vmi1", "vmi2"]))
+        self.assertEqual(self.index.getOwners("unknown"), set())
+
+    def testNamesContaining(self):
+        for query in ["", "l", "db", "lib", "ssl", "-dev", "python3-x", "php7.2-curl-common", "unknown"]:
+            self.assertEqual(self.index.getNamesContaining(query), [name for name in self.names if query in name])
+
+    def testEditDistance(self):
+        random.seed(31)
+        for _ in xrange(500):
+            (name1, name2) = random.sample(self.names, 2)
+            if random.random() < 0.5:
+                name2 = createTypo(createTypo(name1))
+            expected = getEditDistance(name1, name2)
+            for maxDistance in (0, 1, 2, 3, 10):
+                self.assertEqual(PackageNameIndex.getEditDistance(name1, name2, maxDistance),
+                                 min(expected, maxDistance + 1))
+
+    def testSimilarNames(self):
+        random.seed(32)
+        for _ in xrange(200):
+            query = random.choice(self.names)
+            for _ in xrange(random.randint(0, 2)):
+                query = createTypo(query)
+            maxDistance = max(1, len(query) // 3)
+            expected = sorted([(len(name) - len(query), name) for name in self.names if query in name]
+                              + [(getEditDistance(query, name), name) for name in self.names
+                                 if query not in name and getEditDistance(query, name) <= maxDistance])
+            self.assertEqual(self.index.getSimilarNames(query, maxResults=len(self.names)),
+                             [name for (_, name) in expected])
+            self.assertEqual(self.index.getSimilarNames(query), [name for (_, name) in expected[:10]])
+
+    def testSimilarNamesOfTypo(self):
+        self.assertEqual(self.index.getSimilarNames("ngnix")[0], "nginx")
+
+
+if __name__ == "__main__":
+    unittest.main()
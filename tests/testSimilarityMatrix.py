@@ -0,0 +1,116 @@
+import random
+import unittest
+
+import numpy as np
+
+from SimilarityMatrix import SimilarityMatrix
+
+
+class FakeDescriptor:
+    """
+        Provides the part of the VMIDescriptor interface used by SimilarityMatrix
+    """
+    def __init__(self, packageIndex, mainServiceNames):
+        self.packageIndex = packageIndex
+        self.mainServiceNames = mainServiceNames
+        self.mainServices = ["service"]
+
+    def getPackageIndex(self):
+        return self.packageIndex
+
+    def getNamesFromSubTrees(self, roots):
+        return self.mainServiceNames
+
+
+def computeSimilarity(vmi1, vmi2, onlyOnMainServices):
+    """
+        Reference of the weighted similarity, see SimilarityCalculator.computeWeightedSimilarityBetweenVMIDescriptors
+    """
+    packages1 = vmi1.getPackageIndex()
+    packages2 = vmi2.getPackageIndex()
+    if onlyOnMainServices:
+        nodesToCheck = set(vmi1.mainServiceNames) | set(vmi2.mainServiceNames)
+    else:
+        nodesToCheck = set(packages1) | set(packages2)
+    sumAll = 0.0
+    sumMatches = 0.0
+    for pkgName in nodesToCheck:
+        if pkgName in packages1 and pkgName in packages2:
+            (version1, arch1, size1) = packages1[pkgName]
+            (version2, arch2, size2) = packages2[pkgName]
+            sumAll = sumAll + max(size1, size2)
+            if version1 == version2 and (arch1 == arch2 or arch1 == "all" or arch2 == "all"):
+                sumMatches = sumMatches + max(size1, size2)
+        elif pkgName in packages1:
+            sumAll = sumAll + packages1[pkgName][2]
+        elif pkgName in packages2:
+            sumAll = sumAll + packages2[pkgName][2]
+    if sumAll == 0:
+        return 0.0
+    return sumMatches / sumAll
+
+
+def createDescriptors(numVMIs, seed):
+    random.seed(seed)
+    descriptors = []
+    for _ in xrange(numVMIs):
+        packageIndex = dict()
+        for i in random.sample(xrange(300), random.randint(0, 120)):
+            packageIndex["pkg%i" % i] = (random.choice(["1.0", "1.1"]),
+                                         random.choice(["amd64", "all", "i386"]),
+                                         random.randint(1, 1000))
+        mainServiceNames = random.sample(packageIndex.keys(), min(len(packageIndex), random.randint(0, 30)))
+        descriptors.append(FakeDescriptor(packageIndex, mainServiceNames))
+    return descriptors
+
+
+class SimilarityMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.descriptors = createDescriptors(25, seed=40)
+
+    def getExpectedMatrix(self, onlyOnMainServices):
+        numVMIs = len(self.descriptors)
+        expected = np.zeros((numVMIs, numVMIs))
+        for i in xrange(numVMIs):
+            for j in xrange(numVMIs):
+                if i != j:
+                    expected[i, j] = computeSimilarity(self.descriptors[i], self.descriptors[j], onlyOnMainServices)
+        return expected
+
+    def testMatrix(self):
+        for onlyOnMainServices in (False, True):
+            matrix = SimilarityMatrix(self.descriptors, onlyOnMainServices).getMatrix()
+            np.testing.assert_allclose(matrix, self.getExpectedMatrix(onlyOnMainServices), rtol=1e-12)
+
+    def testSimilarities(self):
+        numVMIs = len(self.descriptors)
+        for onlyOnMainServices in (False, True):
+            similarityMatrix = SimilarityMatrix(self.descriptors, onlyOnMainServices)
+            expected = self.getExpectedMatrix(onlyOnMainServices)
+            for i in xrange(numVMIs):
+                similarities = similarityMatrix.getSimilarities(i)
+                similarities[i] = 0.0
+                np.testing.assert_allclose(similarities, expected[i], rtol=1e-12)
+                others = [j for j in xrange(numVMIs) if j != i and j % 3 == 0]
+                np.testing.assert_allclose(similarityMatrix.getSimilarities(i, others), expected[i, others], rtol=1e-12)
+                for others in (slice(i + 1, numVMIs), slice(0, i), slice(1, None, 2)):
+                    similarities = similarityMatrix.getSimilarities(i, others)
+                    if others.start == 1:
+                        # may include i
+                        similarities[np.arange(numVMIs)[others] == i] = 0.0
+                    np.testing.assert_allclose(similarities, expected[i, others], rtol=1e-12)
+
+    def testIdenticalVMIs(self):
+        descriptors = [self.descriptors[1], self.descriptors[1]]
+        matrix = SimilarityMatrix(descriptors, onlyOnMainServices=False).getMatrix()
+        self.assertEqual(matrix[0, 1], 1.0 if len(self.descriptors[1].packageIndex) > 0 else 0.0)
+
+    def testEmpty(self):
+        self.assertEqual(SimilarityMatrix([], onlyOnMainServices=False).getMatrix().shape, (0, 0))
+        descriptors = [FakeDescriptor(dict(), []), FakeDescriptor(dict(), [])]
+        self.assertEqual(SimilarityMatrix(descriptors, onlyOnMainServices=True).getMatrix().tolist(), [[0.0, 0.0], [0.0, 0.0]])
+
+
+if __name__ == "__main__":
+    unittest.main()